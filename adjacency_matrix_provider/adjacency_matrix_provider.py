@@ -20,16 +20,19 @@ __copyright__ = '(C) 2025 by nbayashi'
 # This will get replaced with a git SHA1 when you do a git archive
 
 __revision__ = '$Format:%H$'
+import threading
 from pathlib import Path
 from PyQt5.QtGui import QIcon
 
 from qgis.core import QgsProcessingProvider
+from ..utils.r_session import RSessionPool
 from .r_adjacency_matrix_algorithm import AdjacencyMatrixAlgorithm
 from .r_knearneigh_algorithm import KnearneighAlgorithm
 from .r_dnearneigh_algorithm import DnearneighAlgorithm
 from .gisa.gisa_adjacency_matrix_algorithm import GISAAdjacencyMatrixAlgorithm
 from .gisa.gisa_knearneigh_algorithm import GISAKnearneighAlgorithm
 from .gisa.gisa_dnearneigh_algorithm import GISADnearneighAlgorithm
+from .gisa.gisa_correlogram_algorithm import GISACorrelogramAlgorithm
 from .lisa.lisa_adjacency_matrix_algorithm import LISAAdjacencyMatrixAlgorithm
 from .lisa.lisa_dnearneigh_algorithm import LISADnearneighAlgorithm
 from .lisa.lisa_knearneigh_algorithm import LISAKnearneighAlgorithm
@@ -39,9 +42,29 @@ class AdjacencyMatrixProvider(QgsProcessingProvider):
 
     def __init__(self):
         QgsProcessingProvider.__init__(self)
+        self._r_session_pool = None
+        self._pool_lock = threading.Lock()
 
     def unload(self):
-        pass
+        # 常駐Rワーカーを終了
+        with self._pool_lock:
+            if self._r_session_pool is not None:
+                self._r_session_pool.shutdown()
+                self._r_session_pool = None
+
+    def r_session_pool(self, rscript_path):
+        """
+        全アルゴリズムで共有する常駐Rセッションのプールを返す。
+        アルゴリズムはバックグラウンドのタスクとして並行して実行されるので、実行ごとにプールから
+        空いているセッションを借りる。Rscriptのパスが変更された場合は作り直す。
+        """
+        with self._pool_lock:
+            if self._r_session_pool is not None and self._r_session_pool.rscript_path != rscript_path:
+                self._r_session_pool.shutdown()
+                self._r_session_pool = None
+            if self._r_session_pool is None:
+                self._r_session_pool = RSessionPool(rscript_path)
+            return self._r_session_pool
 
     def loadAlgorithms(self):
         self.addAlgorithm(AdjacencyMatrixAlgorithm())
@@ -51,6 +74,7 @@ class AdjacencyMatrixProvider(QgsProcessingProvider):
         self.addAlgorithm(GISAAdjacencyMatrixAlgorithm())
         self.addAlgorithm(GISAKnearneighAlgorithm())
         self.addAlgorithm(GISADnearneighAlgorithm())
+        self.addAlgorithm(GISACorrelogramAlgorithm())
         # add LISA algorithms
         self.addAlgorithm(LISAAdjacencyMatrixAlgorithm())
         self.addAlgorithm(LISADnearneighAlgorithm())
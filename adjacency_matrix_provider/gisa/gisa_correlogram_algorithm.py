@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ R SpatialStatistics
+                              -------------------
+        begin                : 2025-04-13
+        copyright            : (C) 2025 by nbayashi
+        email                : naoya_nstyle@hotmail.co.jp
+ ***************************************************************************/
+"""
+
+__author__ = 'nbayashi'
+__date__ = '2025-04-13'
+__copyright__ = '(C) 2025 by nbayashi'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+import csv
+import os
+
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsProcessing,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterFileDestination,
+                       QgsFeature,
+                       QgsFeatureSink,
+                       QgsField,
+                       QgsFields,
+                       QgsWkbTypes,
+                       NULL)
+
+
+from qgis.PyQt.QtGui import QIcon
+from ...utils.layer_tools import input_view, layer_centroids, metric_crs
+from ...utils.native_weights import layer_field_values
+from ...utils.correlogram import parse_number_list, distance_correlogram, knn_correlogram
+from ...utils.profiling import add_profile_parameter, stage_profiler
+
+# 出力する列（名前, 型）
+CORRELOGRAM_FIELDS = [
+    ("lag", QVariant.Int),
+    ("distance_from", QVariant.Double),
+    ("distance_to", QVariant.Double),
+    ("k", QVariant.Int),
+    ("avg_links", QVariant.Double),
+    ("isolated", QVariant.Int),
+    ("moran_i", QVariant.Double),
+    ("expectation", QVariant.Double),
+    ("variance", QVariant.Double),
+    ("z_score", QVariant.Double),
+    ("p_value", QVariant.Double),
+]
+
+
+class GISACorrelogramAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    SELECTED_ONLY = 'SELECTED_ONLY'
+    FIELD = 'FIELD'
+    NEIGHBOR_TYPE = 'NEIGHBOR_TYPE'
+    DISTANCE_BANDS = 'DISTANCE_BANDS'
+    CUMULATIVE = 'CUMULATIVE'
+    K_VALUES = 'K_VALUES'
+    OUTPUT = 'OUTPUT'
+    OUTPUT_CSV = 'OUTPUT_CSV'
+
+
+    def initAlgorithm(self, config):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INPUT,
+                self.tr('Input layer'),
+                [QgsProcessing.TypeVectorAnyGeometry]
+            )
+        )
+        # 選択地物のみ（ファイルのレイヤは R に FID の条件を渡し、絞り込んだコピーは作らない）
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.SELECTED_ONLY,
+                description='Selected features only',
+                defaultValue=False
+            )
+        )
+        # 属性の設定
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.FIELD,
+                self.tr('Field'),
+                parentLayerParameterName=self.INPUT,
+                type=QgsProcessingParameterField.Numeric,
+                optional=False
+            )
+        )
+
+        # 距離帯 or k 近傍
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name=self.NEIGHBOR_TYPE,
+                description='Neighbor type',
+                options=['Distance bands (dnearneigh)', 'K-nearest neighbors (knearneigh)'],
+                defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                name=self.DISTANCE_BANDS,
+                description='Distance band upper limits (comma separated, for distance bands)',
+                defaultValue='1000, 2000, 5000, 10000',
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.CUMULATIVE,
+                description='Cumulative bands (0 to d); otherwise rings between consecutive limits',
+                defaultValue=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                name=self.K_VALUES,
+                description='k values (comma separated, for k-nearest neighbors)',
+                defaultValue='1, 2, 4, 8, 16',
+                optional=True
+            )
+        )
+
+        # グラフ用のテーブル（ジオメトリなし）
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                name=self.OUTPUT,
+                description='Correlogram',
+                type=QgsProcessing.TypeVector
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUTPUT_CSV,
+                description='Export correlogram CSV',
+                fileFilter='CSV (*.csv)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        # 段階ごとの計測結果（詳細設定）
+        add_profile_parameter(self)
+
+
+    def processAlgorithm(self, parameters, context, feedback):
+        profiler = stage_profiler(self, parameters, context, feedback)
+        input_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        # 選択地物のみの場合は選択地物だけが見えるレイヤ（サブセットはそのまま適用される）
+        input_layer = input_view(input_layer, self.parameterAsBool(parameters, self.SELECTED_ONLY, context))
+        field_name = self.parameterAsString(parameters, self.FIELD, context)
+        use_knn = self.parameterAsEnum(parameters, self.NEIGHBOR_TYPE, context) == 1
+        output_csv = self.parameterAsFile(parameters, self.OUTPUT_CSV, context)
+
+        try:
+            if use_knn:
+                ks = parse_number_list(self.parameterAsString(parameters, self.K_VALUES, context), integer=True)
+            else:
+                bands = parse_number_list(self.parameterAsString(parameters, self.DISTANCE_BANDS, context))
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+
+        values = layer_field_values(input_layer, field_name)
+        if any(v is None or v == NULL for v in values):
+            raise QgsProcessingException(f"フィールド {field_name} に NULL の地物があります")
+        # 地理座標系は R 側と同じく EPSG:3857（単位：メートル）で距離を測る
+        coords, _ = layer_centroids(input_layer, metric_crs(input_layer), feedback)
+        if feedback.isCanceled():
+            return {}
+        profiler.mark("入力の読み込み")
+
+        if use_knn:
+            feedback.pushInfo(f"k 近傍: {', '.join(str(k) for k in ks)}")
+            try:
+                rows = knn_correlogram(coords, values, ks, feedback)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+        else:
+            feedback.pushInfo(f"距離帯: {', '.join(f'{d:g}' for d in bands)}")
+            rows = distance_correlogram(
+                coords, values, bands, self.parameterAsBool(parameters, self.CUMULATIVE, context), feedback
+            )
+
+        profiler.mark("コレログラムの計算")
+
+        fields = QgsFields()
+        for name, field_type in CORRELOGRAM_FIELDS:
+            fields.append(QgsField(name, field_type))
+        sink, dest_id = self.parameterAsSink(
+            parameters, self.OUTPUT, context, fields, QgsWkbTypes.NoGeometry, input_layer.crs()
+        )
+
+        feedback.pushInfo("=== Moran's I correlogram ===")
+        feedback.pushInfo("lag\tfrom\tto\tk\tavg_links\tmoran_i\tz_score\tp_value")
+        for row in rows:
+            feedback.pushInfo(
+                f"{row['lag']}\t{row['distance_from']:g}\t{row['distance_to']:g}\t{row['k'] or ''}\t"
+                f"{row['avg_links']:.3g}\t{row['moran_i']:.6g}\t{row['z_score']:.6g}\t{row['p_value']:.6g}"
+            )
+            if sink is not None:
+                feat = QgsFeature(fields)
+                feat.setAttributes([row[name] for name, _ in CORRELOGRAM_FIELDS])
+                sink.addFeature(feat, QgsFeatureSink.FastInsert)
+        feedback.pushInfo("=============================")
+
+        if output_csv:
+            with open(output_csv, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow([name for name, _ in CORRELOGRAM_FIELDS])
+                for row in rows:
+                    writer.writerow(["" if row[name] is None else row[name] for name, _ in CORRELOGRAM_FIELDS])
+
+        profiler.mark("出力の書き込み")
+
+        result_dict = {self.OUTPUT: dest_id}
+        if output_csv:
+            result_dict[self.OUTPUT_CSV] = output_csv
+        return profiler.finish(result_dict)
+
+    def name(self):
+        return 'gisacorrelogram'
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), 'icon_gisa_correlogram.png'))
+
+
+    def displayName(self):
+        return self.tr('GISA(Moran\'s I correlogram)')
+
+    def group(self):
+        return self.tr('Global Indicator of Spatial Association')
+
+    def groupId(self):
+        return 'rgisa'
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return GISACorrelogramAlgorithm()
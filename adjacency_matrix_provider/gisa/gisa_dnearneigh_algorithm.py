@@ -17,16 +17,14 @@ __copyright__ = '(C) 2025 by nbayashi'
 # This will get replaced with a git SHA1 when you do a git archive
 
 __revision__ = '$Format:%H$'
-import subprocess
 import os
 
-import tempfile
-
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsSettings,
                        QgsProcessing,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
+                       QgsProcessingParameterDefinition,
                        QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterField,
                        QgsProcessingParameterBoolean,
@@ -35,18 +33,35 @@ from qgis.core import (QgsSettings,
                        QgsProcessingParameterEnum)
 
 from qgis.PyQt.QtGui import QIcon
-from ...utils.layer_tools import get_layer_path_or_temp
+from ...utils.layer_tools import input_view, r_read_layer_code, layer_centroids, metric_crs
+from ...utils.neighbours import distance_band_edges, write_edges, r_read_edges_code
+from ...utils.weights_cache import (weights_cache_path, is_cached, r_cached_nb_code,
+                                    evict_weights_cache)
+from ...utils.handoff import HANDOFF_MODES, HANDOFF_BINARY, write_handoff
+from ...utils.gisa_results import (GISA_STATISTICS, OUTPUT_JSON, analysis_fields, r_gisa_listw_code,
+                                   r_gisa_tests_code, add_gisa_outputs, read_gisa_table, gisa_outputs)
+from ...utils.r_session import run_r_script
+from ...utils.scratch import scratch_scoped, scratch_path, cleanup_scratch
+from ...utils.profiling import add_profile_parameter, stage_profiler
+from ...utils.r_packages import ensure_r_packages, r_library_code
 
 
 class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
 
     FIELD = 'FIELD'
+    FIELDS = 'FIELDS'
     INPUT = 'INPUT'
+    SELECTED_ONLY = 'SELECTED_ONLY'
     STATISTICS_TYPE = 'STATISTICS_TYPE'
     D_MIN = 'D_MIN'
     D_MAX = 'D_MAX'
     USE_DISTANCE_DECAY = 'USE_DISTANCE_DECAY'
+    N_SIMULATIONS = 'N_SIMULATIONS'
+    SEED = 'SEED'
     OUTPUT = 'OUTPUT'
+    OUTPUT_TABLE = 'OUTPUT_TABLE'
+    ENGINE = 'ENGINE'
+    DATA_HANDOFF = 'DATA_HANDOFF'
 
 
 
@@ -58,6 +73,14 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
                 [QgsProcessing.TypeVectorAnyGeometry]
             )
         )
+        # 選択地物のみ（ファイルのレイヤは R に FID の条件を渡し、絞り込んだコピーは作らない）
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.SELECTED_ONLY,
+                description='Selected features only',
+                defaultValue=False
+            )
+        )
         # 属性の設定
         self.addParameter(
                     QgsProcessingParameterField(
@@ -69,12 +92,25 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
                     )
                 )
 
+        # 追加フィールド（近傍は一度だけ作り、複数フィールドをまとめて計算）
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.FIELDS,
+                self.tr('Additional fields (batch)'),
+                parentLayerParameterName=self.INPUT,
+                type=QgsProcessingParameterField.Numeric,
+                allowMultiple=True,
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterEnum(
                 name=self.STATISTICS_TYPE,
                 description='Statistics type',
                 options=['Global Moran\'s I', 'Global Geary\'s C','Global Getis-Ord G','Global Getis-Ord G*'],
-                defaultValue=0
+                allowMultiple=True,
+                defaultValue=[0]
             )
         )
         # dnearneigh → 距離設定
@@ -93,6 +129,16 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # 近傍計算エンジン
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name=self.ENGINE,
+                description='Neighbor engine',
+                options=['R (spdep)', 'Native (NumPy/SciPy)'],
+                defaultValue=0
+            )
+        )
+
 
 
         self.addParameter(
@@ -103,6 +149,37 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # 並べ替え検定（0 のときは解析的な検定のみ）
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.N_SIMULATIONS,
+                description='Number of permutations (0 = analytical test only)',
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=99999
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.SEED,
+                description='Random seed for permutations',
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=1
+            )
+        )
+
+        # Rへのデータ受け渡し方法（詳細設定）
+        handoff_param = QgsProcessingParameterEnum(
+            name=self.DATA_HANDOFF,
+            description='Data handoff to R',
+            options=HANDOFF_MODES,
+            defaultValue=0
+        )
+        handoff_param.setFlags(handoff_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(handoff_param)
+
         # txt
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -114,19 +191,46 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
-       
+        # フィールドごとの集計表（CSV）
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.OUTPUT_TABLE,
+                description='Export result table (CSV)',
+                fileFilter='CSV (*.csv)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        # 検定結果の JSON と型付き出力（統計量・p値・近傍の要約）
+        add_gisa_outputs(self)
+
+        # 段階ごとの計測結果（詳細設定）
+        add_profile_parameter(self)
+
+    @scratch_scoped
     def processAlgorithm(self, parameters, context, feedback):
+        profiler = stage_profiler(self, parameters, context, feedback)
         rscript_path = QgsSettings().value("RRunner/RscriptPath", "")
         # Check if the Rscript path is set
         if not os.path.exists(rscript_path):
             raise QgsProcessingException("Rscriptのパスが無効です")
+        ensure_r_packages(rscript_path)
+        profiler.mark("R パッケージの確認")
         
 
         input_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        # 選択地物のみの場合は選択地物だけが見えるレイヤ（サブセットはそのまま適用される）
+        input_layer = input_view(input_layer, self.parameterAsBool(parameters, self.SELECTED_ONLY, context))
         # フィールド名を取得
         field_name = self.parameterAsString(parameters, self.FIELD, context)
+        field_names = analysis_fields(field_name, self.parameterAsFields(parameters, self.FIELDS, context))
 
         output = self.parameterAsFile(parameters, self.OUTPUT, context)
+        output_table = self.parameterAsFile(parameters, self.OUTPUT_TABLE, context)
+        output_json = self.parameterAsFile(parameters, OUTPUT_JSON, context)
+        # R から集計表を受け取る一時ファイル
+        results_path = scratch_path("gisa_table_", ".tsv")
 
         
 
@@ -135,53 +239,64 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
 
 
         use_distance_decay = self.parameterAsBool(parameters, 'USE_DISTANCE_DECAY', context)
-        r_use_decay = "TRUE" if use_distance_decay else "FALSE"
+
+        n_simulations = self.parameterAsInt(parameters, self.N_SIMULATIONS, context)
+        seed = self.parameterAsInt(parameters, self.SEED, context)
         
-        # 共通: 座標（重心）
-        r_nb_code = "coords <- st_coordinates(st_centroid(polygons))\n"
-        r_nb_code += f'nb <- dnearneigh(coords, d1 = {d_minimum}, d2 = {d_maximum})\n'
+        engine = self.parameterAsEnum(parameters, self.ENGINE, context)
+        # 同じレイヤ・同じ設定で構築済みの近傍はキャッシュから読み込む
+        nb_cache_path = weights_cache_path(input_layer, "dnear", d1=d_minimum, d2=d_maximum, engine=engine)
+        nb_cached = is_cached(nb_cache_path)
+        if nb_cached:
+            feedback.pushInfo("キャッシュ済みの近傍を使用します")
+        edges_path = None
+        if engine == 1:
+            # ネイティブエンジン: QGIS側で距離帯の近傍を求め、近傍リストだけをRに渡す
+            # キャッシュがあっても、R が読み込む前にキャッシュが削除された場合に備えて辺を書き出しておく
+            # （ネイティブエンジンのキーに R で構築した近傍を保存しないため）
+            coords, _ = layer_centroids(input_layer, metric_crs(input_layer), feedback)
+            from_idx, to_idx, _ = distance_band_edges(coords, d_minimum, d_maximum)
+            edges_path = scratch_path("nb_edges_", ".bin")
+            write_edges(edges_path, from_idx, to_idx)
+            r_nb_code = r_read_edges_code(edges_path, len(from_idx), len(coords))
+        else:
+            # 共通: 座標（重心）
+            r_nb_code = "coords <- st_coordinates(st_centroid(polygons))\n"
+            r_nb_code += f'nb <- dnearneigh(coords, d1 = {d_minimum}, d2 = {d_maximum})\n'
                 
-        r_statistic__index = self.parameterAsEnum(parameters, self.STATISTICS_TYPE, context)
-        r_statistic_type = ['Moran\'s I', 'Geary\'s C', 'Getis-Ord G', 'Getis-Ord G*'][r_statistic__index]
+        r_nb_code = r_cached_nb_code(nb_cache_path, r_nb_code)
+        profiler.mark("近傍の準備")
+
+        # 複数選択した統計量は同じ近傍からまとめて計算する
+        r_statistic_types = [GISA_STATISTICS[i] for i in sorted(self.parameterAsEnums(parameters, self.STATISTICS_TYPE, context))]
+        if not r_statistic_types:
+            raise QgsProcessingException("統計量を1つ以上選択してください")
         
 
-        # 入力レイヤを一時GPKGとして保存
-        input_path, is_temp = get_layer_path_or_temp(input_layer)
+        if self.parameterAsEnum(parameters, self.DATA_HANDOFF, context) == HANDOFF_BINARY:
+            # 解析するフィールドと重心座標だけをバイナリで渡す
+            _, r_read_code = write_handoff(
+                input_layer, field_names, metric_crs(input_layer), feedback
+            )
+            input_path = input_layer.source()
+        else:
+            # ファイルのレイヤは元のファイルを読み、フィルタ・選択は st_read(query=) で絞り込む
+            # （それ以外のレイヤは GPKG に書き出す）
+            r_read_code, input_path, _ = r_read_layer_code(input_layer)
+        profiler.mark("入力の書き出し")
         input_layer_path = input_path.replace("\\", "/")
        
 
 
         # Rコードを生成
         r_code = f"""
-         # パッケージ確認＆読み込み
-                # 必要なパッケージ
-        packages <- c("sf", "spdep", "dplyr", "classInt")
-
-        # ユーザーライブラリパスを取得（なければ作成）
-        user_lib <- Sys.getenv("R_LIBS_USER")
-        if (!dir.exists(user_lib)) {{
-        dir.create(user_lib, recursive = TRUE)
-        }}
-
-        # libPaths をユーザー用に変更
-        .libPaths(user_lib)
-
-        # パッケージの読み込みとインストール
-        for (pkg in packages) {{
-        if (!requireNamespace(pkg, quietly = TRUE)) {{
-            tryCatch({{
-            install.packages(pkg, repos = "https://cloud.r-project.org", lib = user_lib)
-            }}, error = function(e) {{
-            message(sprintf("パッケージ '%s' のインストールに失敗しました: %s", pkg, e$message))
-            }})
-        }}
-        library(pkg, character.only = TRUE)
-        }}
+        # パッケージ読み込み（インストール確認は事前に実施済み）
+        {r_library_code()}
 
 
         # 入力読み込み
-        polygons <- st_read("{input_path}")
-        id_field <- "{field_name}"
+        {r_read_code}
+        rss_progress(20, "入力データ読み込み完了")
 
         # 地理座標系なら EPSG:3857 に変換（単位：メートル）
         if (grepl("longlat", st_crs(polygons)$proj4string)) {{
@@ -191,59 +306,22 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
 
         # 近接構築
         {r_nb_code}
+        rss_progress(50, "近傍の構築完了")
 
-        # nb2listw に zero.policy=TRUE をつけた場合、listw$neighbours の長さは nb に合わせて出る
-        # その代わり、重み・隣接が 0 のポリゴンも明示的に扱う必要あり
-        # 行基準化ウェイト行列
-        # 距離減衰を使うかどうか（Pythonから渡されたフラグ）
-        statistic_type <- "{r_statistic_type}"  # Pythonから渡す文字列
-
-        # 距離減衰ありの場合
-        if ({r_use_decay}) {{
-            centroids <- st_centroid(polygons)
-            glist <- nbdists(nb, centroids)
-            glist <- lapply(glist, function(x) 1/x)
-            if (statistic_type == "Getis-Ord G*") {{
-                nb_self <- include.self(nb)
-                glist <- nbdists(nb_self, centroids)
-                glist <- lapply(glist, function(x) ifelse(x == 0, 1e-6, 1 / x))
-                listw <- nb2listw(nb_self, glist=glist, style="W", zero.policy=TRUE)
-            }} else {{
-                listw <- nb2listw(nb, glist=glist, style="W", zero.policy=TRUE)
-            }}
-        }} else {{
-            # 距離減衰なしの場合
-            if (statistic_type == "Getis-Ord G") {{
-                listw <- nb2listw(nb, style="B", zero.policy=TRUE)
-            }} else if (statistic_type == "Getis-Ord G*") {{
-                nb_self <- include.self(nb)
-                listw <- nb2listw(nb_self, style="B", zero.policy=TRUE)
-            }} else {{
-                listw <- nb2listw(nb, style="W", zero.policy=TRUE)
-            }}
-        }}
+        # 統計量ごとの重み（近傍は共通で、スタイル・自己近傍の有無だけを変える）
+        {r_gisa_listw_code(use_distance_decay)}
 
         result_txt <- c(
         "Input layer: {input_layer_path}\\n",
-        "Field: {field_name}",
+        "Field: {', '.join(field_names)}",
         "Neighbor type: Distance-based (min= {d_minimum}, max= {d_maximum})"
         )
 
 
-        if (statistic_type == "Moran's I") {{
-            test <- moran.test(polygons[[id_field]], listw)
-            test_result<- capture.output(test)
-        }} else if (statistic_type == "Geary's C") {{
-            test <- geary.test(polygons[[id_field]], listw)
-            test_result <- capture.output(test)
-        }} else if (statistic_type == "Getis-Ord G" || statistic_type == "Getis-Ord G*") {{
-            test <- globalG.test(polygons[[id_field]], listw)
-            test_result <- capture.output(test)
-        }} 
+        # 統計量・フィールドごとに検定
+        {r_gisa_tests_code(field_names, r_statistic_types, n_simulations, seed, results_path)}
 
         # 結果を出力
-        # ヘッダーに結果を追加
-        result_txt <- c(result_txt, "", test_result)
 
         cat(result_txt, sep="\n")
 
@@ -255,24 +333,34 @@ class GISADnearneighAlgorithm(QgsProcessingAlgorithm):
                 
                 
                 
-        # Rスクリプトを一時ファイルに保存
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".R") as f:
-            f.write(r_code.encode("utf-8"))
-            r_script_file = f.name
-
-        # Rスクリプトを実行
-        result = subprocess.run([rscript_path, r_script_file], capture_output=True, text=True)
-        if result.returncode != 0:
-            raise QgsProcessingException(f"R実行中にエラー:\n{result.stderr}")
-
-        feedback.pushInfo("=== GISA Statistics Result ===\n" + result.stdout)
+        # Rスクリプトを実行（出力は逐次ログに表示）
+        feedback.pushInfo("=== GISA Statistics Result ===")
+        run_r_script(self, rscript_path, r_code, feedback, profiler)
         feedback.pushInfo("=============================")
 
-        os.remove(r_script_file)
-        if is_temp and os.path.exists(input_path):
-            os.remove(input_path)
+        # 集計表を型付き出力・CSV・JSON にする
+        rows = read_gisa_table(results_path)
+        result_dict = gisa_outputs(rows, output_table, output_json, {
+            "algorithm": self.name(),
+            "input": input_layer_path,
+            "fields": field_names,
+            "statistics": r_statistic_types,
+            "neighbor_type": "Distance-based", "d_min": d_minimum, "d_max": d_maximum,
+            "distance_decay": use_distance_decay,
+            "n_simulations": n_simulations,
+            "seed": seed,
+        })
+        if output:
+            result_dict[self.OUTPUT] = output
+        profiler.mark("出力の書き込み")
+
+        # 一時ファイルを削除（エラーで中断した場合も scratch_scoped が削除する）
+        cleanup_scratch()
+        if nb_cache_path:
+            evict_weights_cache()
         
-        return {}
+        profiler.mark("一時ファイルの削除")
+        return profiler.finish(result_dict)
 
     def name(self):
         return 'gisadnearneigh'
@@ -17,38 +17,51 @@ __copyright__ = '(C) 2025 by nbayashi'
 # This will get replaced with a git SHA1 when you do a git archive
 
 __revision__ = '$Format:%H$'
-import subprocess
 import os
-import uuid
-
-import tempfile
 
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsSettings,
-                       QgsVectorLayer,
                        QgsProcessing,
                        QgsProcessingException,
-                       QgsFeatureSink,
-                       QgsWkbTypes,
                        QgsProcessingAlgorithm,
+                       QgsProcessingParameterDefinition,
                        QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterBoolean,
                        QgsProcessingParameterField,
                        QgsProcessingParameterNumber,
                        QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterEnum)
 
 from qgis.PyQt.QtGui import QIcon
-from ...utils.layer_tools import get_layer_path_or_temp
+from ...utils.layer_tools import input_view, r_read_layer_code, layer_centroids, metric_crs
+from ...utils.neighbours import distance_band_edges, write_edges, r_read_edges_code
+from ...utils.weights_cache import (weights_cache_path, is_cached, r_cached_nb_code,
+                                    evict_weights_cache)
+from ...utils.handoff import HANDOFF_MODES, HANDOFF_BINARY, write_handoff
+from ...utils.gisa_results import analysis_fields
+from ...utils.lisa_results import r_lisa_results_code, write_lisa_sink, lisa_update
+from ...utils.in_place import check_updatable, defer_update, apply_deferred_update
+from ...utils.r_session import run_r_script
+from ...utils.scratch import scratch_scoped, scratch_path, cleanup_scratch
+from ...utils.profiling import add_profile_parameter, stage_profiler
+from ...utils.r_packages import ensure_r_packages, r_library_code
 
 
 class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
 
     FIELD = 'FIELD'
+    FIELDS = 'FIELDS'
     INPUT = 'INPUT'
+    SELECTED_ONLY = 'SELECTED_ONLY'
+    UPDATE_INPUT = 'UPDATE_INPUT'
     STATISTICS_TYPE = 'STATISTICS_TYPE'
     D_MIN = 'D_MIN'
     D_MAX = 'D_MAX'
     OUTPUT_POLYGONS = 'OUTPUT_POLYGONS'
+    ENGINE = 'ENGINE'
+    DATA_HANDOFF = 'DATA_HANDOFF'
+    N_SIMULATIONS = 'N_SIMULATIONS'
+    SEED = 'SEED'
 
 
 
@@ -60,6 +73,22 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
                 [QgsProcessing.TypeVectorAnyGeometry]
             )
         )
+        # 選択地物のみ（ファイルのレイヤは R に FID の条件を渡し、絞り込んだコピーは作らない）
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.SELECTED_ONLY,
+                description='Selected features only',
+                defaultValue=False
+            )
+        )
+        # 入力レイヤに結果の列を追加して書き込む（出力ポリゴンは作らない）
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.UPDATE_INPUT,
+                description='Update input layer in place (add result fields)',
+                defaultValue=False
+            )
+        )
         # 属性の設定
         self.addParameter(
                     QgsProcessingParameterField(
@@ -70,6 +99,18 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
                         optional=False
                     )
                 )
+
+        # 追加フィールド（近傍は一度だけ作り、複数フィールドをまとめて計算）
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.FIELDS,
+                self.tr('Additional fields (batch)'),
+                parentLayerParameterName=self.INPUT,
+                type=QgsProcessingParameterField.Numeric,
+                allowMultiple=True,
+                optional=True
+            )
+        )
  
         self.addParameter(
             QgsProcessingParameterEnum(
@@ -95,6 +136,47 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # 近傍計算エンジン
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name=self.ENGINE,
+                description='Neighbor engine',
+                options=['R (spdep)', 'Native (NumPy/SciPy)'],
+                defaultValue=0
+            )
+        )
+
+        # 条件付き並べ替え（0 のときは解析的な p 値のみ）
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.N_SIMULATIONS,
+                description='Number of permutations (0 = analytical p-values only)',
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=99999
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.SEED,
+                description='Random seed for permutations',
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=1
+            )
+        )
+
+        # Rへのデータ受け渡し方法（詳細設定）
+        handoff_param = QgsProcessingParameterEnum(
+            name=self.DATA_HANDOFF,
+            description='Data handoff to R',
+            options=HANDOFF_MODES,
+            defaultValue=0
+        )
+        handoff_param.setFlags(handoff_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(handoff_param)
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 name=self.OUTPUT_POLYGONS,
@@ -103,17 +185,30 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
-       
+        # 段階ごとの計測結果（詳細設定）
+        add_profile_parameter(self)
+
+    @scratch_scoped
     def processAlgorithm(self, parameters, context, feedback):
+        profiler = stage_profiler(self, parameters, context, feedback)
         rscript_path = QgsSettings().value("RRunner/RscriptPath", "")
         # Check if the Rscript path is set
         if not os.path.exists(rscript_path):
             raise QgsProcessingException("Rscriptのパスが無効です")
+        ensure_r_packages(rscript_path)
+        profiler.mark("R パッケージの確認")
         
 
-        input_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        source_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        # 選択地物のみの場合は選択地物だけが見えるレイヤ（サブセットはそのまま適用される）
+        input_layer = input_view(source_layer, self.parameterAsBool(parameters, self.SELECTED_ONLY, context))
+        update_input = self.parameterAsBool(parameters, self.UPDATE_INPUT, context)
+        if update_input:
+            # R を実行する前に、入力レイヤを更新できるか確認する
+            check_updatable(source_layer)
         # フィールド名を取得
         field_name = self.parameterAsString(parameters, self.FIELD, context)
+        field_names = analysis_fields(field_name, self.parameterAsFields(parameters, self.FIELDS, context))
 
         
 
@@ -122,52 +217,60 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
 
 
         
-        # 共通: 座標（重心）
-        r_nb_code = "coords <- st_coordinates(st_centroid(polygons))\n"
-        r_nb_code += f'nb <- dnearneigh(coords, d1 = {d_minimum}, d2 = {d_maximum})\n'
+        engine = self.parameterAsEnum(parameters, self.ENGINE, context)
+        # 同じレイヤ・同じ設定で構築済みの近傍はキャッシュから読み込む
+        nb_cache_path = weights_cache_path(input_layer, "dnear", d1=d_minimum, d2=d_maximum, engine=engine)
+        nb_cached = is_cached(nb_cache_path)
+        if nb_cached:
+            feedback.pushInfo("キャッシュ済みの近傍を使用します")
+        edges_path = None
+        if engine == 1:
+            # ネイティブエンジン: QGIS側で距離帯の近傍を求め、近傍リストだけをRに渡す
+            # キャッシュがあっても、R が読み込む前にキャッシュが削除された場合に備えて辺を書き出しておく
+            # （ネイティブエンジンのキーに R で構築した近傍を保存しないため）
+            coords, _ = layer_centroids(input_layer, metric_crs(input_layer), feedback)
+            from_idx, to_idx, _ = distance_band_edges(coords, d_minimum, d_maximum)
+            edges_path = scratch_path("nb_edges_", ".bin")
+            write_edges(edges_path, from_idx, to_idx)
+            r_nb_code = r_read_edges_code(edges_path, len(from_idx), len(coords))
+        else:
+            # 共通: 座標（重心）
+            r_nb_code = "coords <- st_coordinates(st_centroid(polygons))\n"
+            r_nb_code += f'nb <- dnearneigh(coords, d1 = {d_minimum}, d2 = {d_maximum})\n'
                 
+        r_nb_code = r_cached_nb_code(nb_cache_path, r_nb_code)
+        profiler.mark("近傍の準備")
+
         r_statistic__index = self.parameterAsEnum(parameters, self.STATISTICS_TYPE, context)
         r_statistic_type = ['Local Moran\'s I', 'Local Getis-Ord G', 'Local Getis-Ord G*'][r_statistic__index]
+        n_simulations = self.parameterAsInt(parameters, self.N_SIMULATIONS, context)
+        seed = self.parameterAsInt(parameters, self.SEED, context)
         
 
-        # 入力レイヤを一時GPKGとして保存
-        input_path, is_temp = get_layer_path_or_temp(input_layer)
-       
-        # 出力先（Rが書き出す）
-        output_poly_path = os.path.join(tempfile.gettempdir(), f"output_neighbors_{uuid.uuid4().hex}.gpkg")
+        if self.parameterAsEnum(parameters, self.DATA_HANDOFF, context) == HANDOFF_BINARY:
+            # 解析するフィールドと重心座標だけをバイナリで渡す
+            _, r_read_code = write_handoff(
+                input_layer, field_names, metric_crs(input_layer), feedback
+            )
+        else:
+            # ファイルのレイヤは元のファイルを読み、フィルタ・選択は st_read(query=) で絞り込む
+            # （それ以外のレイヤは GPKG に書き出す）
+            r_read_code, _, _ = r_read_layer_code(input_layer)
+        profiler.mark("入力の書き出し")
+
+        # 出力先（Rは結果の属性だけを書き出す）
+        results_path = scratch_path("lisa_results_", ".tsv")
         
 
         # Rコードを生成
         r_code = f"""
-         # パッケージ確認＆読み込み
-        # 必要なパッケージ
-        packages <- c("sf", "spdep", "dplyr", "classInt")
-
-        # ユーザーライブラリパスを取得（なければ作成）
-        user_lib <- Sys.getenv("R_LIBS_USER")
-        if (!dir.exists(user_lib)) {{
-        dir.create(user_lib, recursive = TRUE)
-        }}
-
-        # libPaths をユーザー用に変更
-        .libPaths(user_lib)
-
-        # パッケージの読み込みとインストール
-        for (pkg in packages) {{
-        if (!requireNamespace(pkg, quietly = TRUE)) {{
-            tryCatch({{
-            install.packages(pkg, repos = "https://cloud.r-project.org", lib = user_lib)
-            }}, error = function(e) {{
-            message(sprintf("パッケージ '%s' のインストールに失敗しました: %s", pkg, e$message))
-            }})
-        }}
-        library(pkg, character.only = TRUE)
-        }}
+        # パッケージ読み込み（インストール確認は事前に実施済み）
+        {r_library_code()}
 
 
         # 入力読み込み
-        polygons <- st_read("{input_path}")
-        id_field <- "{field_name}"
+        {r_read_code}
+        rss_progress(20, "入力データ読み込み完了")
 
         # 地理座標系なら EPSG:3857 に変換（単位：メートル）
         if (grepl("longlat", st_crs(polygons)$proj4string)) {{
@@ -177,6 +280,7 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
 
         # 近接構築
         {r_nb_code}
+        rss_progress(50, "近傍の構築完了")
 
         # 隣接行列の作成
         statistic_type <- "{r_statistic_type}"  # Pythonから渡す文字列
@@ -192,103 +296,47 @@ class LISADnearneighAlgorithm(QgsProcessingAlgorithm):
         
 
 
-        if (statistic_type == "Local Moran's I") {{
-            test <- localmoran(polygons[[id_field]], listw, zero.policy = TRUE)
-            test_result <- capture.output(test)
-            quadr <- attr(test, "quadr")
-
-            # 結果を属性に追加
-            attrs <- st_drop_geometry(polygons)
-            attrs$Ii <- test[, "Ii"]
-            attrs$E <- test[, "E.Ii"]
-            attrs$Var <- test[, "Var.Ii"]
-            attrs$Z <- test[, "Z.Ii"]
-            attrs$Pr_z <- test[, "Pr(z != E(Ii))"]
-            attrs$clus_mean <- quadr[,"mean"]
-            attrs$clus_median <- quadr[,"median"]
-            attrs$clus_pysal <- quadr[,"pysal"]
-
-            # geometryと再結合
-            polygons <- st_sf(attrs, geometry = st_geometry(polygons))
-        }} else if (statistic_type == "Local Getis-Ord G") {{
-            test <- localG(polygons[[id_field]], listw, zero.policy = TRUE)
-            #test_result <- capture.output(test)
-            internals <- attr(test, "internals")
-            # 結果を属性に追加
-            attrs <- st_drop_geometry(polygons)
-            attrs$Gi <-  as.numeric(test)
-            attrs$Pr_z <- internals[, "Pr(z != E(Gi))"]
-
-            # geometryと再結合
-            polygons <- st_sf(attrs, geometry = st_geometry(polygons))
-        }} else if (statistic_type == "Local Getis-Ord G*") {{
-            test <- localG(polygons[[id_field]], listw, zero.policy = TRUE)
-            #test_result <- capture.output(test)
-            internals <- attr(test, "internals")
-            cluster <- attr(test,"cluster")
-            # 結果を属性に追加
-            attrs <- st_drop_geometry(polygons)
-            attrs$Gi <-  as.numeric(test)
-            attrs$Pr_z <- internals[, "Pr(z != E(G*i))"]
-            attrs$cluster <- cluster
-
-            # geometryと再結合
-            polygons <- st_sf(attrs, geometry = st_geometry(polygons))
-
-        }} 
-
-        # 必ずsfオブジェクトに戻す
-        polygons <- st_as_sf(polygons)
-        # 結果を出力
-        st_write(polygons, "{output_poly_path}", delete_dsn = TRUE)
+        {r_lisa_results_code(results_path, field_names, n_simulations, seed)}
 
         
         """
                 
                 
                 
-        # Rスクリプトを一時ファイルに保存
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".R") as f:
-            f.write(r_code.encode("utf-8"))
-            r_script_file = f.name
-
-        # Rスクリプトを実行
-        result = subprocess.run([rscript_path, r_script_file], capture_output=True, text=True)
-        if result.returncode != 0 or 'Error' in result.stderr:
-            raise QgsProcessingException(f"R実行中にエラー:\n{result.stderr}\n{result.stdout}")
-
-        feedback.pushInfo("=== LISA Statistics Result ===\n" + result.stdout)
+        # Rスクリプトを実行（出力は逐次ログに表示）
+        feedback.pushInfo("=== LISA Statistics Result ===")
+        run_r_script(self, rscript_path, r_code, feedback, profiler)
         feedback.pushInfo("=============================")
 
-        # Rが書き出したポリゴンを読み込み
-        poly_layer = QgsVectorLayer(output_poly_path, "LISA_Polygons", "ogr")
-        if poly_layer.isValid():
-            sink_poly, poly_id = self.parameterAsSink(
-                parameters,
-                self.OUTPUT_POLYGONS,
-                context,
-                poly_layer.fields(),
-                QgsWkbTypes.MultiPolygon,  
-                poly_layer.crs()
-            )
-            if sink_poly:
-                for feat in poly_layer.getFeatures():
-                    sink_poly.addFeature(feat, QgsFeatureSink.FastInsert)
+        if update_input:
+            # 結果の列は postProcessAlgorithm（メインスレッド）で入力レイヤに書き込む
+            defer_update(self, lisa_update(source_layer, input_layer, results_path))
+            poly_id = None
         else:
-            feedback.reportError("出力ポリゴンレイヤの読み込みに失敗しました。")
+            # 結果の属性を入力レイヤのジオメトリに結合して出力
+            poly_id = write_lisa_sink(
+                self, parameters, context, feedback, input_layer, self.OUTPUT_POLYGONS, results_path
+            )
+        profiler.mark("出力の書き込み")
 
 
-        # 一時ファイルを削除
-        os.remove(r_script_file)
-        if is_temp and os.path.exists(input_path):
-            os.remove(input_path)
+        # 一時ファイルを削除（エラーで中断した場合も scratch_scoped が削除する）
+        cleanup_scratch()
+        if nb_cache_path:
+            evict_weights_cache()
 
 
         result_dict = {}
-        if 'poly_id' in locals():
+        if poly_id is not None:
             result_dict[self.OUTPUT_POLYGONS] = poly_id
 
-        return result_dict
+        profiler.mark("一時ファイルの削除")
+        return profiler.finish(result_dict)
+
+    def postProcessAlgorithm(self, context, feedback):
+        # 入力レイヤの更新（プロジェクトのレイヤはメインスレッドで変更する）
+        apply_deferred_update(self, feedback)
+        return {}
 
     def name(self):
         return 'lisadnearneigh'
@@ -17,12 +17,7 @@ __copyright__ = '(C) 2025 by nbayashi'
 # This will get replaced with a git SHA1 when you do a git archive
 
 __revision__ = '$Format:%H$'
-import subprocess
 import os
-import uuid
-
-
-import tempfile
 
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsSettings,
@@ -30,30 +25,45 @@ from qgis.core import (QgsSettings,
                        QgsProcessingException,
                        QgsVectorLayer,
                        QgsVectorFileWriter,
-                       QgsFeatureSink,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterField,
                        QgsProcessingParameterBoolean,
                        QgsProcessingParameterNumber,
+                       QgsProcessingParameterEnum,
                        QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterFileDestination)
 
 from qgis.PyQt.QtGui import QIcon
-from ..utils.layer_tools import get_layer_path_or_temp
+from ..utils.layer_tools import input_view, r_read_layer_code, layer_centroids, metric_crs
+from ..utils.neighbours import (distance_band_edges, r_edge_lines_code,
+                                r_neighbour_columns_code, read_neighbour_columns)
+from ..utils.native_weights import write_native_weight_outputs
+from ..utils.weights_io import (WEIGHTS_FORMATS, WEIGHTS_FILE_FILTER,
+                                r_weights_export_code)
+from ..utils.in_place import (AttributeUpdate, add_neighbour_columns, check_updatable,
+                              defer_update, apply_deferred_update)
+from ..utils.r_session import run_r_script
+from ..utils.scratch import scratch_scoped, scratch_path, cleanup_scratch
+from ..utils.sink_writer import copy_to_sink
+from ..utils.profiling import add_profile_parameter, stage_profiler
+from ..utils.r_packages import ensure_r_packages, r_library_code
 
 
 class DnearneighAlgorithm(QgsProcessingAlgorithm):
 
     FIELD = 'FIELD'
     INPUT = 'INPUT'
-    REMOVE_DUPLICATE_LINES = 'REMOVE_DUPLICATE_LINES'
+    SELECTED_ONLY = 'SELECTED_ONLY'
+    UPDATE_INPUT = 'UPDATE_INPUT'
     D_MIN = 'D_MIN'
     D_MAX = 'D_MAX'
     USE_DISTANCE_DECAY = 'USE_DISTANCE_DECAY'
     OUTPUT_NODE = 'OUTPUT_NODE'
     OUTPUT_POLYGONS = 'OUTPUT_POLYGONS'
     OUTPUT_WEIGHTS_CSV = 'OUTPUT_WEIGHTS_CSV'
+    OUTPUT_WEIGHTS_FORMAT = 'OUTPUT_WEIGHTS_FORMAT'
+    ENGINE = 'ENGINE'
 
 
 
@@ -65,6 +75,22 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
                 [QgsProcessing.TypeVectorAnyGeometry]
             )
         )
+        # 選択地物のみ（ファイルのレイヤは R に FID の条件を渡し、絞り込んだコピーは作らない）
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.SELECTED_ONLY,
+                description='Selected features only',
+                defaultValue=False
+            )
+        )
+        # 入力レイヤに neighbor_ids / neighbor_count の列を追加して書き込む（出力ポリゴンは作らない）
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.UPDATE_INPUT,
+                description='Update input layer in place (add neighbour fields)',
+                defaultValue=False
+            )
+        )
         # 属性の設定
         self.addParameter(
                     QgsProcessingParameterField(
@@ -93,12 +119,13 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
         )
 
 
-        # 重複行の削除
+        # 近傍計算エンジン
         self.addParameter(
-            QgsProcessingParameterBoolean(
-                name=self.REMOVE_DUPLICATE_LINES,
-                description='Remove duplicated lines (A→B and B→A)',
-                defaultValue=False
+            QgsProcessingParameterEnum(
+                name=self.ENGINE,
+                description='Neighbor engine',
+                options=['R (spdep)', 'Native (NumPy/SciPy)'],
+                defaultValue=0
             )
         )
 
@@ -128,29 +155,56 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
                 createByDefault=True 
             )
         )
+        # ウェイト行列の書き出し形式（密な行列以外は辺の数に比例したサイズ）
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name=self.OUTPUT_WEIGHTS_FORMAT,
+                description='Weights output format',
+                options=WEIGHTS_FORMATS,
+                defaultValue=0
+            )
+        )
         # CSV path
         self.addParameter(
             QgsProcessingParameterFileDestination(
                 name='OUTPUT_WEIGHTS_CSV',
-                description='Row-standardized weights matrix (CSV)',
-                fileFilter='CSV files (*.csv)',
+                description='Row-standardized weights matrix',
+                fileFilter=WEIGHTS_FILE_FILTER,
                 optional=True,  # ← スキップ可
                 createByDefault=False # ← デフォルトで作成しない
             )
         )
 
+        # 段階ごとの計測結果（詳細設定）
+        add_profile_parameter(self)
+
+    @scratch_scoped
     def processAlgorithm(self, parameters, context, feedback):
+        # ネイティブエンジンはRを起動せずに処理する
+        if self.parameterAsEnum(parameters, self.ENGINE, context) == 1:
+            return self.processNative(parameters, context, feedback)
+
+        profiler = stage_profiler(self, parameters, context, feedback)
         rscript_path = QgsSettings().value("RRunner/RscriptPath", "")
         # Check if the Rscript path is set
         if not os.path.exists(rscript_path):
             raise QgsProcessingException("Rscriptのパスが無効です")
+        ensure_r_packages(rscript_path)
+        profiler.mark("R パッケージの確認")
         
 
-        input_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        source_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        # 選択地物のみの場合は選択地物だけが見えるレイヤ（サブセットはそのまま適用される）
+        input_layer = input_view(source_layer, self.parameterAsBool(parameters, self.SELECTED_ONLY, context))
+        update_input = self.parameterAsBool(parameters, self.UPDATE_INPUT, context)
+        if update_input:
+            # 近傍を求める前に、入力レイヤを更新できるか確認する
+            check_updatable(source_layer)
         # フィールド名を取得
         field_name = self.parameterAsString(parameters, self.FIELD, context)
 
         output_weights_path = self.parameterAsFile(parameters, 'OUTPUT_WEIGHTS_CSV', context)
+        weights_format = self.parameterAsEnum(parameters, self.OUTPUT_WEIGHTS_FORMAT, context)
 
         
 
@@ -158,8 +212,6 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
         d_maximum = self.parameterAsDouble(parameters, self.D_MAX, context)
 
 
-        remove_duplicates = self.parameterAsBool(parameters, self.REMOVE_DUPLICATE_LINES, context)
-        r_remove_flag = "TRUE" if remove_duplicates else "FALSE"
 
         use_distance_decay = self.parameterAsBool(parameters, 'USE_DISTANCE_DECAY', context)
         r_use_decay = "TRUE" if use_distance_decay else "FALSE"
@@ -170,41 +222,29 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
         
 
 
-        # 入力レイヤのパスを取得
-        input_path, is_temp = get_layer_path_or_temp(input_layer)
+        # ファイルのレイヤは元のファイルを読み、フィルタ・選択は st_read(query=) で絞り込む
+        # （それ以外のレイヤは GPKG に書き出す）
+        r_read_code, _, _ = r_read_layer_code(input_layer)
+        profiler.mark("入力の書き出し")
 
         # 出力先（Rが書き出す）
-        output_path = os.path.join(tempfile.gettempdir(), f"output_neighbors_{uuid.uuid4().hex}.gpkg")
-        output_poly_path = os.path.join(tempfile.gettempdir(), f"nb_polygons_{uuid.uuid4().hex}.gpkg")
+        output_path = scratch_path("output_neighbors_", ".gpkg")
+        if update_input:
+            # 入力レイヤを更新する場合は近接情報の列だけを受け取る
+            output_poly_path = scratch_path("nb_columns_", ".tsv")
+            r_poly_output_code = r_neighbour_columns_code(output_poly_path)
+        else:
+            output_poly_path = scratch_path("nb_polygons_", ".gpkg")
+            r_poly_output_code = f'st_write(polygons, "{output_poly_path}", delete_dsn = TRUE)'
 
         # Rコードを生成
         r_code = f"""
-         # パッケージ確認＆読み込み# 必要なパッケージ
-        packages <- c("sf", "spdep", "dplyr", "classInt")
-
-        # ユーザーライブラリパスを取得（なければ作成）
-        user_lib <- Sys.getenv("R_LIBS_USER")
-        if (!dir.exists(user_lib)) {{
-        dir.create(user_lib, recursive = TRUE)
-        }}
-
-        # libPaths をユーザー用に変更
-        .libPaths(user_lib)
-
-        # パッケージの読み込みとインストール
-        for (pkg in packages) {{
-        if (!requireNamespace(pkg, quietly = TRUE)) {{
-            tryCatch({{
-            install.packages(pkg, repos = "https://cloud.r-project.org", lib = user_lib)
-            }}, error = function(e) {{
-            message(sprintf("パッケージ '%s' のインストールに失敗しました: %s", pkg, e$message))
-            }})
-        }}
-        library(pkg, character.only = TRUE)
-        }}
+        # パッケージ読み込み（インストール確認は事前に実施済み）
+        {r_library_code()}
 
         # 入力読み込み
-        polygons <- st_read("{input_path}")
+        {r_read_code}
+        rss_progress(20, "入力データ読み込み完了")
         id_field <- "{field_name}"
 
         # 地理座標系なら EPSG:3857 に変換（単位：メートル）
@@ -215,56 +255,25 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
 
         # 近接構築
         {r_nb_code}
+        rss_progress(50, "近傍の構築完了")
 
         # ID & centroid
         id_values <- polygons[[id_field]]
         centroids <- st_centroid(polygons)
 
-        # edge list
-        edge_list <- do.call(rbind, lapply(seq_along(nb), function(i) {{
-            data.frame(from = i, to = nb[[i]])
-        }})) %>% dplyr::filter(from < to)
-
-
-        # 重複行削除
-        if ({r_remove_flag}) {{
-        edge_list <- edge_list %>%
-            mutate(pair = paste(pmin(from, to), pmax(from, to), sep = "_")) %>%
-            distinct(pair, .keep_all = TRUE)
-            }}
-
-        edge_list$from_id <- id_values[edge_list$from]
-        edge_list$to_id   <- id_values[edge_list$to]
-
-        # ライン生成 + 距離付加
-        lines <- lapply(1:nrow(edge_list), function(i) {{
-            from_geom <- centroids[edge_list$from[i], ]
-            to_geom   <- centroids[edge_list$to[i], ]
-            line <- st_linestring(rbind(st_coordinates(from_geom), st_coordinates(to_geom)))
-            dist <- st_distance(from_geom, to_geom, by_element = TRUE)
-            list(geom = line, dist = as.numeric(dist))
-        }})
-
-        # ラインレイヤ生成
-        line_sf <- st_sf(
-            from = edge_list$from_id,
-            to = edge_list$to_id,
-            distance = sapply(lines, function(x) x$dist),
-            geometry = st_sfc(lapply(lines, function(x) x$geom)),
-            crs = st_crs(polygons)
-        )
-        st_write(line_sf, "{output_path}", delete_dsn = TRUE)
+        {r_edge_lines_code(output_path, "forward")}
 
 
         # ポリゴンに近接行列を付与
         neighbor_ids <- sapply(nb, function(neigh) paste(id_values[neigh], collapse = ","))
-        neighbor_count <- sapply(nb, length)
+        neighbor_count <- card(nb)
 
         polygons$neighbor_ids <- neighbor_ids
         polygons$neighbor_count <- neighbor_count
 
-        # ポリゴンとして保存
-        st_write(polygons, "{output_poly_path}", delete_dsn = TRUE)
+        # ポリゴンとして保存（入力レイヤを更新する場合は列だけ）
+        {r_poly_output_code}
+        rss_stage("ポリゴンの書き出し")
 
 
         # nb2listw に zero.policy=TRUE をつけた場合、listw$neighbours の長さは nb に合わせて出る
@@ -280,48 +289,17 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
         }}
         
 
-        # IDリスト（行と列の順番を固定）
-        all_ids <- id_values
-
-        # 初期化：全ゼロ行列
-        weight_mat <- matrix(0, nrow = length(all_ids), ncol = length(all_ids))
-        rownames(weight_mat) <- all_ids
-        colnames(weight_mat) <- all_ids
-
-        # ウェイト代入
-        for (i in seq_along(listw$neighbours)) {{
-        from_id <- id_values[i]
-        neigh_ids <- listw$neighbours[[i]]
-        weights <- listw$weights[[i]]
-        
-        if (length(neigh_ids) > 0) {{
-            to_ids <- id_values[neigh_ids]
-            weight_mat[as.character(from_id), as.character(to_ids)] <- weights
-        }}
-        }}
         cat("---- nb summary ----\n")
         print(summary(nb))
         cat("---- end of summary ----\n")
 
-        # 書き出し（CSV形式）
-        if ("{output_weights_path}" != "") {{
-            write.csv(weight_mat, file = "{output_weights_path}", row.names = TRUE)
-        }}
+        {r_weights_export_code(weights_format, output_weights_path, input_layer.name(), field_name)}
         
         """
                 
                 
-        # Rスクリプトを一時ファイルに保存
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".R") as f:
-            f.write(r_code.encode("utf-8"))
-            r_script_file = f.name
-
-        # Rスクリプトを実行
-        result = subprocess.run([rscript_path, r_script_file], capture_output=True, text=True)
-        if result.returncode != 0:
-            raise QgsProcessingException(f"R実行中にエラー:\n{result.stderr}")
-
-        feedback.pushInfo("Rの出力:\n" + result.stdout)
+        # Rスクリプトを実行（出力は逐次ログに表示）
+        run_r_script(self, rscript_path, r_code, feedback, profiler)
 
         # Rが出力したラインレイヤをQGISで読み込む
         output_layer = QgsVectorLayer(output_path, "NeighborLines", "ogr")
@@ -338,38 +316,46 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
             )
 
             if sink:
-                for feat in output_layer.getFeatures():
-                    sink.addFeature(feat, QgsFeatureSink.FastInsert)
+                feedback.setProgressText("ラインの書き込み")
+                copy_to_sink(output_layer, sink, feedback, progress=(80, 90))
             else:
                 feedback.pushInfo("ラインレイヤの出力はスキップされました。")
 
             
         
-        # ポリゴンレイヤをQGISで読み込む
-        poly_layer = QgsVectorLayer(output_poly_path, "PolygonNeighbors", "ogr")
-        if poly_layer.isValid():
-            sink_poly, poly_id = self.parameterAsSink(
-                parameters,
-                self.OUTPUT_POLYGONS,
-                context,
-                poly_layer.fields(),
-                poly_layer.wkbType(),
-                poly_layer.crs()
-            )
+        if update_input:
+            # 近接情報の列は postProcessAlgorithm（メインスレッド）で入力レイヤに書き込む
+            poly_update = AttributeUpdate(source_layer, input_layer)
+            add_neighbour_columns(poly_update, *read_neighbour_columns(output_poly_path))
+            defer_update(self, poly_update)
+            poly_layer = None
+        else:
+            # ポリゴンレイヤをQGISで読み込む
+            poly_layer = QgsVectorLayer(output_poly_path, "PolygonNeighbors", "ogr")
+            if poly_layer.isValid():
+                sink_poly, poly_id = self.parameterAsSink(
+                    parameters,
+                    self.OUTPUT_POLYGONS,
+                    context,
+                    poly_layer.fields(),
+                    poly_layer.wkbType(),
+                    poly_layer.crs()
+                )
 
-            if sink_poly:
-                for feat in poly_layer.getFeatures():
-                    sink_poly.addFeature(feat, QgsFeatureSink.FastInsert)
+                if sink_poly:
+                    feedback.setProgressText("ポリゴンの書き込み")
+                    copy_to_sink(poly_layer, sink_poly, feedback, progress=(90, 100))
+                else:
+                    feedback.pushInfo("出力ポリゴンはスキップされました。")
             else:
-                feedback.pushInfo("出力ポリゴンはスキップされました。")
-        else:
-            feedback.reportError("出力ポリゴンレイヤの読み込みに失敗しました。")
-        feedback.pushInfo(result.stdout)
+                feedback.reportError("出力ポリゴンレイヤの読み込みに失敗しました。")
 
 
-        os.remove(r_script_file)
-        if is_temp and os.path.exists(input_path):
-            os.remove(input_path)
+        profiler.mark("出力の書き込み")
+        # 一時ファイルを削除（GPKG を閉じてから。エラーで中断した場合も scratch_scoped が削除する）
+        output_layer = poly_layer = None
+        cleanup_scratch()
+        profiler.mark("一時ファイルの削除")
 
 
         result_dict = {}
@@ -377,7 +363,54 @@ class DnearneighAlgorithm(QgsProcessingAlgorithm):
             result_dict[self.OUTPUT_NODE] = dest_id
         if 'poly_id' in locals():
             result_dict[self.OUTPUT_POLYGONS] = poly_id
-        return result_dict
+        return profiler.finish(result_dict)
+
+    def processNative(self, parameters, context, feedback):
+        profiler = stage_profiler(self, parameters, context, feedback)
+        source_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        # 選択地物のみの場合は選択地物だけが見えるレイヤ（サブセットはそのまま適用される）
+        input_layer = input_view(source_layer, self.parameterAsBool(parameters, self.SELECTED_ONLY, context))
+        update_input = self.parameterAsBool(parameters, self.UPDATE_INPUT, context)
+        poly_update = None
+        if update_input:
+            # 近傍を求める前に、入力レイヤを更新できるか確認する
+            check_updatable(source_layer)
+            poly_update = AttributeUpdate(source_layer, input_layer)
+        field_name = self.parameterAsString(parameters, self.FIELD, context)
+        output_weights_path = self.parameterAsFile(parameters, self.OUTPUT_WEIGHTS_CSV, context)
+        weights_format = self.parameterAsEnum(parameters, self.OUTPUT_WEIGHTS_FORMAT, context)
+        d_minimum = self.parameterAsDouble(parameters, self.D_MIN, context)
+        d_maximum = self.parameterAsDouble(parameters, self.D_MAX, context)
+        use_distance_decay = self.parameterAsBool(parameters, self.USE_DISTANCE_DECAY, context)
+
+        # R版と同じく地理座標系は EPSG:3857 に変換してから重心を求める
+        dest_crs = metric_crs(input_layer)
+        coords, _ = layer_centroids(input_layer, dest_crs, feedback)
+        from_idx, to_idx, distances = distance_band_edges(coords, d_minimum, d_maximum)
+
+        profiler.mark("近傍の構築（ネイティブ）")
+
+        result_dict = write_native_weight_outputs(
+            self, parameters, context, feedback, input_layer, field_name,
+            coords, from_idx, to_idx,
+            dest_crs=dest_crs,
+            line_filter="forward",
+            use_distance_decay=use_distance_decay,
+            weights_path=output_weights_path,
+            weights_format=weights_format,
+            distances=distances,
+            profiler=profiler,
+            poly_update=poly_update
+        )
+        if poly_update is not None:
+            # 近接情報の列は postProcessAlgorithm（メインスレッド）で入力レイヤに書き込む
+            defer_update(self, poly_update)
+        return profiler.finish(result_dict)
+
+    def postProcessAlgorithm(self, context, feedback):
+        # 入力レイヤの更新（プロジェクトのレイヤはメインスレッドで変更する）
+        apply_deferred_update(self, feedback)
+        return {}
 
     def name(self):
         return 'dnearneigh'
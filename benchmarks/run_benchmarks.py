@@ -0,0 +1,408 @@
+"""
+合成データでプロバイダの全アルゴリズムを、全エンジン（近傍計算エンジン × R への受け渡し方法）で
+実行し、段階ごとの時間・メモリ（profiling.StageProfiler の記録）を集める。
+
+QGIS の Python で実行する（例: OSGeo4W Shell の python、Linux の /usr/bin/python3）。
+
+    python benchmarks/run_benchmarks.py run --rscript /usr/bin/Rscript --sizes 1000,10000 --out results/main.json
+    python benchmarks/run_benchmarks.py compare results/main.json results/branch.json
+
+各ケースは別プロセスで実行する（前のケースのメモリ・常駐Rセッション・キャッシュが次に影響しない）。
+設定は専用の QGIS プロファイルに書くので、普段の QGIS の設定は変わらない。
+近傍のキャッシュは無効にして、毎回近傍を作る時間を計る。
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+# 子プロセスが結果を返す行
+RESULT_MARKER = "##RESULT##"
+# 結果ファイルの形式（項目を変えたら上げる）
+RESULT_VERSION = 1
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# アルゴリズムごとのデータセットとパラメータ（距離は合成データの平均間隔 SPACING の倍数）
+ALGORITHMS = {
+    'adjacencymatrix': ('polygons', {'FIELD': 'value', 'NEIGHBOR_TYPE': 0}),
+    'knearneigh': ('all', {'FIELD': 'value', 'K': 4}),
+    'dnearneigh': ('all', {'FIELD': 'value', 'D_MIN': 0, 'D_MAX': 2.5}),
+    'gisaadjacencymatrix': ('polygons', {'FIELD': 'value', 'STATISTICS_TYPE': [0], 'NEIGHBOR_TYPE': 0}),
+    'gisaknearneigh': ('all', {'FIELD': 'value', 'STATISTICS_TYPE': [0], 'K': 4}),
+    'gisadnearneigh': ('all', {'FIELD': 'value', 'STATISTICS_TYPE': [0], 'D_MIN': 0, 'D_MAX': 2.5}),
+    'gisacorrelogram': ('all', {'FIELD': 'value', 'NEIGHBOR_TYPE': 0, 'DISTANCE_BANDS': [1.5, 2.5, 5, 10]}),
+    'lisaadjacencymatrix': ('polygons', {'FIELD': 'value', 'STATISTICS_TYPE': 0, 'NEIGHBOR_TYPE': 0}),
+    'lisaknearneigh': ('all', {'FIELD': 'value', 'STATISTICS_TYPE': 0, 'K': 4}),
+    'lisadnearneigh': ('all', {'FIELD': 'value', 'STATISTICS_TYPE': 0, 'D_MIN': 0, 'D_MAX': 2.5}),
+}
+# 平均間隔の倍数で指定するパラメータ
+DISTANCE_PARAMETERS = ['D_MIN', 'D_MAX', 'DISTANCE_BANDS']
+# エンジンとして総当たりする選択肢
+ENGINE_PARAMETERS = ['ENGINE', 'DATA_HANDOFF']
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def start_qgis(profile_dir, rscript_path=""):
+    """ベンチマーク専用のプロファイルで QGIS を初期化する"""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from qgis.core import QgsApplication, QgsSettings
+
+    os.makedirs(profile_dir, exist_ok=True)
+    app = QgsApplication([], False, profile_dir)
+    app.initQgis()
+    settings = QgsSettings()
+    if rscript_path:
+        settings.setValue("RRunner/RscriptPath", rscript_path)
+    settings.setValue("RRunner/WeightsCacheEnabled", False)
+    return app
+
+
+def load_provider():
+    """リポジトリのプラグインをパッケージとして読み込み、プロバイダを返す"""
+    if "rss_plugin" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "rss_plugin", os.path.join(PLUGIN_DIR, "__init__.py"),
+            submodule_search_locations=[PLUGIN_DIR]
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["rss_plugin"] = module
+        spec.loader.exec_module(module)
+    from rss_plugin.adjacency_matrix_provider.adjacency_matrix_provider import AdjacencyMatrixProvider
+    return AdjacencyMatrixProvider()
+
+
+def engine_variants(provider, algorithm_name):
+    """
+    アルゴリズムが持つエンジンの選択肢の組み合わせ。
+    戻り値は (ラベル, パラメータ) のリスト（エンジンの選択肢がなければ1つ）。
+    """
+    from qgis.core import QgsApplication
+
+    algorithm = QgsApplication.processingRegistry().createAlgorithmById(f"{provider.id()}:{algorithm_name}")
+    choices = []
+    for name in ENGINE_PARAMETERS:
+        definition = algorithm.parameterDefinition(name)
+        if definition is not None:
+            choices.append([(name, i, option.split()[0].lower()) for i, option in enumerate(definition.options())])
+    variants = []
+    for combination in itertools.product(*choices):
+        label = "/".join(short for _, _, short in combination) or "default"
+        variants.append((label, {name: i for name, i, _ in combination}))
+    return variants
+
+
+def build_cases(args, provider):
+    from synthetic import DATASETS, POLYGON_DATASETS, SPACING
+
+    cases = []
+    for algorithm_name in args.algorithms:
+        datasets, base_params = ALGORITHMS[algorithm_name]
+        usable = POLYGON_DATASETS if datasets == 'polygons' else DATASETS
+        params = dict(base_params)
+        for name in DISTANCE_PARAMETERS:
+            if name in params:
+                value = params[name]
+                params[name] = (", ".join(f"{v * SPACING:g}" for v in value)
+                                if isinstance(value, list) else value * SPACING)
+        for (label, engine_params), kind, n in itertools.product(
+                engine_variants(provider, algorithm_name), args.datasets, args.sizes):
+            if kind not in usable:
+                continue
+            if args.engines and label not in args.engines:
+                continue
+            cases.append({
+                "key": f"{algorithm_name}|{kind}|{n}|{label}",
+                "algorithm": algorithm_name,
+                "dataset": kind,
+                "n": n,
+                "engine": label,
+                "params": dict(params, **engine_params),
+            })
+    return cases
+
+
+def run_case(case, profile_dir, rscript_path, work_dir):
+    """1ケースを現在のプロセスで実行する（子プロセスから呼ばれる）"""
+    app = start_qgis(profile_dir, rscript_path)
+    from qgis.core import (QgsApplication,
+                           QgsProcessingContext,
+                           QgsProcessingFeedback,
+                           QgsProcessingParameterFeatureSink)
+
+    provider = load_provider()
+    QgsApplication.processingRegistry().addProvider(provider)
+    from rss_plugin.utils.profiling import OUTPUT_PROFILE, memory_mb
+
+    class Feedback(QgsProcessingFeedback):
+        def __init__(self):
+            super().__init__()
+            self.errors = []
+
+        def reportError(self, error, fatalError=False):
+            self.errors.append(error)
+
+    algorithm = QgsApplication.processingRegistry().createAlgorithmById(f"{provider.id()}:{case['algorithm']}")
+    params = dict(case["params"], INPUT=case["input"])
+    profile_path = os.path.join(work_dir, "profile.json")
+    params[OUTPUT_PROFILE] = profile_path
+    # 既定で作られる出力だけを作る（普段の実行と同じ書き込み量にする）
+    for definition in algorithm.destinationParameterDefinitions():
+        name = definition.name()
+        if name == OUTPUT_PROFILE or not definition.createByDefault():
+            continue
+        extension = "gpkg" if isinstance(definition, QgsProcessingParameterFeatureSink) else definition.defaultFileExtension()
+        params[name] = os.path.join(work_dir, f"{name.lower()}.{extension}")
+
+    context = QgsProcessingContext()
+    feedback = Feedback()
+    start = time.perf_counter()
+    try:
+        _, ok = algorithm.run(params, context, feedback)
+    finally:
+        total_seconds = time.perf_counter() - start
+        provider.unload()
+    record = {"total_seconds": total_seconds, "peak_rss_mb": memory_mb()[1]}
+    if ok and os.path.exists(profile_path):
+        with open(profile_path, encoding="utf-8") as f:
+            record["stages"] = json.load(f)["stages"]
+        record["status"] = "ok"
+    else:
+        record["status"] = "error"
+        record["error"] = "\n".join(feedback.errors)[-2000:]
+    app.exitQgis()
+    return record
+
+
+def spawn_case(case, args, profile_dir):
+    """1ケースを別プロセスで実行し、結果の dict を返す"""
+    work_dir = tempfile.mkdtemp(prefix="rss_bench_", dir=args.work_dir)
+    command = [sys.executable, os.path.abspath(__file__), "case",
+               "--profile-dir", profile_dir, "--work-dir", work_dir,
+               "--rscript", args.rscript or "", json.dumps(case)]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, errors="replace",
+                                   timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        return {"status": "timeout", "total_seconds": args.timeout}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    return {"status": "crash", "error": (completed.stderr or completed.stdout)[-2000:]}
+
+
+def stage_totals(run):
+    """段階名ごとの秒数（同じ名前が複数回あれば合計）"""
+    totals = {}
+    for stage in run.get("stages", []):
+        key = f"{stage['source']}:{stage['name']}"
+        totals[key] = totals.get(key, 0.0) + stage["seconds"]
+    return totals
+
+
+def summarise(runs):
+    """繰り返し実行の中央値"""
+    ok_runs = [run for run in runs if run["status"] == "ok"]
+    summary = {"status": "ok" if ok_runs else runs[-1]["status"]}
+    if not ok_runs:
+        summary["error"] = runs[-1].get("error", "")
+        return summary
+    summary["median_seconds"] = statistics.median(run["total_seconds"] for run in ok_runs)
+    peaks = [run["peak_rss_mb"] for run in ok_runs if run.get("peak_rss_mb") is not None]
+    summary["peak_rss_mb"] = max(peaks) if peaks else None
+    r_peaks = [stage["r_peak_mb"] for run in ok_runs for stage in run.get("stages", []) if stage["source"] == "R"]
+    summary["r_peak_mb"] = max(r_peaks) if r_peaks else None
+    per_stage = [stage_totals(run) for run in ok_runs]
+    names = list(dict.fromkeys(name for totals in per_stage for name in totals))
+    summary["stages"] = {name: statistics.median(totals.get(name, 0.0) for totals in per_stage) for name in names}
+    return summary
+
+
+def environment_info(args):
+    """結果を比べるときに確認する実行環境"""
+    from qgis.core import Qgis
+    import numpy
+    import scipy
+
+    def command_output(command):
+        try:
+            completed = subprocess.run(command, capture_output=True, text=True, cwd=PLUGIN_DIR, timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        return (completed.stdout + completed.stderr).strip() or None
+
+    commit = command_output(["git", "rev-parse", "HEAD"])
+    dirty = command_output(["git", "status", "--porcelain", "--untracked-files=no"])
+    return {
+        "result_version": RESULT_VERSION,
+        "label": args.label,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "git_dirty": bool(dirty),
+        "qgis": Qgis.version(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "scipy": scipy.__version__,
+        "r": command_output([args.rscript, "--version"]) if args.rscript else None,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+    }
+
+
+def command_run(args):
+    from synthetic import ensure_dataset
+
+    args.work_dir = args.work_dir or os.path.join(os.path.dirname(os.path.abspath(args.out)), "work")
+    os.makedirs(args.work_dir, exist_ok=True)
+    profile_dir = os.path.join(args.work_dir, "qgis-profile")
+    app = start_qgis(profile_dir, args.rscript)
+    from qgis.core import QgsApplication
+
+    provider = load_provider()
+    QgsApplication.processingRegistry().addProvider(provider)
+    cases = build_cases(args, provider)
+    meta = environment_info(args)
+
+    results = []
+    for i, case in enumerate(cases, start=1):
+        case["input"] = ensure_dataset(args.data_dir, case["dataset"], case["n"], args.seed, log)
+        runs = []
+        for _ in range(args.repeat):
+            runs.append(spawn_case(case, args, profile_dir))
+            if runs[-1]["status"] != "ok":
+                break
+        summary = summarise(runs)
+        result = {key: case[key] for key in ("key", "algorithm", "dataset", "n", "engine", "params")}
+        result["runs"] = runs
+        result.update(summary)
+        results.append(result)
+        if summary["status"] == "ok":
+            peak = "" if summary["peak_rss_mb"] is None else f"  peak {summary['peak_rss_mb']:.0f} MB"
+            log(f"[{i}/{len(cases)}] {case['key']}: {summary['median_seconds']:.3f} s{peak}")
+        else:
+            log(f"[{i}/{len(cases)}] {case['key']}: {summary['status']} {summary.get('error', '')[-300:]}")
+        # 途中で止めても、それまでの結果が残るように毎回書き出す
+        write_results(args.out, meta, results)
+    app.exitQgis()
+
+
+def write_results(path, meta, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=1)
+
+
+def command_case(args):
+    case = json.loads(args.case)
+    record = run_case(case, args.profile_dir, args.rscript, args.work_dir)
+    print(RESULT_MARKER + json.dumps(record, ensure_ascii=False), flush=True)
+
+
+def command_compare(args):
+    """2つの結果ファイルのケースごと（--stages なら段階ごと）の中央値の比"""
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    for name, data in (("base", base), ("new", new)):
+        meta = data["meta"]
+        log(f"{name}: {meta.get('label') or ''} {meta.get('git_commit') or ''}{' (dirty)' if meta.get('git_dirty') else ''}"
+            f" QGIS {meta.get('qgis')} / {meta.get('platform')}")
+    base_results = {result["key"]: result for result in base["results"]}
+    regressions = 0
+    log(f"{'case':<56} {'base s':>10} {'new s':>10} {'ratio':>7}")
+    for result in new["results"]:
+        before = base_results.get(result["key"])
+        if before is None or before["status"] != "ok" or result["status"] != "ok":
+            status = "missing" if before is None else f"{before['status']} -> {result['status']}"
+            log(f"{result['key']:<56} {status}")
+            continue
+        ratio = result["median_seconds"] / before["median_seconds"] if before["median_seconds"] else float("inf")
+        flag = "  *" if ratio > args.threshold else ""
+        regressions += bool(flag)
+        log(f"{result['key']:<56} {before['median_seconds']:>10.3f} {result['median_seconds']:>10.3f} {ratio:>7.2f}{flag}")
+        if args.stages:
+            for stage, seconds in result["stages"].items():
+                old = before["stages"].get(stage)
+                if old is None:
+                    log(f"    {stage:<52} {'':>10} {seconds:>10.3f}")
+                else:
+                    stage_ratio = f"{seconds / old:>7.2f}" if old else ""
+                    log(f"    {stage:<52} {old:>10.3f} {seconds:>10.3f} {stage_ratio}")
+    log(f"{regressions} case(s) slower than x{args.threshold:g}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def comma_list(convert=str):
+    return lambda text: [convert(value) for value in text.replace(",", " ").split()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="R Spatial Statistics benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run benchmarks and write a result JSON")
+    run.add_argument("--out", required=True, help="result JSON path")
+    run.add_argument("--label", default="", help="free text stored in the result (e.g. branch name)")
+    run.add_argument("--rscript", default=os.environ.get("RSCRIPT", ""), help="Rscript path (R engines are reported as errors without it)")
+    run.add_argument("--sizes", type=comma_list(int), default=DEFAULT_SIZES)
+    run.add_argument("--datasets", type=comma_list(), default=None)
+    run.add_argument("--algorithms", type=comma_list(), default=list(ALGORITHMS))
+    run.add_argument("--engines", type=comma_list(), default=None, help="e.g. native/binary,r/geopackage (default: all)")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--timeout", type=float, default=3600, help="seconds per run")
+    run.add_argument("--data-dir", default=os.path.join(BENCHMARK_DIR, "data"), help="synthetic dataset cache")
+    run.add_argument("--work-dir", default=None, help="outputs and QGIS profile (default: next to --out)")
+
+    case = subparsers.add_parser("case", help=argparse.SUPPRESS)
+    case.add_argument("--profile-dir", required=True)
+    case.add_argument("--work-dir", required=True)
+    case.add_argument("--rscript", default="")
+    case.add_argument("case")
+
+    compare = subparsers.add_parser("compare", help="compare two result JSON files")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--stages", action="store_true", help="show per-stage medians")
+    compare.add_argument("--threshold", type=float, default=1.1, help="ratio reported as a regression")
+    compare.add_argument("--fail-on-regression", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        from synthetic import DATASETS
+
+        args.datasets = args.datasets or DATASETS
+        unknown = set(args.algorithms) - set(ALGORITHMS) or set(args.datasets) - set(DATASETS)
+        if unknown:
+            parser.error(f"unknown: {', '.join(sorted(unknown))}")
+        command_run(args)
+    elif args.command == "case":
+        command_case(args)
+    else:
+        return command_compare(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
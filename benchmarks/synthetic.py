@@ -0,0 +1,174 @@
+"""
+ベンチマーク用の合成データ（規則格子・ボロノイ分割・クラスタ点群）を作る。
+乱数は seed から決まるので、同じ (種類, 件数, seed) なら何度作っても同じ地物になる。
+点の密度は件数によらず一定（平均間隔 SPACING m）にしてあるので、
+距離帯・k 近傍の近傍数は件数を増やしてもほぼ変わらず、件数に対する伸び方だけを比べられる。
+"""
+import math
+import os
+
+import numpy as np
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransformContext,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsVectorFileWriter,
+                       QgsWkbTypes)
+from qgis.PyQt.QtCore import QVariant
+
+# 生成方法を変えたら上げる（ファイル名に入るので古いデータは使われなくなる）
+GENERATOR_VERSION = 1
+# 点・セルの平均間隔（m）
+SPACING = 100.0
+# 領域の境界上の頂点の丸め誤差の許容値（m）
+EPSILON = 1e-6
+CRS = "EPSG:3857"
+
+DATASETS = ['lattice', 'voronoi', 'points']
+# 面のデータセット（隣接関係のアルゴリズムに使える）
+POLYGON_DATASETS = ['lattice', 'voronoi']
+
+# 書き込みの単位（地物数）
+WRITE_BATCH = 10000
+
+
+def dataset_path(data_dir, kind, n, seed):
+    return os.path.join(data_dir, f"{kind}_{n}_s{seed}_v{GENERATOR_VERSION}.gpkg")
+
+
+def ensure_dataset(data_dir, kind, n, seed=1, log=print):
+    """データセットの GPKG のパスを返す（なければ作る）"""
+    path = dataset_path(data_dir, kind, n, seed)
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    log(f"generating {kind} n={n} seed={seed}")
+    rng = np.random.default_rng([seed, n, DATASETS.index(kind)])
+    if kind == 'lattice':
+        centres, geometries = _lattice(n)
+    elif kind == 'voronoi':
+        centres, geometries = _voronoi(n, rng)
+    elif kind == 'points':
+        centres, geometries = _clustered_points(n, rng)
+    else:
+        raise ValueError(f"unknown dataset: {kind}")
+    values = _field_values(centres, rng)
+    # 途中で止まったファイルを使わないよう、書き終えてから名前を変える
+    partial = path + ".partial.gpkg"
+    _write_gpkg(partial, geometries, values,
+                QgsWkbTypes.Point if kind == 'points' else QgsWkbTypes.Polygon)
+    os.replace(partial, path)
+    return path
+
+
+def _extent(n):
+    """密度を一定にしたときの領域の一辺"""
+    return math.sqrt(n) * SPACING
+
+
+def _lattice(n):
+    """一辺 SPACING の正方格子（最後の行は途中まで）"""
+    cols = math.ceil(math.sqrt(n))
+    idx = np.arange(n)
+    x0 = (idx % cols) * SPACING
+    y0 = (idx // cols) * SPACING
+    centres = np.column_stack([x0 + SPACING / 2, y0 + SPACING / 2])
+
+    def geometries():
+        for x, y in zip(x0, y0):
+            x1, y1 = x + SPACING, y + SPACING
+            yield f"POLYGON(({x} {y},{x1} {y},{x1} {y1},{x} {y1},{x} {y}))"
+
+    return centres, geometries()
+
+
+def _voronoi(n, rng):
+    """
+    一様乱数の点のボロノイ分割。
+    辺の近くの点を領域の外へ鏡映して加えると、元の点のセルは領域の境界で閉じる。
+    隣り合うセルは頂点を共有するので、Queen / Rook の隣接がそのまま求まる。
+    """
+    from scipy.spatial import Voronoi
+
+    size = _extent(n)
+    points = rng.uniform(0, size, (n, 2))
+    band = 5 * SPACING
+    mirrored = [points]
+    for axis in (0, 1):
+        near_low = points[points[:, axis] < band].copy()
+        near_low[:, axis] = -near_low[:, axis]
+        near_high = points[points[:, axis] > size - band].copy()
+        near_high[:, axis] = 2 * size - near_high[:, axis]
+        mirrored += [near_low, near_high]
+    vor = Voronoi(np.vstack(mirrored))
+    vertices = vor.vertices
+    box = QgsGeometry.fromWkt(f"POLYGON((0 0,{size} 0,{size} {size},0 {size},0 0))")
+
+    def geometries():
+        for i in range(n):
+            region = vor.regions[vor.point_region[i]]
+            ring = vertices[region]
+            if -1 in region or ring.min() < -EPSILON or ring.max() > size + EPSILON:
+                # 鏡映の範囲外まで広がったまれなセルだけ領域で切る
+                hull = QgsGeometry.fromMultiPointXY(
+                    [QgsPointXY(x, y) for x, y in vertices[[v for v in region if v >= 0]]]
+                ).convexHull()
+                yield hull.intersection(box).asWkt()
+            else:
+                yield "POLYGON((" + ",".join(f"{x} {y}" for x, y in ring) + f",{ring[0][0]} {ring[0][1]}))"
+
+    return points, geometries()
+
+
+def _clustered_points(n, rng):
+    """Thomas 過程のクラスタ点群（親点1つあたり平均50点、広がりは SPACING の3倍）"""
+    size = _extent(n)
+    n_parents = max(1, n // 50)
+    parents = rng.uniform(0, size, (n_parents, 2))
+    points = parents[rng.integers(0, n_parents, n)] + rng.normal(0, 3 * SPACING, (n, 2))
+    # 領域の外に出た点は反対側に回す
+    points = np.mod(points, size)
+    return points, (f"POINT({x} {y})" for x, y in points)
+
+
+def _field_values(centres, rng):
+    """
+    value  … 空間的に滑らかな成分 + ノイズ（正の空間自己相関）
+    value2 … ノイズのみ（自己相関なし）
+    """
+    wavelength = 20 * SPACING
+    x, y = centres[:, 0], centres[:, 1]
+    smooth = np.sin(x / wavelength) + np.cos(y / wavelength)
+    value = smooth + rng.normal(0, 0.5, len(centres))
+    value2 = rng.normal(0, 1, len(centres))
+    return np.column_stack([value, value2])
+
+
+def _write_gpkg(path, geometries, values, wkb_type):
+    fields = QgsFields()
+    fields.append(QgsField("value", QVariant.Double))
+    fields.append(QgsField("value2", QVariant.Double))
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = "GPKG"
+    options.fileEncoding = "UTF-8"
+    writer = QgsVectorFileWriter.create(
+        path, fields, wkb_type, QgsCoordinateReferenceSystem(CRS),
+        QgsCoordinateTransformContext(), options
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise RuntimeError(writer.errorMessage())
+    batch = []
+    for wkt, (value, value2) in zip(geometries, values):
+        feat = QgsFeature(fields)
+        feat.setGeometry(QgsGeometry.fromWkt(wkt))
+        feat.setAttributes([float(value), float(value2)])
+        batch.append(feat)
+        if len(batch) >= WRITE_BATCH:
+            writer.addFeatures(batch)
+            batch = []
+    if batch:
+        writer.addFeatures(batch)
+    del writer
@@ -1,7 +1,102 @@
 import os
-from qgis.PyQt.QtWidgets import QDialog
-from qgis.core import QgsSettings
+from qgis.PyQt.QtWidgets import QDialog, QMessageBox
+from qgis.core import (Qgis, QgsApplication, QgsMessageLog, QgsProcessingException,
+                       QgsProcessingFeedback, QgsSettings, QgsTask)
 from qgis.PyQt import uic
+from qgis.utils import iface
+from .utils.r_packages import (find_missing_packages, install_packages,
+                               mark_verified, clear_verified,
+                               query_library_paths, save_library_paths)
+
+# 実行中の確認・インストールタスク（ダイアログを閉じた後も参照を保持する）
+_package_tasks = set()
+
+
+class _LogFeedback(QgsProcessingFeedback):
+    """インストール中のRの出力をメッセージログ（R Spatial Statistics タブ）に書く"""
+
+    def pushInfo(self, info):
+        QgsMessageLog.logMessage(info, "R Spatial Statistics", Qgis.Info)
+
+    def pushConsoleInfo(self, info):
+        QgsMessageLog.logMessage(info, "R Spatial Statistics", Qgis.Info)
+
+
+class PackageCheckTask(QgsTask):
+    """
+    Rの .libPaths() の取得と、必要なRパッケージの確認をバックグラウンドで行うタスク。
+    終了すると on_finished(task) をメインスレッドで呼ぶ。
+    """
+
+    def __init__(self, rscript_path, on_finished):
+        super().__init__("Rパッケージの確認", QgsTask.CanCancel)
+        self.rscript_path = rscript_path
+        self.on_finished = on_finished
+        self.library_paths = None
+        self.missing = []
+        self.error = None
+
+    def run(self):
+        try:
+            self.library_paths = query_library_paths(self.rscript_path)
+            self.missing = find_missing_packages(self.rscript_path)
+        except QgsProcessingException as e:
+            self.error = str(e)
+            return False
+        return True
+
+    def finished(self, result):
+        _package_tasks.discard(self)
+        if self.library_paths is not None:
+            save_library_paths(self.rscript_path, self.library_paths)
+        self.on_finished(self)
+
+
+class PackageInstallTask(QgsTask):
+    """Rパッケージのインストールをバックグラウンドで行うタスク"""
+
+    def __init__(self, rscript_path, packages):
+        super().__init__("Rパッケージのインストール: " + ", ".join(packages), QgsTask.CanCancel)
+        self.rscript_path = rscript_path
+        self.packages = packages
+        self.feedback = _LogFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+        self.missing = packages
+        self.library_paths = None
+        self.error = None
+
+    def cancel(self):
+        self.feedback.cancel()
+        super().cancel()
+
+    def run(self):
+        try:
+            install_packages(self.rscript_path, self.packages, self.feedback)
+            if self.isCanceled():
+                return False
+            self.missing = find_missing_packages(self.rscript_path)
+            # ユーザーライブラリが新しく作られた場合は .libPaths() が変わる
+            self.library_paths = query_library_paths(self.rscript_path)
+        except QgsProcessingException as e:
+            self.error = str(e)
+            return False
+        return not self.missing
+
+    def finished(self, result):
+        _package_tasks.discard(self)
+        if self.library_paths is not None:
+            save_library_paths(self.rscript_path, self.library_paths)
+        if result:
+            mark_verified(self.rscript_path)
+            iface.messageBar().pushSuccess("R Spatial Statistics", "Rパッケージのインストールが完了しました")
+        elif self.isCanceled():
+            iface.messageBar().pushWarning("R Spatial Statistics", "Rパッケージのインストールがキャンセルされました")
+        else:
+            message = self.error or "パッケージのインストールに失敗しました: " + ", ".join(self.missing)
+            iface.messageBar().pushWarning(
+                "R Spatial Statistics", message + "（詳細はログメッセージの R Spatial Statistics タブ）"
+            )
+
 
 class RSpatialStatisticsSettingDialog(QDialog):
     def __init__(self):
@@ -19,6 +114,44 @@ class RSpatialStatisticsSettingDialog(QDialog):
     def save_path(self):
         # QgsFileWidgetからパスを取得
         selected_path = self.ui.rscriptPath.filePath()
-        if selected_path:
-            self.settings.setValue("RRunner/RscriptPath", selected_path)
+        if not selected_path:
+            self.accept()
+            return
+        self.settings.setValue("RRunner/RscriptPath", selected_path)
+        # パスが変わった可能性があるのでパッケージ確認をやり直す
+        clear_verified()
+        if not os.path.exists(selected_path):
+            self.accept()
+            return
+        # Rの起動には時間がかかるので、確認はタスクとして実行し、終わるまでボタンを無効にする
+        self.ui.pushButton_run.setEnabled(False)
+        self.ui.pushButton_run.setText("確認中...")
+        task = PackageCheckTask(selected_path, self.check_finished)
+        _package_tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def check_finished(self, task):
+        # 必要なRパッケージの確認結果を表示し、足りなければインストールを提案
+        self.ui.pushButton_run.setEnabled(True)
+        self.ui.pushButton_run.setText("OK")
+        if not self.isVisible():
+            # 確認中にダイアログが閉じられた
+            return
+        if task.error is not None or task.isCanceled():
+            QMessageBox.warning(self, "R Spatial Statistics", task.error or "Rパッケージの確認がキャンセルされました")
+            return
+
+        if task.missing:
+            answer = QMessageBox.question(
+                self, "R Spatial Statistics",
+                "次のRパッケージがインストールされていません:\n" + ", ".join(task.missing) +
+                "\n\n今すぐインストールしますか？"
+            )
+            if answer == QMessageBox.Yes:
+                # インストールには時間がかかるのでタスクとして実行し、ダイアログはすぐに閉じる
+                install_task = PackageInstallTask(task.rscript_path, task.missing)
+                _package_tasks.add(install_task)
+                QgsApplication.taskManager().addTask(install_task)
+        else:
+            mark_verified(task.rscript_path)
         self.accept()
@@ -30,6 +30,8 @@ from .processing import RScriptProcessingProvider
 from qgis.core import QgsApplication
 
 from .adjacency_matrix_provider.adjacency_matrix_provider import AdjacencyMatrixProvider
+from .utils.scratch import sweep_orphans
+from .utils.layer_tools import start_change_tracking, stop_change_tracking
 
 class RRunnerPlugin:
     def __init__(self, iface):
@@ -47,6 +49,10 @@ class RRunnerPlugin:
 
 
     def initProcessing(self):
+        # 前回異常終了したときに残った一時ファイルを削除
+        sweep_orphans()
+        # 入力の書き出しのキャッシュ用に、レイヤの変更をメインスレッドで追跡する
+        start_change_tracking()
         self.provider = AdjacencyMatrixProvider()
         QgsApplication.processingRegistry().addProvider(self.provider)
 
@@ -55,6 +61,7 @@ class RRunnerPlugin:
     def unload(self):
         self.iface.removePluginMenu("R Spatial Statistics", self.action)
         QgsApplication.processingRegistry().removeProvider(self.provider)
+        stop_change_tracking()
 
 
     def show_dialog(self):
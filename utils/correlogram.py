@@ -0,0 +1,140 @@
+"""
+距離帯・k 近傍ごとの Global Moran's I（コレログラム）を NumPy / SciPy で計算する。
+点の組の距離は空間インデックスで一度だけ求め、距離の昇順に並べてから
+各距離帯を先頭からの区間として順に切り出す（距離帯ごとに検索し直さない）。
+k 近傍は最大の k で一度だけ検索し、近い順の先頭 k 列を使う。
+"""
+import math
+
+import numpy as np
+
+from .neighbours import knn_table, radius_pairs
+
+
+def parse_number_list(text, integer=False):
+    """カンマ（または空白）区切りの数値を昇順・重複なしのリストにする"""
+    values = []
+    for token in text.replace(",", " ").split():
+        value = float(token)
+        if integer:
+            if value != int(value):
+                raise ValueError(f"整数を指定してください: {token}")
+            value = int(value)
+        if value <= 0:
+            raise ValueError(f"正の値を指定してください: {token}")
+        values.append(value)
+    if not values:
+        raise ValueError("値を1つ以上指定してください")
+    return sorted(set(values))
+
+
+def moran_test(z, from_idx, to_idx, weights):
+    """
+    spdep の moran.test（randomisation = TRUE、alternative = "greater"、
+    zero.policy = TRUE、adjust.n = TRUE）と同じ値を返す。
+    z: 平均を引いた値、weights: 辺ごとの重み（行基準化済み）
+    """
+    n_all = len(z)
+    links = np.bincount(from_idx, minlength=n_all)
+    isolated = int((links == 0).sum())
+    n = n_all - isolated
+    s0 = float(weights.sum())
+    result = {
+        "avg_links": float(links.mean()) if n_all else 0.0,
+        "isolated": isolated,
+        "moran_i": math.nan,
+        "expectation": math.nan,
+        "variance": math.nan,
+        "z_score": math.nan,
+        "p_value": math.nan,
+    }
+    m2 = float((z * z).sum())
+    if s0 == 0 or n < 4 or m2 == 0:
+        return result
+
+    lag = np.bincount(from_idx, weights=weights * z[to_idx], minlength=n_all)
+    moran_i = n / s0 * float((z * lag).sum()) / m2
+
+    # S1 = 1/2 Σ (w_ij + w_ji)^2、S2 = Σ (w_i. + w_.i)^2
+    key = np.concatenate([from_idx * n_all + to_idx, to_idx * n_all + from_idx])
+    _, inverse = np.unique(key, return_inverse=True)
+    pair_sum = np.bincount(inverse, weights=np.concatenate([weights, weights]))
+    s1 = 0.5 * float((pair_sum * pair_sum).sum())
+    margins = (np.bincount(from_idx, weights=weights, minlength=n_all) +
+               np.bincount(to_idx, weights=weights, minlength=n_all))
+    s2 = float((margins * margins).sum())
+
+    kurtosis = n_all * float((z ** 4).sum()) / (m2 * m2)
+    expectation = -1.0 / (n - 1)
+    variance = ((n * ((n * n - 3 * n + 3) * s1 - n * s2 + 3 * s0 * s0) -
+                 kurtosis * ((n * n - n) * s1 - 2 * n * s2 + 6 * s0 * s0)) /
+                ((n - 1) * (n - 2) * (n - 3) * s0 * s0) - expectation * expectation)
+    result.update(moran_i=moran_i, expectation=expectation, variance=variance)
+    if variance > 0:
+        z_score = (moran_i - expectation) / math.sqrt(variance)
+        result.update(z_score=z_score, p_value=0.5 * math.erfc(z_score / math.sqrt(2)))
+    return result
+
+
+def _row_standardise(n, from_idx):
+    counts = np.bincount(from_idx, minlength=n)
+    return 1.0 / counts[from_idx]
+
+
+def distance_correlogram(coords, values, bands, cumulative=True, feedback=None):
+    """
+    距離帯ごとの Moran's I。
+    cumulative=True  … 0 〜 d（dnearneigh(coords, 0, d) と同じ）
+    cumulative=False … 1つ前の d 〜 d の円環
+    戻り値は距離帯ごとの dict のリスト。
+    """
+    n = len(coords)
+    z = np.asarray(values, dtype=float)
+    z = z - z.mean()
+    i, j, dist = radius_pairs(coords, bands[-1])
+    order = np.argsort(dist, kind="stable")
+    i, j, dist = i[order], j[order], dist[order]
+    # 各距離帯の終わり（距離 <= d の組の数）
+    ends = np.searchsorted(dist, bands, side="right")
+
+    rows = []
+    start, lower = 0, 0.0
+    for lag, (upper, end) in enumerate(zip(bands, ends), start=1):
+        if feedback is not None:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * (lag - 1) / len(bands))
+        first = 0 if cumulative else start
+        # 対称にして from の昇順に並べる
+        from_idx = np.concatenate([i[first:end], j[first:end]])
+        to_idx = np.concatenate([j[first:end], i[first:end]])
+        order = np.argsort(from_idx, kind="stable")
+        from_idx, to_idx = from_idx[order], to_idx[order]
+        row = moran_test(z, from_idx, to_idx, _row_standardise(n, from_idx))
+        row.update(lag=lag, distance_from=0.0 if cumulative else lower, distance_to=float(upper), k=None)
+        rows.append(row)
+        start, lower = end, float(upper)
+    return rows
+
+
+def knn_correlogram(coords, values, ks, feedback=None):
+    """k 近傍ごとの Moran's I（knn2nb(knearneigh(coords, k)) と同じ近傍）"""
+    n = len(coords)
+    z = np.asarray(values, dtype=float)
+    z = z - z.mean()
+    table = knn_table(coords, ks[-1])
+    rows = []
+    for lag, k in enumerate(ks, start=1):
+        if feedback is not None:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * (lag - 1) / len(ks))
+        from_idx = np.repeat(np.arange(n, dtype=np.int64), k)
+        to_idx = table[:, :k].ravel()
+        kth = table[:, k - 1]
+        distances = np.hypot(coords[kth, 0] - coords[:, 0], coords[kth, 1] - coords[:, 1])
+        row = moran_test(z, from_idx, to_idx, np.full(len(from_idx), 1.0 / k))
+        # 横軸に使えるよう、k 番目の近傍までの距離の範囲を付ける
+        row.update(lag=lag, distance_from=float(distances.min()), distance_to=float(distances.max()), k=k)
+        rows.append(row)
+    return rows
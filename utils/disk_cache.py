@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+
+from qgis.core import QgsSettings
+
+# キャッシュ全体の親フォルダ（設定 RRunner/CacheDir で変更できる）
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "r_spatial_stat_cache")
+# 書き込み途中のファイル（名前に ".tmp" を含む）を削除の対象にするまでの時間（秒）
+_PARTIAL_GRACE = 3600
+
+
+def cache_dir(name):
+    """用途ごとのキャッシュフォルダを返す（無ければ作成する）"""
+    root = QgsSettings().value("RRunner/CacheDir", "") or DEFAULT_CACHE_DIR
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def touch(path):
+    """参照されたエントリの更新日時を現在時刻にする（LRU の順番を更新）"""
+    try:
+        os.utime(path, None)
+        return True
+    except OSError:
+        return False
+
+
+def evict_lru(directory, max_bytes, max_age=None, keep=()):
+    """
+    フォルダ内のファイルを更新日時の古い順に削除し、合計サイズを max_bytes 以下にする。
+    max_age（秒）を指定すると、それより古いファイルはサイズに関係なく削除する。
+    keep のファイル（これから読まれるエントリ）と、他の処理が書き込み中のファイルは削除しない。
+    戻り値は削除したファイル数。
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    now = time.time()
+    entries = []
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        protected = (os.path.abspath(entry.path) in keep or
+                     (".tmp" in entry.name and now - stat.st_mtime < _PARTIAL_GRACE))
+        entries.append((stat.st_mtime, stat.st_size, entry.path, protected))
+    entries.sort()
+
+    total = sum(entry[1] for entry in entries)
+    removed = 0
+    for mtime, size, path, protected in entries:
+        expired = max_age is not None and now - mtime > max_age
+        if protected or (total <= max_bytes and not expired):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            # 他の処理が使用中のファイルは残す
+            continue
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,230 @@
+"""
+GISA の検定を複数の統計量・フィールドに対してまとめて行う R コード。
+近傍（nb）は一度だけ作り、統計量に必要な重み（W / B、自己近傍の有無）はそこから派生させる。
+検定を繰り返してログ・テキスト用の結果と、1行1検定の集計表を作る。
+集計表はタブ区切りで QGIS 側に渡し、型付きの Processing 出力・CSV・JSON にする
+（spdep の表示形式に依存しない）。
+"""
+import csv
+import json
+import math
+
+from qgis.core import (QgsProcessingOutputNumber,
+                       QgsProcessingOutputString,
+                       QgsProcessingParameterFileDestination)
+
+from .permutation import r_global_permutation_functions, r_global_permutation_code
+
+# 統計量（Processing の選択肢と同じ順番）
+GISA_STATISTICS = ['Moran\'s I', 'Geary\'s C', 'Getis-Ord G', 'Getis-Ord G*']
+
+# 集計表の列（R の gisa_table と同じ順番）と型
+GISA_TABLE_COLUMNS = [
+    ("field", str),
+    ("statistic", str),
+    ("estimate", float),
+    ("expectation", float),
+    ("variance", float),
+    ("std_deviate", float),
+    ("p_value", float),
+    ("perm_p_value", float),
+    ("n", int),
+    ("n_links", int),
+    ("avg_links", float),
+    ("min_links", int),
+    ("max_links", int),
+    ("isolated", int),
+]
+
+# 最初の検定（1つ目の統計量 × FIELD）の値を返す出力（出力名, 列名, 説明）
+GISA_NUMBER_OUTPUTS = [
+    ('STATISTIC', 'estimate', 'Statistic'),
+    ('EXPECTATION', 'expectation', 'Expectation'),
+    ('VARIANCE', 'variance', 'Variance'),
+    ('Z_SCORE', 'std_deviate', 'Standard deviate (z)'),
+    ('P_VALUE', 'p_value', 'p-value'),
+    ('PERM_P_VALUE', 'perm_p_value', 'Permutation p-value'),
+    ('N_FEATURES', 'n', 'Number of features'),
+    ('N_LINKS', 'n_links', 'Number of neighbour links'),
+    ('AVG_LINKS', 'avg_links', 'Average number of neighbours'),
+    ('MIN_LINKS', 'min_links', 'Minimum number of neighbours'),
+    ('MAX_LINKS', 'max_links', 'Maximum number of neighbours'),
+    ('N_ISOLATED', 'isolated', 'Features without neighbours'),
+]
+OUTPUT_JSON = 'OUTPUT_JSON'
+
+
+def r_string_vector(values):
+    """Python の文字列のリストを R の文字ベクトルにする"""
+    return "c(" + ", ".join(f'"{value}"' for value in values) + ")"
+
+
+def analysis_fields(field_name, extra_fields):
+    """FIELD と追加フィールドを重複なしで並べる"""
+    fields = [field_name]
+    for name in extra_fields:
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+
+def r_gisa_listw_code(use_distance_decay):
+    """
+    nb から統計量ごとの listw を返す関数 gisa_listw(statistic_type) を定義する R コード。
+    同じスタイル・自己近傍の組み合わせは一度だけ作って使い回す。
+    """
+    r_use_decay = "TRUE" if use_distance_decay else "FALSE"
+    return f"""
+        gisa_listw_cache <- list()
+        gisa_centroids <- NULL
+        gisa_listw <- function(statistic_type) {{
+            # 距離減衰ありは行基準化（W）、なしは G / G* のみバイナリ（B）
+            self <- statistic_type == "Getis-Ord G*"
+            style <- if ({r_use_decay} || !(statistic_type %in% c("Getis-Ord G", "Getis-Ord G*"))) "W" else "B"
+            key <- paste(style, self)
+            if (is.null(gisa_listw_cache[[key]])) {{
+                nb_used <- if (self) include.self(nb) else nb
+                glist <- NULL
+                if ({r_use_decay}) {{
+                    if (is.null(gisa_centroids)) gisa_centroids <<- st_centroid(polygons)
+                    glist <- nbdists(nb_used, gisa_centroids)
+                    glist <- lapply(glist, function(x) ifelse(x == 0, 1e-6, 1 / x))
+                }}
+                gisa_listw_cache[[key]] <<- nb2listw(nb_used, glist = glist, style = style, zero.policy = TRUE)
+            }}
+            gisa_listw_cache[[key]]
+        }}
+"""
+
+
+def r_gisa_tests_code(field_names, statistic_types, n_simulations=0, seed=1, results_path=""):
+    """
+    gisa_listw・polygons から各統計量・各フィールドの検定を行う R コード。
+    result_txt に検定結果と集計表を追加し、集計表（GISA_TABLE_COLUMNS）を
+    results_path にタブ区切りで書き出す（read_gisa_table で読み込む）。
+    """
+    results_path = results_path.replace("\\", "/")
+    return f"""
+        {r_global_permutation_functions(n_simulations)}
+
+        gisa_statistics <- {r_string_vector(statistic_types)}
+        gisa_fields <- {r_string_vector(field_names)}
+        gisa_table <- NULL
+        for (statistic_type in gisa_statistics) {{
+            listw <- gisa_listw(statistic_type)
+            links <- card(listw$neighbours)
+            for (id_field in gisa_fields) {{
+                if (statistic_type == "Moran's I") {{
+                    test <- moran.test(polygons[[id_field]], listw)
+                }} else if (statistic_type == "Geary's C") {{
+                    test <- geary.test(polygons[[id_field]], listw)
+                }} else if (statistic_type == "Getis-Ord G" || statistic_type == "Getis-Ord G*") {{
+                    test <- globalG.test(polygons[[id_field]], listw)
+                }}
+                test_result <- capture.output(test)
+
+                # 並べ替え検定（指定した場合のみ）
+                {r_global_permutation_code(n_simulations, seed)}
+
+                if (length(gisa_statistics) > 1 || length(gisa_fields) > 1) {{
+                    result_txt <- c(result_txt, "", paste0("--- ", statistic_type, " / ", id_field, " ---"))
+                }}
+                result_txt <- c(result_txt, "", test_result)
+                gisa_table <- rbind(gisa_table, data.frame(
+                    field = id_field,
+                    statistic = statistic_type,
+                    estimate = unname(test$estimate[1]),
+                    expectation = unname(test$estimate[2]),
+                    variance = unname(test$estimate[3]),
+                    std_deviate = unname(test$statistic),
+                    p_value = test$p.value,
+                    perm_p_value = perm_p_value,
+                    n = length(links),
+                    n_links = sum(links),
+                    avg_links = mean(links),
+                    min_links = min(links),
+                    max_links = max(links),
+                    isolated = sum(links == 0)
+                ))
+            }}
+        }}
+
+        rss_stage("統計量の計算")
+
+        # 全検定の集計表
+        if (nrow(gisa_table) > 1) {{
+            result_txt <- c(result_txt, "", "Summary:", capture.output(print(gisa_table, row.names = FALSE)))
+        }}
+        if ("{results_path}" != "") {{
+            write.table(gisa_table, "{results_path}", sep = "\\t", quote = FALSE,
+                        row.names = FALSE, na = "", fileEncoding = "UTF-8")
+        }}
+"""
+
+
+def add_gisa_outputs(algorithm):
+    """JSON の出力パラメータと、検定結果の型付き出力を追加する"""
+    algorithm.addParameter(
+        QgsProcessingParameterFileDestination(
+            name=OUTPUT_JSON,
+            description='Export result JSON',
+            fileFilter='JSON (*.json)',
+            optional=True,
+            createByDefault=False
+        )
+    )
+    algorithm.addOutput(QgsProcessingOutputString('STATISTIC_TYPE', 'Statistic type'))
+    algorithm.addOutput(QgsProcessingOutputString('FIELD_NAME', 'Field'))
+    for name, _, description in GISA_NUMBER_OUTPUTS:
+        algorithm.addOutput(QgsProcessingOutputNumber(name, description))
+    algorithm.addOutput(QgsProcessingOutputNumber('N_TESTS', 'Number of tests'))
+
+
+def read_gisa_table(path):
+    """R が書き出した集計表を読み込む（1検定1つの dict、NA・NaN は None）"""
+    types = dict(GISA_TABLE_COLUMNS)
+
+    def convert(name, value):
+        if value in ("", "NA", "NaN"):
+            return None
+        if types[name] is str:
+            return value
+        number = float(value)
+        if not math.isfinite(number):
+            return None
+        return int(number) if types[name] is int else number
+
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        return [{name: convert(name, row[name]) for name, _ in GISA_TABLE_COLUMNS} for row in reader]
+
+
+def gisa_outputs(rows, table_path="", json_path="", info=None):
+    """
+    集計表を CSV（table_path）・JSON（json_path）に書き出し、Processing の結果の辞書を返す。
+    型付き出力は最初の検定の値、JSON には info（入力・近傍などの条件）と全検定を入れる。
+    """
+    names = [name for name, _ in GISA_TABLE_COLUMNS]
+    if table_path:
+        with open(table_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for row in rows:
+                writer.writerow(["NA" if row[name] is None else row[name] for name in names])
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"info": info or {}, "tests": rows}, f, ensure_ascii=False, indent=2)
+
+    first = rows[0] if rows else {}
+    result_dict = {
+        'STATISTIC_TYPE': first.get("statistic"),
+        'FIELD_NAME': first.get("field"),
+        'N_TESTS': len(rows),
+    }
+    for name, column, _ in GISA_NUMBER_OUTPUTS:
+        result_dict[name] = first.get(column)
+    if table_path:
+        result_dict['OUTPUT_TABLE'] = table_path
+    if json_path:
+        result_dict[OUTPUT_JSON] = json_path
+    return result_dict
@@ -0,0 +1,88 @@
+"""
+QGIS から R へのデータ受け渡し（列ごとのバイナリファイル）。
+GPKG に全属性を書き出す代わりに、解析に使うフィールドと重心座標だけを
+リトルエンディアンの生配列で書き出し、R 側は readBin で直接読み込む。
+"""
+import os
+
+import numpy as np
+from qgis.core import NULL, QgsFeatureRequest
+
+from .layer_tools import layer_centroids
+from .scratch import scratch_dir
+
+# 受け渡し方法（Processing の選択肢と同じ順番）
+HANDOFF_MODES = [
+    'GeoPackage (all attributes and geometry)',
+    'Binary columns (analysed fields and centroids only)'
+]
+HANDOFF_GPKG, HANDOFF_BINARY = range(len(HANDOFF_MODES))
+
+# 文字列フィールドの欠損値
+_TEXT_NA = "\\N"
+
+
+def write_handoff(layer, field_names, dest_crs=None, feedback=None):
+    """
+    重心座標・FID・指定フィールドを一時フォルダに書き出す。
+    戻り値:
+        (フォルダのパス, polygons を重心の点の sf として作る R コード)
+    """
+    directory = scratch_dir("rss_handoff_")
+    coords, fids = layer_centroids(layer, dest_crs, feedback)
+    n = len(fids)
+    np.ascontiguousarray(coords[:, 0], dtype="<f8").tofile(os.path.join(directory, "x.f64"))
+    np.ascontiguousarray(coords[:, 1], dtype="<f8").tofile(os.path.join(directory, "y.f64"))
+    fids.astype("<f8").tofile(os.path.join(directory, "fid.f64"))
+
+    fields = layer.fields()
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(field_names, fields)
+    columns = {name: [] for name in field_names}
+    for feat in layer.getFeatures(request):
+        for name in field_names:
+            columns[name].append(feat[name])
+
+    r_columns = []
+    for i, name in enumerate(field_names):
+        values = columns[name]
+        if fields.field(name).isNumeric():
+            path = os.path.join(directory, f"col_{i}.f64")
+            array = np.array(
+                [np.nan if v is None or v == NULL else float(v) for v in values], dtype="<f8"
+            )
+            array.tofile(path)
+            r_columns.append(
+                f'handoff_df[["{name}"]] <- handoff_f64("col_{i}.f64"); '
+                f'handoff_df[["{name}"]][is.nan(handoff_df[["{name}"]])] <- NA'
+            )
+        else:
+            path = os.path.join(directory, f"col_{i}.txt")
+            with open(path, "w", encoding="utf-8", newline="\n") as f:
+                for v in values:
+                    text = _TEXT_NA if v is None or v == NULL else str(v)
+                    f.write(text.replace("\r", " ").replace("\n", " ") + "\n")
+            r_columns.append(
+                f'handoff_df[["{name}"]] <- readLines(file.path(handoff_dir, "col_{i}.txt"), n = handoff_n, encoding = "UTF-8"); '
+                f'handoff_df[["{name}"]][handoff_df[["{name}"]] == "\\\\N"] <- NA'
+            )
+
+    crs = dest_crs if dest_crs is not None else layer.crs()
+    if crs.isValid():
+        with open(os.path.join(directory, "crs.wkt"), "w", encoding="utf-8") as f:
+            f.write(crs.toWkt())
+        r_crs = 'st_crs(paste(readLines(file.path(handoff_dir, "crs.wkt"), encoding = "UTF-8"), collapse = "\\n"))'
+    else:
+        r_crs = "NA"
+
+    r_code = "\n        ".join([
+        f'handoff_dir <- "{directory.replace(chr(92), "/")}"',
+        f"handoff_n <- {n}",
+        'handoff_f64 <- function(name) readBin(file.path(handoff_dir, name), "double", n = handoff_n, size = 8, endian = "little")',
+        'handoff_df <- data.frame(rss_fid = handoff_f64("fid.f64"), rss_x = handoff_f64("x.f64"), rss_y = handoff_f64("y.f64"))',
+        *r_columns,
+        f'polygons <- st_as_sf(handoff_df, coords = c("rss_x", "rss_y"), crs = {r_crs})',
+    ])
+    return directory, r_code
+
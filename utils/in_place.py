@@ -0,0 +1,110 @@
+"""
+結果の列を新しいレイヤに出力する代わりに、入力レイヤに直接書き込む。
+ジオメトリを複製せず、結果の列を追加して値を FID ごとに changeAttributeValues で一括して更新する。
+processAlgorithm（バックグラウンドのスレッド）では値を集めるだけにし、
+プロジェクトのレイヤの更新は postProcessAlgorithm（メインスレッド）で行う。
+"""
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (NULL,
+                       QgsFeatureRequest,
+                       QgsField,
+                       QgsProcessingException,
+                       QgsVectorDataProvider)
+
+
+def check_updatable(layer):
+    """レイヤに列の追加・属性の更新ができなければ QgsProcessingException"""
+    capabilities = layer.dataProvider().capabilities()
+    required = QgsVectorDataProvider.AddAttributes | QgsVectorDataProvider.ChangeAttributeValues
+    if (capabilities & required) != required:
+        raise QgsProcessingException(f"入力レイヤ（{layer.name()}）は列の追加・属性の更新に対応していません")
+    if layer.isEditable():
+        raise QgsProcessingException(f"入力レイヤ（{layer.name()}）の編集モードを終了してから実行してください")
+
+
+def _feature_ids(layer, request=None):
+    request = QgsFeatureRequest(request) if request is not None else QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([])
+    return [feat.id() for feat in layer.getFeatures(request)]
+
+
+class AttributeUpdate:
+    """
+    入力レイヤに書き込む結果の列。
+    値は解析に使ったレイヤ（layer_tools.input_view の戻り値）の地物の順番で渡す。
+    """
+
+    def __init__(self, layer, view):
+        self.layer = layer
+        # 解析に使ったレイヤの FID（地物の順番）
+        self.view_fids = _feature_ids(view)
+        if view is layer or view.source() == layer.source():
+            # 入力レイヤそのもの、またはサブセットを加えた複製（FID は同じ）
+            self.fids = self.view_fids
+        else:
+            # 選択地物から作ったメモリレイヤ（materialize は選択地物を同じ要求の順番で追加する）
+            request = QgsFeatureRequest()
+            request.setFilterFids(layer.selectedFeatureIds())
+            self.fids = _feature_ids(layer, request)
+            if len(self.fids) != len(self.view_fids):
+                raise QgsProcessingException("選択地物が実行中に変更されました")
+        self.fields = []
+        self.columns = []
+
+    def add_field(self, field, values):
+        """列（QgsField）と、地物の順番の値を追加する"""
+        values = list(values)
+        if len(values) != len(self.fids):
+            raise QgsProcessingException("QGIS側とR側で地物数が一致しません")
+        self.fields.append(field)
+        self.columns.append(values)
+
+    def apply(self, feedback=None):
+        """列を追加し、全地物の値を1回の changeAttributeValues で書き込む。戻り値は更新した地物数"""
+        check_updatable(self.layer)
+        provider = self.layer.dataProvider()
+        new_fields = [field for field in self.fields if provider.fields().lookupField(field.name()) < 0]
+        if new_fields:
+            if not provider.addAttributes(new_fields):
+                raise QgsProcessingException(
+                    "入力レイヤに列を追加できませんでした:\n" + "\n".join(provider.errors())
+                )
+            self.layer.updateFields()
+        # 入力と同じ名前の列は上書きする
+        indexes = [provider.fields().lookupField(field.name()) for field in self.fields]
+
+        changes = {}
+        for i, fid in enumerate(self.fids):
+            changes[fid] = {
+                index: NULL if column[i] is None else column[i]
+                for index, column in zip(indexes, self.columns)
+            }
+        if not provider.changeAttributeValues(changes):
+            raise QgsProcessingException(
+                "入力レイヤの属性を更新できませんでした:\n" + "\n".join(provider.errors())
+            )
+        self.layer.triggerRepaint()
+        if feedback is not None:
+            names = ", ".join(field.name() for field in self.fields)
+            feedback.pushInfo(f"入力レイヤ（{self.layer.name()}）の {len(changes)} 件の地物に {names} を書き込みました")
+        return len(changes)
+
+
+def add_neighbour_columns(update, neighbor_ids, neighbor_counts):
+    """近接情報付きポリゴンと同じ列（neighbor_ids, neighbor_count）を更新に加える"""
+    update.add_field(QgsField("neighbor_ids", QVariant.String), neighbor_ids)
+    update.add_field(QgsField("neighbor_count", QVariant.Int), (int(count) for count in neighbor_counts))
+
+
+def defer_update(algorithm, update):
+    """postProcessAlgorithm で書き込む更新を登録する"""
+    algorithm._pending_update = update
+
+
+def apply_deferred_update(algorithm, feedback):
+    """登録された更新を書き込む（postProcessAlgorithm から呼ぶ）"""
+    update = getattr(algorithm, "_pending_update", None)
+    algorithm._pending_update = None
+    if update is not None:
+        update.apply(feedback)
@@ -1,19 +1,434 @@
-
+import functools
+import hashlib
 import os
-import tempfile
+import struct
 import uuid
-from qgis.core import QgsVectorFileWriter
+import numpy as np
+from qgis.core import (QgsVectorFileWriter,
+                       QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransform,
+                       QgsFeatureRequest,
+                       QgsProject,
+                       QgsProviderRegistry,
+                       QgsSettings,
+                       QgsVectorLayer,
+                       QgsWkbTypes,
+                       QgsProcessingException)
+
+from .disk_cache import cache_dir, evict_lru, touch
+from .scratch import scratch_path
+
+# R が元のファイルを直接読めるレイヤ（QGIS の storageType）
+_FILE_STORAGE_TYPES = ["esri shapefile", "gpkg", "geojson", "geopackage"]
+# 書き出し形式を変えたときに古いキャッシュを使わないための版番号
+_EXPORT_CACHE_VERSION = 2
+# 選択地物から作ったメモリレイヤに付ける、元のレイヤと選択地物を表すプロパティ名
+_VIEW_SOURCE_PROPERTY = "r_spatial_stat_view_source"
+# レイヤ ID ごとの [識別子, データの変更回数]（メインスレッドで更新し、書き出し時に読む）
+_change_tokens = {}
+# レイヤ ID ごとの接続したシグナル（変更の追跡をやめるときに切断する）
+_tracked = {}
 
-def get_layer_path_or_temp(layer):
+
+def _ogr_file_source(layer):
+    """
+    OGR で開いたファイルベースのレイヤなら、ファイルのパス・レイヤ名・FID 列名を返す。
+    それ以外（メモリ・DB・SQL 文のサブセットなど）は None。
     """
-    入力レイヤがファイルベースならそのパスを返す。
-    そうでなければ一時GPKGに書き出してそのパスを返す。
+    if layer.providerType() != "ogr" or layer.storageType().lower() not in _FILE_STORAGE_TYPES:
+        return None
+    if layer.subsetString().strip().upper().startswith("SELECT"):
+        return None
+    parts = QgsProviderRegistry.instance().decodeUri("ogr", layer.source())
+    path = parts.get("path", "")
+    if not os.path.isfile(path):
+        return None
+    try:
+        from osgeo import ogr
+    except ImportError:
+        return None
+    dataset = ogr.Open(path)
+    if dataset is None:
+        return None
+    name = parts.get("layerName")
+    ogr_layer = dataset.GetLayerByName(name) if name else dataset.GetLayer(parts.get("layerId") or 0)
+    if ogr_layer is None:
+        return None
+    # Shapefile・GeoJSON は FID 列を持たないので OGR SQL の特殊フィールド FID を使う
+    return path, ogr_layer.GetName(), ogr_layer.GetFIDColumn() or "FID"
+
+
+def fid_condition(fid_column, fids):
+    """FID の集合を WHERE 句の条件にする（連続した FID は BETWEEN にまとめる）"""
+    fids = sorted(fids)
+    column = '"' + fid_column.replace('"', '""') + '"'
+    ranges, singles = [], []
+    start = prev = None
+    for fid in fids + [None]:
+        if start is not None and fid == prev + 1:
+            prev = fid
+            continue
+        if start is not None:
+            if prev - start >= 2:
+                ranges.append(f"{column} BETWEEN {start} AND {prev}")
+            else:
+                singles.extend(range(start, prev + 1))
+        start = prev = fid
+    terms = ranges + ([f"{column} IN ({','.join(str(fid) for fid in singles)})"] if singles else [])
+    return "(" + " OR ".join(terms) + ")"
+
+
+def input_view(layer, selected_only=False):
+    """
+    解析に使う地物だけが見えるレイヤを返す。
+    レイヤのサブセット（フィルタ）はプロバイダで適用されるので、selected_only=False ならそのまま返す。
+    selected_only=True の場合、ファイルベースのレイヤは選択地物の FID の条件をサブセットに加えた複製
+    （地物はファイルから必要な分だけ読まれる）、それ以外は選択地物だけのメモリレイヤを返す。
+    """
+    if not selected_only:
+        return layer
+    fids = layer.selectedFeatureIds()
+    if not fids:
+        raise QgsProcessingException("選択されている地物がありません")
+    source = _ogr_file_source(layer)
+    if source is not None:
+        condition = fid_condition(source[2], fids)
+        subset = layer.subsetString().strip()
+        view = layer.clone()
+        if view.setSubsetString(f"({subset}) AND {condition}" if subset else condition):
+            return view
+    request = QgsFeatureRequest()
+    request.setFilterFids(fids)
+    view = layer.materialize(request)
+    # 書き出しのキャッシュのキーに、元のレイヤと選択地物を使う
+    selection = hashlib.sha1(",".join(str(fid) for fid in sorted(fids)).encode("utf-8")).hexdigest()
+    view.setProperty(_VIEW_SOURCE_PROPERTY, f"{layer.id()}|{selection}")
+    return view
+
+
+def _r_string(text):
+    """R の文字列リテラルにする"""
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def r_read_layer_code(layer, variable="polygons"):
+    """
+    入力レイヤを R の variable に読み込むコードを返す。
+    ファイルベースのレイヤは元のファイルを直接読み、サブセット（フィルタ・選択地物の条件）は
+    st_read(query=) の WHERE 句として渡す（絞り込んだコピーは作らない）。
+    それ以外のレイヤは見えている地物だけを GPKG に書き出す（内容が変わっていなければ
+    キャッシュ済みの書き出しを使う。キャッシュが無効か、キーが作れないレイヤなら一時GPKG）。
     戻り値:
-        (パス: str, 一時ファイルフラグ: bool)
+        (R コード, 読み込むファイルのパス, 一時ファイルフラグ)
+    """
+    source = _ogr_file_source(layer)
+    if source is not None:
+        path, layer_name, _ = source
+        subset = layer.subsetString().strip()
+        if subset:
+            table = layer_name.replace('"', '""')
+            query = f'SELECT * FROM "{table}" WHERE {subset}'
+            r_code = f"{variable} <- st_read({_r_string(path)}, query = {_r_string(query)})"
+        else:
+            r_code = f"{variable} <- st_read({_r_string(path)}, layer = {_r_string(layer_name)})"
+        return r_code, path, False
+    if QgsSettings().value("RRunner/InputCacheEnabled", True, type=bool):
+        export_path = _cached_export(layer)
+        if export_path is not None:
+            return f"{variable} <- st_read({_r_string(export_path)})", export_path, False
+    temp_path = scratch_path("input_polygons_", ".gpkg")
+    _export_gpkg(layer, temp_path)
+    return f"{variable} <- st_read({_r_string(temp_path)})", temp_path, True
+
+
+def _export_gpkg(layer, path):
+    error = QgsVectorFileWriter.writeAsVectorFormat(layer, path, "utf-8", layer.crs(), "GPKG")
+    if error[0] != QgsVectorFileWriter.NoError:
+        raise QgsProcessingException(f"入力レイヤを書き出せませんでした: {error[1]}")
+
+
+def _count_change(layer_id, *args):
+    if layer_id in _change_tokens:
+        _change_tokens[layer_id][1] += 1
+
+
+def track_layer_changes(layers):
+    """
+    レイヤのデータの変更回数（dataChanged / layerModified の回数）を数え始める。
+    シグナルの接続はメインスレッドで行う（start_change_tracking から呼ばれる）。
+    識別子はレイヤを追加するたびに作るので、QGIS の再起動やプロジェクトの読み直しで変わる。
+    """
+    for layer in layers:
+        if not isinstance(layer, QgsVectorLayer) or layer.id() in _tracked:
+            continue
+        layer_id = layer.id()
+        _change_tokens[layer_id] = [uuid.uuid4().hex, 0]
+        slot = functools.partial(_count_change, layer_id)
+        signals = [layer.dataChanged, layer.layerModified]
+        for signal in signals:
+            signal.connect(slot)
+        _tracked[layer_id] = (signals, slot)
+
+
+def untrack_layer_changes(layer_ids):
+    """レイヤの変更の追跡をやめ、シグナルを切断する"""
+    for layer_id in layer_ids:
+        signals, slot = _tracked.pop(layer_id, ((), None))
+        for signal in signals:
+            try:
+                signal.disconnect(slot)
+            except TypeError:
+                pass
+        _change_tokens.pop(layer_id, None)
+
+
+def start_change_tracking():
+    """プロジェクトのレイヤの変更の追跡を始める（プラグインの読み込み時にメインスレッドで呼ぶ）"""
+    project = QgsProject.instance()
+    track_layer_changes(project.mapLayers().values())
+    project.layersAdded.connect(track_layer_changes)
+    project.layersWillBeRemoved.connect(untrack_layer_changes)
+
+
+def stop_change_tracking():
+    """start_change_tracking で接続したシグナルをすべて切断する（プラグインの終了時に呼ぶ）"""
+    project = QgsProject.instance()
+    for signal, slot in ((project.layersAdded, track_layer_changes),
+                         (project.layersWillBeRemoved, untrack_layer_changes)):
+        try:
+            signal.disconnect(slot)
+        except TypeError:
+            pass
+    untrack_layer_changes(list(_tracked))
+
+
+def _export_cache_key(layer):
     """
-    if layer.storageType().lower() in ["esri shapefile", "gpkg", "geojson", "geopackage"]:
-        return layer.source(), False
+    書き出しのキャッシュのキー。プロバイダ・データソース・サブセット・地物数・座標系・
+    フィールドの定義と、QGIS 内でのデータの変更回数から作る（地物は読まない）。
+    選択地物から作ったメモリレイヤは、元のレイヤのキーと選択地物の FID から作る。
+    変更を追跡していないレイヤ（プロジェクトに無いレイヤ）は None（キャッシュしない）。
+    QGIS の外で変更されるデータ（DB など）は、設定 RRunner/InputCacheChecksum を有効にすると
+    全地物のジオメトリ・属性のチェックサムをキーにする。
+    """
+    if QgsSettings().value("RRunner/InputCacheChecksum", False, type=bool):
+        content = layer_fingerprint(layer, attributes=True)
+        return hashlib.sha1(f"{_EXPORT_CACHE_VERSION}|{content}".encode("utf-8")).hexdigest()
+
+    view_source = layer.property(_VIEW_SOURCE_PROPERTY)
+    if view_source:
+        source_id, selection = view_source.split("|", 1)
+        source = QgsProject.instance().mapLayer(source_id)
     else:
-        temp_path = os.path.join(tempfile.gettempdir(), f"input_polygons_{uuid.uuid4().hex}.gpkg")
-        QgsVectorFileWriter.writeAsVectorFormat(layer, temp_path, "utf-8", layer.crs(), "GPKG")
-        return temp_path, True
\ No newline at end of file
+        source, selection = layer, ""
+    token = _change_tokens.get(source.id()) if source is not None else None
+    if token is None:
+        return None
+    fields = [(field.name(), field.typeName(), field.length(), field.precision())
+              for field in source.fields()]
+    content = "|".join([
+        source.providerType(),
+        source.dataProvider().dataSourceUri(),
+        source.subsetString(),
+        str(layer.featureCount()),
+        source.crs().toWkt(),
+        repr(fields),
+        f"{token[0]}:{token[1]}",
+        selection
+    ])
+    return hashlib.sha1(f"{_EXPORT_CACHE_VERSION}|{content}".encode("utf-8")).hexdigest()
+
+
+def _cached_export(layer):
+    """
+    ファイルでないレイヤの書き出し（GPKG）をキャッシュから返す。
+    キー（_export_cache_key）が同じなら書き出しを省略する。キーが作れなければ None。
+    新しく書き出したときは、設定の上限（RRunner/InputCacheMaxMB、RRunner/InputCacheMaxAgeDays）を
+    超えた古いエントリを削除する。
+    """
+    key = _export_cache_key(layer)
+    if key is None:
+        return None
+    directory = cache_dir("inputs")
+    path = os.path.join(directory, f"input_{key}.gpkg")
+    if os.path.exists(path) and touch(path):
+        return path
+    # 同じレイヤを並行して書き出しても壊れないよう、書き終えてから名前を変える
+    partial = os.path.join(directory, f"input_{key}.{uuid.uuid4().hex}.tmp.gpkg")
+    try:
+        _export_gpkg(layer, partial)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    settings = QgsSettings()
+    max_mb = settings.value("RRunner/InputCacheMaxMB", 1024, type=int)
+    max_days = settings.value("RRunner/InputCacheMaxAgeDays", 7, type=float)
+    evict_lru(directory, max_mb * 1024 * 1024, max_days * 86400, keep=[path])
+    return path
+
+
+def layer_fingerprint(layer, attributes=False):
+    """
+    レイヤの内容を表すハッシュ値（キャッシュのキー用）。
+    未編集のファイルベースのレイヤはファイル（と -wal / -shm）の更新日時とサイズ、
+    それ以外のレイヤは全地物のFIDとジオメトリのチェックサムを使う。
+    attributes=True ならチェックサムに属性値とフィールドの定義も含める。
+    このときデータソースはキーに含めないので、内容が同じなら別のレイヤ
+    （選択地物から作り直したメモリレイヤなど）でも同じ値になる。
+    """
+    parts = [
+        layer.providerType(),
+        layer.source(),
+        layer.subsetString(),
+        str(layer.featureCount()),
+        layer.crs().toWkt()
+    ]
+    path = layer.source().split("|")[0]
+    if os.path.isfile(path) and not layer.isModified():
+        stat = os.stat(path)
+        parts += [str(stat.st_mtime_ns), str(stat.st_size)]
+        # GPKG / SQLite の WAL モードでは、チェックポイントまで変更が -wal に残り本体は変わらない
+        for sidecar in (path + "-wal", path + "-shm"):
+            if os.path.isfile(sidecar):
+                stat = os.stat(sidecar)
+                parts += [sidecar, str(stat.st_mtime_ns), str(stat.st_size)]
+        if attributes:
+            parts.append(repr(layer.fields().names()))
+    else:
+        checksum = hashlib.sha1()
+        request = QgsFeatureRequest()
+        if not attributes:
+            request.setSubsetOfAttributes([])
+        for feat in layer.getFeatures(request):
+            checksum.update(struct.pack("<q", feat.id()))
+            checksum.update(bytes(feat.geometry().asWkb()))
+            if attributes:
+                checksum.update(repr(feat.attributes()).encode("utf-8"))
+        if attributes:
+            fields = [(field.name(), field.typeName(), field.length(), field.precision())
+                      for field in layer.fields()]
+            parts = [repr(fields), str(layer.featureCount()), layer.crs().toWkt()]
+        parts.append(checksum.hexdigest())
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def metric_crs(layer):
+    """
+    R側と同じく、地理座標系のレイヤは EPSG:3857（単位：メートル）で扱う。
+    投影変換が不要なら None を返す。
+    """
+    if layer.crs().isGeographic():
+        return QgsCoordinateReferenceSystem("EPSG:3857")
+    return None
+
+
+def layer_centroids(layer, dest_crs=None, feedback=None):
+    """
+    レイヤの各地物の重心座標を取得する（地物の並び順は st_read と同じ）。
+    dest_crs を指定すると投影変換してから重心を求める。
+    戻り値:
+        (重心座標: numpy.ndarray (n, 2), 地物ID: numpy.ndarray (n,))
+    """
+    transform = None
+    if dest_crs is not None:
+        transform = QgsCoordinateTransform(layer.crs(), dest_crs, QgsProject.instance())
+
+    count = max(layer.featureCount(), 0)
+    coords = np.empty((count, 2), dtype=float)
+    fids = np.empty(count, dtype=np.int64)
+    i = 0
+    for feat in layer.getFeatures():
+        if feedback is not None and feedback.isCanceled():
+            break
+        geom = feat.geometry()
+        if geom.isNull() or geom.isEmpty():
+            raise QgsProcessingException(f"ジオメトリが空の地物があります（fid={feat.id()}）")
+        if transform is not None:
+            geom.transform(transform)
+        point = geom.centroid().asPoint()
+        if i >= count:
+            coords = np.resize(coords, (i + 1024, 2))
+            fids = np.resize(fids, i + 1024)
+        coords[i] = (point.x(), point.y())
+        fids[i] = feat.id()
+        i += 1
+    return coords[:i], fids[:i]
+
+
+def layer_vertices(layer, dest_crs=None, feedback=None):
+    """
+    レイヤの全地物の境界頂点をまとめて取得する（隣接判定用）。
+    戻り値:
+        (頂点座標: numpy.ndarray (m, 2), 頂点が属する地物の番号: numpy.ndarray (m,), 地物数)
+    """
+    transform = None
+    if dest_crs is not None:
+        transform = QgsCoordinateTransform(layer.crs(), dest_crs, QgsProject.instance())
+
+    parts, owners = [], []
+    n = 0
+    for feat in layer.getFeatures():
+        if feedback is not None and feedback.isCanceled():
+            break
+        geom = feat.geometry()
+        if not geom.isNull():
+            if transform is not None:
+                geom.transform(transform)
+            if QgsWkbTypes.isCurvedType(geom.wkbType()):
+                geom.convertToStraightSegment()
+            for xy in _wkb_coordinates(bytes(geom.asWkb()), 0)[0]:
+                parts.append(xy)
+                owners.append(np.full(len(xy), n, dtype=np.int64))
+        n += 1
+    if not parts:
+        return np.empty((0, 2)), np.empty(0, dtype=np.int64), n
+    return np.concatenate(parts), np.concatenate(owners), n
+
+
+def _wkb_coordinates(wkb, offset):
+    """
+    WKB を読み、頂点配列（XYのみ）のリストと読み終えた位置を返す。
+    ISO WKB / EWKB の Z・M 付きの型にも対応する。
+    """
+    endian = "<" if wkb[offset] == 1 else ">"
+    geom_type = struct.unpack_from(endian + "I", wkb, offset + 1)[0]
+    offset += 5
+    has_z = bool(geom_type & 0x80000000)
+    has_m = bool(geom_type & 0x40000000)
+    geom_type &= 0x0FFFFFFF
+    if geom_type >= 1000:
+        has_z = has_z or (geom_type // 1000) in (1, 3)
+        has_m = has_m or (geom_type // 1000) in (2, 3)
+        geom_type %= 1000
+    dims = 2 + has_z + has_m
+
+    def read_points(count, at):
+        values = np.frombuffer(wkb, dtype=endian + "f8", count=count * dims, offset=at)
+        return values.reshape(count, dims)[:, :2], at + 8 * count * dims
+
+    if geom_type == 1:
+        xy, offset = read_points(1, offset)
+        return [xy], offset
+    if geom_type == 2:
+        count = struct.unpack_from(endian + "I", wkb, offset)[0]
+        xy, offset = read_points(count, offset + 4)
+        return [xy], offset
+    if geom_type == 3:
+        rings = struct.unpack_from(endian + "I", wkb, offset)[0]
+        offset += 4
+        result = []
+        for _ in range(rings):
+            count = struct.unpack_from(endian + "I", wkb, offset)[0]
+            xy, offset = read_points(count, offset + 4)
+            result.append(xy)
+        return result, offset
+    if geom_type in (4, 5, 6, 7):
+        count = struct.unpack_from(endian + "I", wkb, offset)[0]
+        offset += 4
+        result = []
+        for _ in range(count):
+            part, offset = _wkb_coordinates(wkb, offset)
+            result.extend(part)
+        return result, offset
+    raise QgsProcessingException(f"未対応のジオメトリ型です（WKB type {geom_type}）")
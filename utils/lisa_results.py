@@ -0,0 +1,183 @@
+"""
+LISA の結果を属性だけで受け渡す。
+R は地物ごとの結果列（Ii, E, Var, Z, Pr_z, クラスタ分類など）だけをタブ区切りで書き出し、
+QGIS 側で入力レイヤのジオメトリ・属性に結合して出力する（または入力レイヤに直接書き込む）。
+ジオメトリは R との間を往復しない。
+"""
+import csv
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsProcessingException)
+
+from .gisa_results import r_string_vector
+from .in_place import AttributeUpdate
+from .sink_writer import BatchedSink
+from .permutation import r_local_permutation_functions, r_local_permutation_code
+
+# R 側で結果に付ける FID 列（バイナリ受け渡しの場合のみ）
+FID_COLUMN = "rss_fid"
+
+
+def r_lisa_results_code(results_path, field_names, n_simulations=0, seed=1):
+    """
+    statistic_type・polygons・listw から各フィールドの局所統計量を計算し、
+    結果列だけを results_path に書き出す R コード。
+    複数フィールドの場合は列名の末尾に "_<フィールド名>" を付ける。
+    n_simulations が 1 以上なら条件付き並べ替えの列（Pr_sim, Z_sim）も追加する。
+    """
+    results_path = results_path.replace("\\", "/")
+    return f"""
+        {r_local_permutation_functions(n_simulations)}
+
+        lisa_fields <- {r_string_vector(field_names)}
+        lisa_results <- NULL
+        for (id_field in lisa_fields) {{
+            if (statistic_type == "Local Moran's I") {{
+                test <- localmoran(polygons[[id_field]], listw, zero.policy = TRUE)
+                quadr <- attr(test, "quadr")
+                results <- data.frame(
+                    Ii = test[, "Ii"],
+                    E = test[, "E.Ii"],
+                    Var = test[, "Var.Ii"],
+                    Z = test[, "Z.Ii"],
+                    Pr_z = test[, "Pr(z != E(Ii))"],
+                    clus_mean = as.character(quadr[, "mean"]),
+                    clus_median = as.character(quadr[, "median"]),
+                    clus_pysal = as.character(quadr[, "pysal"])
+                )
+            }} else if (statistic_type == "Local Getis-Ord G") {{
+                test <- localG(polygons[[id_field]], listw, zero.policy = TRUE)
+                internals <- attr(test, "internals")
+                results <- data.frame(
+                    Gi = as.numeric(test),
+                    Pr_z = internals[, "Pr(z != E(Gi))"]
+                )
+            }} else if (statistic_type == "Local Getis-Ord G*") {{
+                test <- localG(polygons[[id_field]], listw, zero.policy = TRUE)
+                internals <- attr(test, "internals")
+                results <- data.frame(
+                    Gi = as.numeric(test),
+                    Pr_z = internals[, "Pr(z != E(G*i))"],
+                    cluster = as.character(attr(test, "cluster"))
+                )
+            }}
+            {r_local_permutation_code(n_simulations, seed)}
+
+            if (length(lisa_fields) > 1) {{
+                names(results) <- paste0(names(results), "_", id_field)
+            }}
+            lisa_results <- if (is.null(lisa_results)) results else cbind(lisa_results, results)
+        }}
+        results <- lisa_results
+        rss_stage("統計量の計算")
+
+        # 結果列だけを書き出す（FIDが分かる場合は付ける）
+        if ("{FID_COLUMN}" %in% names(polygons)) {{
+            results <- cbind({FID_COLUMN} = polygons[["{FID_COLUMN}"]], results)
+        }}
+        write.table(results, "{results_path}", sep = "\\t", quote = FALSE,
+                    row.names = FALSE, na = "", fileEncoding = "UTF-8")
+        rss_stage("結果の書き出し")
+"""
+
+
+def read_lisa_results(path):
+    """
+    R が書き出した結果を読み込む。
+    戻り値:
+        (列名のリスト, 各列が数値かどうかのリスト, 行のリスト)
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f, delimiter="\t")
+        names = next(reader)
+        rows = list(reader)
+
+    numeric = []
+    for col in range(len(names)):
+        is_number = True
+        for row in rows:
+            if row[col] in ("", "NA", "NaN"):
+                continue
+            try:
+                float(row[col])
+            except ValueError:
+                is_number = False
+                break
+        numeric.append(is_number)
+
+    def convert(value, is_number):
+        if value in ("", "NA"):
+            return None
+        return float(value) if is_number else value
+
+    rows = [[convert(v, numeric[i]) for i, v in enumerate(row)] for row in rows]
+    return names, numeric, rows
+
+
+def write_lisa_sink(algorithm, parameters, context, feedback, layer, output_name, results_path):
+    """
+    入力レイヤの地物に LISA の結果列を結合してシンクに書き出す。
+    結果に FID 列があれば FID で、無ければ地物の順番で対応付ける。
+    戻り値はシンクの ID（出力しない場合は None）。
+    """
+    names, numeric, rows = read_lisa_results(results_path)
+    by_fid = None
+    if names and names[0] == FID_COLUMN:
+        by_fid = {int(row[0]): row[1:] for row in rows}
+        names, numeric = names[1:], numeric[1:]
+    elif len(rows) != layer.featureCount():
+        raise QgsProcessingException("QGIS側とR側で地物数が一致しません")
+
+    # 入力と同じ名前の列は上書きする（R版の attrs$<列名> と同じ）
+    fields = QgsFields(layer.fields())
+    base_count = fields.count()
+    targets = []
+    for name, is_number in zip(names, numeric):
+        index = fields.lookupField(name)
+        if index < 0:
+            fields.append(QgsField(name, QVariant.Double if is_number else QVariant.String))
+            index = fields.count() - 1
+        targets.append(index)
+
+    sink, dest_id = algorithm.parameterAsSink(
+        parameters, output_name, context, fields, layer.wkbType(), layer.crs()
+    )
+    if sink is None:
+        return None
+
+    writer = BatchedSink(sink, feedback, layer.featureCount(), progress=(90, 100))
+    for i, feat in enumerate(layer.getFeatures()):
+        values = by_fid.get(feat.id()) if by_fid is not None else rows[i]
+        attributes = feat.attributes() + [None] * (fields.count() - base_count)
+        if values is not None:
+            for index, value in zip(targets, values):
+                attributes[index] = value
+        out = QgsFeature(fields)
+        out.setGeometry(feat.geometry())
+        out.setAttributes(attributes)
+        if not writer.add(out):
+            break
+    writer.flush()
+    return dest_id
+
+
+def lisa_update(source_layer, layer, results_path):
+    """
+    LISA の結果列を入力レイヤ（source_layer）への更新（in_place.AttributeUpdate）にする。
+    layer は解析に使ったレイヤ（選択地物・サブセットを適用したもの）。
+    """
+    names, numeric, rows = read_lisa_results(results_path)
+    update = AttributeUpdate(source_layer, layer)
+    if names and names[0] == FID_COLUMN:
+        by_fid = {int(row[0]): row[1:] for row in rows}
+        names, numeric = names[1:], numeric[1:]
+        rows = [by_fid.get(fid) for fid in update.view_fids]
+    for col, (name, is_number) in enumerate(zip(names, numeric)):
+        update.add_field(
+            QgsField(name, QVariant.Double if is_number else QVariant.String),
+            (row[col] if row is not None else None for row in rows)
+        )
+    return update
@@ -0,0 +1,146 @@
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsCoordinateTransform,
+                       QgsFeature,
+                       QgsFeatureRequest,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsProject,
+                       QgsWkbTypes)
+
+from .in_place import add_neighbour_columns
+from .neighbours import (edge_distances, neighbour_counts, nb_summary,
+                         remove_duplicate_edges, row_standardised_weights)
+from .sink_writer import BatchedSink
+from .weights_io import DENSE_CSV, format_id, write_weights
+
+
+def layer_field_values(layer, field_name):
+    """ジオメトリを読まずに、指定フィールドの値を地物順に取得する"""
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([field_name], layer.fields())
+    return [feat[field_name] for feat in layer.getFeatures(request)]
+
+
+def write_native_weight_outputs(algorithm, parameters, context, feedback, layer, field_name,
+                                coords, from_idx, to_idx, dest_crs=None, line_filter=None,
+                                use_distance_decay=False, weights_path="", distances=None,
+                                weights_format=DENSE_CSV, profiler=None, poly_update=None):
+    """
+    R版の近接行列アルゴリズムと同じ出力（ラインレイヤ・近接情報付きポリゴン・
+    行基準化ウェイト行列）を QGIS 側だけで作成する。
+    line_filter:
+        None      … すべての辺をラインにする
+        "unique"  … A→B と B→A を1本にまとめる
+        "forward" … from < to の辺のみ（対称な近傍用）
+    distances: 辺ごとの距離が計算済みなら渡す（距離減衰の重みに使う）
+    weights_format: ウェイト行列の書き出し形式（weights_io.WEIGHTS_FORMATS の番号）
+    profiler: profiling.StageProfiler を渡すと出力ごとに段階を記録する
+    poly_update: in_place.AttributeUpdate を渡すと、近接情報付きポリゴンを出力する代わりに
+                 neighbor_ids / neighbor_count の列をその更新に加える
+    """
+    n = len(coords)
+    ids = layer_field_values(layer, field_name)
+    crs = dest_crs if dest_crs is not None else layer.crs()
+    geographic = dest_crs is None and layer.crs().isGeographic()
+    result_dict = {}
+
+    feedback.pushInfo("---- nb summary ----")
+    feedback.pushInfo(nb_summary(n, from_idx))
+    feedback.pushInfo("---- end of summary ----")
+
+    # ライン生成 + 距離付加
+    line_from, line_to = from_idx, to_idx
+    if line_filter == "unique":
+        line_from, line_to = remove_duplicate_edges(from_idx, to_idx)
+    elif line_filter == "forward":
+        keep = from_idx < to_idx
+        line_from, line_to = from_idx[keep], to_idx[keep]
+    line_dist = edge_distances(coords, line_from, line_to, geographic)
+
+    id_field = layer.fields().field(field_name)
+    line_fields = QgsFields()
+    for name in ("from", "to"):
+        field = QgsField(id_field)
+        field.setName(name)
+        line_fields.append(field)
+    line_fields.append(QgsField("distance", QVariant.Double))
+
+    sink, dest_id = algorithm.parameterAsSink(
+        parameters, algorithm.OUTPUT_NODE, context, line_fields, QgsWkbTypes.LineString, crs
+    )
+    if sink:
+        feedback.setProgressText("ラインの書き込み")
+        writer = BatchedSink(sink, feedback, len(line_from), progress=(80, 90))
+        for i, j, d in zip(line_from, line_to, line_dist):
+            feat = QgsFeature(line_fields)
+            feat.setGeometry(QgsGeometry.fromPolylineXY(
+                [QgsPointXY(*coords[i]), QgsPointXY(*coords[j])]
+            ))
+            feat.setAttributes([ids[i], ids[j], float(d)])
+            if not writer.add(feat):
+                break
+        writer.flush()
+        result_dict[algorithm.OUTPUT_NODE] = dest_id
+    else:
+        feedback.pushInfo("ラインレイヤの出力はスキップされました。")
+    if profiler is not None:
+        profiler.mark("ラインの書き込み")
+
+    # ポリゴンに近接情報を付与
+    counts = neighbour_counts(n, from_idx)
+    starts = counts.cumsum() - counts
+    if poly_update is not None:
+        neighbor_ids = (
+            ",".join(format_id(ids[j]) for j in to_idx[starts[i]:starts[i] + counts[i]]) for i in range(n)
+        )
+        add_neighbour_columns(poly_update, neighbor_ids, counts)
+    poly_fields = QgsFields(layer.fields())
+    poly_fields.append(QgsField("neighbor_ids", QVariant.String))
+    poly_fields.append(QgsField("neighbor_count", QVariant.Int))
+
+    sink_poly = None
+    if poly_update is None:
+        sink_poly, poly_id = algorithm.parameterAsSink(
+            parameters, algorithm.OUTPUT_POLYGONS, context, poly_fields, layer.wkbType(), crs
+        )
+    if sink_poly:
+        transform = None
+        if dest_crs is not None:
+            transform = QgsCoordinateTransform(layer.crs(), dest_crs, QgsProject.instance())
+        feedback.setProgressText("ポリゴンの書き込み")
+        writer = BatchedSink(sink_poly, feedback, n, progress=(90, 100))
+        for i, feat in enumerate(layer.getFeatures()):
+            neigh = to_idx[starts[i]:starts[i] + counts[i]]
+            out = QgsFeature(poly_fields)
+            geom = feat.geometry()
+            if transform is not None:
+                geom.transform(transform)
+            out.setGeometry(geom)
+            out.setAttributes(
+                feat.attributes() + [",".join(format_id(ids[j]) for j in neigh), int(counts[i])]
+            )
+            if not writer.add(out):
+                break
+        writer.flush()
+        result_dict[algorithm.OUTPUT_POLYGONS] = poly_id
+    elif poly_update is None:
+        feedback.pushInfo("出力ポリゴンはスキップされました。")
+    if profiler is not None:
+        profiler.mark("ポリゴンの書き込み")
+
+    # 行基準化ウェイト行列
+    if weights_path:
+        if not use_distance_decay:
+            distances = None
+        elif distances is None:
+            distances = edge_distances(coords, from_idx, to_idx, geographic)
+        weights = row_standardised_weights(n, from_idx, distances)
+        write_weights(weights_path, weights_format, ids, from_idx, to_idx, weights,
+                      layer_name=layer.name(), id_field=field_name)
+        if profiler is not None:
+            profiler.mark("ウェイト行列の書き出し")
+
+    return result_dict
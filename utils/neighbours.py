@@ -0,0 +1,330 @@
+"""
+R を使わずに近傍（spdep の nb 相当）を構築するための NumPy / SciPy 実装。
+近傍は (from_idx, to_idx) の2本の整数配列（0始まり、from → to の昇順）で表す。
+"""
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # SciPy が無い環境では NumPy のみで計算する
+    cKDTree = None
+
+# 総当たり計算時に一度に処理する行数
+_CHUNK_ROWS = 2048
+# poly2nb の snap の既定値（R の sqrt(.Machine$double.eps)）
+POLY2NB_DEFAULT_SNAP = float(np.sqrt(np.finfo(float).eps))
+
+
+def knn_edges(coords, k):
+    """
+    spdep の knn2nb(knearneigh(coords, k)) と同じ近傍を返す。
+    各点から自分自身を除いた k 個の最近傍を、インデックスの昇順で並べる。
+    """
+    nn = knn_table(coords, k)
+    nn.sort(axis=1)
+    return np.repeat(np.arange(len(nn), dtype=np.int64), k), nn.ravel()
+
+
+def knn_table(coords, k):
+    """
+    各点から自分自身を除いた k 個の最近傍を、距離の近い順に並べた (n, k) 配列。
+    先頭の j 列を取れば j 近傍になる。
+    """
+    coords = np.asarray(coords, dtype=float)
+    n = len(coords)
+    if k >= n:
+        raise ValueError(f"k ({k}) は地物数 ({n}) より小さくしてください")
+
+    if cKDTree is not None:
+        _, idx = cKDTree(coords).query(coords, k=k + 1, workers=-1)
+    else:
+        idx = _brute_force_knn(coords, k + 1)
+    idx = np.asarray(idx, dtype=np.int64).reshape(n, k + 1)
+
+    # 自分自身を除く（重複点で自分が含まれなかった行は最も遠い候補を除く）
+    is_self = idx == np.arange(n)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    return idx[~is_self].reshape(n, k)
+
+
+def _brute_force_knn(coords, k):
+    n = len(coords)
+    result = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, _CHUNK_ROWS):
+        block = coords[start:start + _CHUNK_ROWS]
+        d2 = ((block[:, None, :] - coords[None, :, :]) ** 2).sum(axis=2)
+        part = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(d2, part, axis=1).argsort(axis=1)
+        result[start:start + len(block)] = np.take_along_axis(part, order, axis=1)
+    return result
+
+
+def distance_band_edges(coords, d1, d2):
+    """
+    spdep の dnearneigh(coords, d1, d2) と同じ近傍（d1 <= 距離 <= d2、自分自身は除く）を返す。
+    半径 d2 の検索は KD-tree（SciPy が無い場合は一様グリッド）で一括して行う。
+    戻り値:
+        (from_idx, to_idx, 距離) … nbdists と同じ並び
+    """
+    coords = np.asarray(coords, dtype=float)
+    i, j, dist = radius_pairs(coords, d2)
+    keep = (dist >= d1) & (dist <= d2)
+    i, j, dist = i[keep], j[keep], dist[keep]
+
+    # 対称にして from → to の昇順に並べる
+    from_idx = np.concatenate([i, j])
+    to_idx = np.concatenate([j, i])
+    dist = np.concatenate([dist, dist])
+    order = np.lexsort((to_idx, from_idx))
+    return from_idx[order], to_idx[order], dist[order]
+
+
+def radius_pairs(coords, r):
+    """
+    距離 r 以内の点の組（i < j、各組1回）と距離を返す。
+    KD-tree（SciPy が無い場合は一様グリッド）で一括して検索する。
+    """
+    coords = np.asarray(coords, dtype=float)
+    if r <= 0 or len(coords) < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+
+    if cKDTree is not None:
+        pairs = cKDTree(coords).query_pairs(r=r, output_type="ndarray")
+        i, j = pairs[:, 0].astype(np.int64), pairs[:, 1].astype(np.int64)
+    else:
+        i, j = _grid_pairs(coords, r)
+    dist = np.hypot(coords[j, 0] - coords[i, 0], coords[j, 1] - coords[i, 1])
+    return i, j, dist
+
+
+def _grid_pairs(coords, r):
+    """一様グリッドで半径 r 以内の点の組（各組1回）を求める"""
+    n = len(coords)
+    cell = np.floor((coords - coords.min(axis=0)) / r).astype(np.int64)
+    # r が小さいとセル番号の積があふれるので、実在する x・y のセル番号の順位をキーにする
+    ux = np.unique(cell[:, 0])
+    uy = np.unique(cell[:, 1])
+    key = np.searchsorted(ux, cell[:, 0]) * len(uy) + np.searchsorted(uy, cell[:, 1])
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+
+    found_i, found_j = [], []
+    # 自セルと、半平面側の隣接4セルだけを調べれば全ての組を1回ずつ数えられる
+    for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        for start in range(0, n, _CHUNK_ROWS * 16):
+            rows = np.arange(start, min(start + _CHUNK_ROWS * 16, n))
+            tx = cell[rows, 0] + dx
+            ty = cell[rows, 1] + dy
+            px = np.minimum(np.searchsorted(ux, tx), len(ux) - 1)
+            py = np.minimum(np.searchsorted(uy, ty), len(uy) - 1)
+            exists = (ux[px] == tx) & (uy[py] == ty)
+            target = px * len(uy) + py
+            lo = np.searchsorted(sorted_key, target, "left")
+            cnt = np.where(exists, np.searchsorted(sorted_key, target, "right") - lo, 0)
+            i = np.repeat(rows, cnt)
+            offset = np.arange(cnt.sum()) - np.repeat(cnt.cumsum() - cnt, cnt)
+            j = order[np.repeat(lo, cnt) + offset]
+            if dx == 0 and dy == 0:
+                keep = j > i
+                i, j = i[keep], j[keep]
+            d2 = (coords[j, 0] - coords[i, 0]) ** 2 + (coords[j, 1] - coords[i, 1]) ** 2
+            keep = d2 <= r * r
+            found_i.append(i[keep])
+            found_j.append(j[keep])
+    return np.concatenate(found_i), np.concatenate(found_j)
+
+
+def contiguity_edges(xy, owner, queen=True, snap=0.0):
+    """
+    spdep の poly2nb と同じ隣接関係を求める。
+    xy: 全地物の境界頂点 (m, 2)、owner: 各頂点が属する地物の番号 (m,)
+    queen=True  … 境界点を1つ以上共有すれば隣接
+    queen=False … 境界点を2つ以上共有すれば隣接（poly2nb の Rook と同じ基準）
+    距離 snap 以内の頂点を同一点とみなす。snap <= 0 のときは poly2nb の既定値
+    （POLY2NB_DEFAULT_SNAP）を使う。
+    """
+    xy = np.asarray(xy, dtype=float)
+    owner = np.asarray(owner, dtype=np.int64)
+    if len(xy) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    if snap <= 0:
+        snap = POLY2NB_DEFAULT_SNAP
+
+    # 同じ地物内で snap 以内に重なる頂点（閉じ点など）は1つにまとめる
+    key = np.floor((xy - xy.min(axis=0)) / snap).astype(np.int64)
+    _, first = np.unique(np.column_stack([owner, key]), axis=0, return_index=True)
+    xy, owner, key = xy[first], owner[first], key[first]
+    vi, vj = _grid_pairs(xy, snap)
+    keep = owner[vi] != owner[vj]
+    vi, vj = vi[keep], vj[keep]
+    a, b = owner[vi], owner[vj]
+    low = np.minimum(a, b)
+    high = np.maximum(a, b)
+    # 1つの頂点が相手の複数の頂点と snap 以内にあっても共有点は1つと数える
+    # （番号の小さい地物側の頂点のセルで (i, j, セル) の重複を除く）
+    cell = np.where((a <= b)[:, None], key[vi], key[vj])
+    triples = np.unique(np.column_stack([low, high, cell]), axis=0)
+
+    pairs, shared = np.unique(triples[:, :2], axis=0, return_counts=True)
+    pairs = pairs[shared >= (1 if queen else 2)]
+
+    from_idx = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    to_idx = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    order = np.lexsort((to_idx, from_idx))
+    return from_idx[order], to_idx[order]
+
+
+def remove_duplicate_edges(from_idx, to_idx):
+    """A→B と B→A の組を1本にする（先に現れた方を残す）"""
+    low = np.minimum(from_idx, to_idx)
+    high = np.maximum(from_idx, to_idx)
+    key = low * (int(max(from_idx.max(initial=0), to_idx.max(initial=0))) + 1) + high
+    _, first = np.unique(key, return_index=True)
+    first.sort()
+    return from_idx[first], to_idx[first]
+
+
+def edge_distances(coords, from_idx, to_idx, geographic=False):
+    """
+    辺ごとの中心点間距離。
+    geographic=True のときは経緯度として球面距離（m, sf/s2 と同じ地球半径）を返す。
+    """
+    a = coords[from_idx]
+    b = coords[to_idx]
+    if not geographic:
+        return np.hypot(b[:, 0] - a[:, 0], b[:, 1] - a[:, 1])
+    lon1, lat1, lon2, lat2 = map(np.radians, (a[:, 0], a[:, 1], b[:, 0], b[:, 1]))
+    h = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def neighbour_counts(n, from_idx):
+    return np.bincount(from_idx, minlength=n)
+
+
+def row_standardised_weights(n, from_idx, distances=None):
+    """
+    nb2listw(style = "W") の重み。distances を渡すと 1/d を行基準化する。
+    from_idx は昇順に並んでいること。
+    """
+    if distances is None:
+        g = np.ones(len(from_idx))
+    else:
+        g = 1.0 / distances
+    row_sum = np.bincount(from_idx, weights=g, minlength=n)
+    return g / row_sum[from_idx]
+
+
+def nb_summary(n, from_idx):
+    """summary(nb) の主要な値を文字列で返す"""
+    counts = neighbour_counts(n, from_idx)
+    links = int(counts.sum())
+    lines = [
+        "Neighbour list object:",
+        f"Number of regions: {n}",
+        f"Number of nonzero links: {links}",
+        f"Percentage nonzero weights: {100.0 * links / (n * n) if n else 0:.6g}",
+        f"Average number of links: {links / n if n else 0:.6g}",
+    ]
+    if (counts == 0).any():
+        lines.append(f"{int((counts == 0).sum())} regions with no links")
+    return "\n".join(lines)
+
+
+def write_edges(path, from_idx, to_idx):
+    """R に渡すため、辺を 1始まりの int32（リトルエンディアン）で書き出す"""
+    pairs = np.empty((len(from_idx), 2), dtype="<i4")
+    pairs[:, 0] = from_idx + 1
+    pairs[:, 1] = to_idx + 1
+    pairs.tofile(path)
+
+
+def r_read_edges_code(path, n_edges, n_features):
+    """write_edges で書き出した辺から spdep の nb オブジェクトを作る R コード"""
+    path = path.replace("\\", "/")
+    return f"""
+        if (nrow(polygons) != {n_features}) stop("QGIS側とR側で地物数が一致しません")
+        nb_pairs <- matrix(readBin("{path}", "integer", n = {2 * n_edges}, size = 4, endian = "little"), ncol = 2, byrow = TRUE)
+        nb <- split(nb_pairs[, 2], factor(nb_pairs[, 1], levels = seq_len(nrow(polygons))))
+        nb <- lapply(nb, function(x) if (length(x) == 0) 0L else sort(as.integer(x)))
+        names(nb) <- NULL
+        class(nb) <- "nb"
+        attr(nb, "region.id") <- as.character(seq_len(nrow(polygons)))
+        attr(nb, "sym") <- is.symmetric.nb(nb, verbose = FALSE, force = TRUE)
+"""
+
+
+def r_edge_lines_code(output_path, line_filter=None):
+    """
+    nb の辺を中心点間のラインにして書き出す R コード（辺ごとの R 関数呼び出しは行わない）。
+    polygons, nb, id_values, centroids が定義されていること。
+    line_filter は write_native_weight_outputs と同じ（None / "unique" / "forward"）。
+    """
+    output_path = output_path.replace("\\", "/")
+    if line_filter == "unique":
+        r_filter = "keep <- !duplicated(pmin(edge_from, edge_to) * (length(nb) + 1) + pmax(edge_from, edge_to))"
+    elif line_filter == "forward":
+        r_filter = "keep <- edge_from < edge_to"
+    else:
+        r_filter = "keep <- rep(TRUE, length(edge_from))"
+    return f"""
+        # edge list（近傍なしを表す 0 は除く）
+        edge_from <- rep(seq_along(nb), lengths(nb))
+        edge_to <- unlist(nb, use.names = FALSE)
+        edge_from <- edge_from[edge_to > 0]
+        edge_to <- edge_to[edge_to > 0]
+        {r_filter}
+        edge_from <- edge_from[keep]
+        edge_to <- edge_to[keep]
+
+        # ライン生成 + 距離付加（座標行列から一括で作成）
+        centroid_xy <- st_coordinates(centroids)
+        x1 <- centroid_xy[edge_from, 1]
+        y1 <- centroid_xy[edge_from, 2]
+        x2 <- centroid_xy[edge_to, 1]
+        y2 <- centroid_xy[edge_to, 2]
+        if (isTRUE(st_is_longlat(polygons))) {{
+            edge_dist <- as.numeric(st_distance(st_geometry(centroids)[edge_from], st_geometry(centroids)[edge_to], by_element = TRUE))
+        }} else {{
+            edge_dist <- sqrt((x2 - x1)^2 + (y2 - y1)^2)
+        }}
+        line_wkt <- sprintf("LINESTRING (%.17g %.17g, %.17g %.17g)", x1, y1, x2, y2)
+
+        # ラインレイヤ生成
+        line_sf <- st_sf(
+            from = id_values[edge_from],
+            to = id_values[edge_to],
+            distance = edge_dist,
+            geometry = st_as_sfc(line_wkt, crs = st_crs(polygons))
+        )
+        st_write(line_sf, "{output_path}", delete_dsn = TRUE)
+        rss_stage("ラインの書き出し")
+"""
+
+
+def r_neighbour_columns_code(output_path):
+    """
+    ポリゴンに付ける近接情報（neighbor_ids, neighbor_count）だけをタブ区切りで書き出す R コード
+    （入力レイヤを更新する場合。ジオメトリは書き出さない）。
+    """
+    output_path = output_path.replace("\\", "/")
+    return f"""
+        write.table(data.frame(neighbor_ids = neighbor_ids, neighbor_count = neighbor_count),
+                    "{output_path}", sep = "\\t", quote = FALSE, row.names = FALSE, na = "",
+                    fileEncoding = "UTF-8")
+"""
+
+
+def read_neighbour_columns(path):
+    """r_neighbour_columns_code の出力を (neighbor_ids のリスト, neighbor_count のリスト) として読む"""
+    ids, counts = [], []
+    with open(path, encoding="utf-8") as f:
+        next(f)
+        for line in f:
+            text, _, count = line.rstrip("\r\n").rpartition("\t")
+            ids.append(text)
+            counts.append(int(count))
+    return ids, counts
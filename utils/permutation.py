@@ -0,0 +1,180 @@
+"""
+並べ替え（モンテカルロ）検定の R コード。
+並べ替えは固定サイズのチャンクに分け、r_parallel の共通関数で複数コアに分散する。
+"""
+from .r_parallel import R_PARALLEL_CODE, r_workers_code
+
+# 1チャンクあたりの並べ替え回数
+PERMUTATIONS_PER_CHUNK = 100
+
+R_GLOBAL_PERMUTATION_CODE = r"""
+# 並べ替え1チャンク分を計算する関数を作る。
+# PSOCK クラスタに入力全体を送らないよう、環境はグローバル環境にする
+rss_global_chunk_fun <- function(x, listw, statistic_type, nsim, seeds) {
+    n <- length(x)
+    S0 <- Szero(listw)
+    if (statistic_type == "Moran's I") {
+        stat_fun <- function(v) moran(v, listw, n, S0, zero.policy = TRUE)$I
+    } else if (statistic_type == "Geary's C") {
+        stat_fun <- function(v) geary(v, listw, n, n - 1, S0, zero.policy = TRUE)$C
+    } else {
+        # globalG.test と同じ G（並べ替えで分母は変わらない）
+        stat_fun <- function(v) sum(v * lag.listw(listw, v, zero.policy = TRUE)) / (sum(v)^2 - sum(v^2))
+    }
+    chunk <- %(chunk)d
+    list(
+        stat = stat_fun,
+        chunk = function(i) {
+            assign(".Random.seed", seeds[[i]], envir = globalenv())
+            sims <- min(chunk, nsim - (i - 1) * chunk)
+            vapply(seq_len(sims), function(j) stat_fun(sample(x)), numeric(1))
+        }
+    )
+}
+environment(rss_global_chunk_fun) <- globalenv()
+
+rss_global_permutation <- function(x, listw, statistic_type, nsim, seed, workers) {
+    n_chunks <- ceiling(nsim / %(chunk)d)
+    fun <- rss_global_chunk_fun(x, listw, statistic_type, nsim, rss_chunk_seeds(seed, n_chunks))
+    sims <- unlist(rss_parallel_chunks(n_chunks, fun$chunk, workers, c(60, 95), "並べ替え検定"))
+
+    observed <- fun$stat(x)
+    # Geary's C は値が小さいほど正の空間自己相関
+    if (statistic_type == "Geary's C") {
+        p_value <- (sum(sims <= observed) + 1) / (nsim + 1)
+        alternative <- "less (positive spatial autocorrelation)"
+    } else {
+        p_value <- (sum(sims >= observed) + 1) / (nsim + 1)
+        alternative <- "greater"
+    }
+    list(statistic = observed, p_value = p_value, nsim = nsim,
+         rank = rank(c(sims, observed))[nsim + 1], alternative = alternative,
+         sims_mean = mean(sims), sims_var = var(sims), seed = seed, workers = workers)
+}
+
+rss_permutation_text <- function(perm, statistic_type) {
+    c(
+        sprintf("Monte-Carlo simulation of %%s", statistic_type),
+        sprintf("number of simulations + 1: %%d", perm$nsim + 1),
+        sprintf("statistic = %%.6g, observed rank = %%g, p-value = %%.6g", perm$statistic, perm$rank, perm$p_value),
+        sprintf("alternative hypothesis: %%s", perm$alternative),
+        sprintf("mean of permutations = %%.6g, variance of permutations = %%.6g", perm$sims_mean, perm$sims_var),
+        sprintf("seed = %%d, workers = %%d", perm$seed, perm$workers)
+    )
+}
+""" % {"chunk": PERMUTATIONS_PER_CHUNK}
+
+
+def r_global_permutation_functions(n_simulations):
+    """GISA の並べ替え検定の関数定義（n_simulations が 0 の場合は空）"""
+    if n_simulations <= 0:
+        return ""
+    return R_PARALLEL_CODE + R_GLOBAL_PERMUTATION_CODE
+
+
+def r_global_permutation_code(n_simulations, seed):
+    """
+    GISA の並べ替え検定を行い、結果を test_result に、疑似 p 値を perm_p_value に入れる R コード。
+    r_global_permutation_functions の定義と
+    polygons・id_field・listw・statistic_type・test_result が定義されていること。
+    n_simulations が 0 の場合は perm_p_value を NA にするだけ。
+    """
+    if n_simulations <= 0:
+        return "perm_p_value <- NA_real_"
+    return f"""
+            perm <- rss_global_permutation(polygons[[id_field]], listw, statistic_type,
+                                           {int(n_simulations)}, {int(seed)}, {r_workers_code()})
+            test_result <- c(test_result, "", rss_permutation_text(perm, statistic_type))
+            perm_p_value <- perm$p_value
+"""
+
+# 条件付き並べ替え（LISA）で1チャンクあたりに扱う地物数
+ROWS_PER_CHUNK = 1000
+
+R_LOCAL_PERMUTATION_CODE = r"""
+# 条件付き並べ替え（地物 i の値を固定し、残り n - 1 個の値を近傍に割り当て直す）。
+# チャンク内の全地物で同じ並べ替え（n - 1 個から kmax 個の非復元抽出）を使い、
+# 行列積でまとめて計算する。環境はグローバル環境にする（rss_global_chunk_fun と同じ）
+rss_local_chunk_fun <- function(x, listw, statistic_type, nsim, seeds) {
+    n <- length(x)
+    if (statistic_type == "Local Moran's I") {
+        v <- x - mean(x)
+        scale <- v / (sum(v^2) / n)
+    } else if (statistic_type == "Local Getis-Ord G") {
+        v <- x
+        scale <- 1 / (sum(x) - x)
+    } else {
+        v <- x
+        scale <- rep(1 / sum(x), n)
+    }
+    neighbours <- listw$neighbours
+    weights <- listw$weights
+    rows_per_chunk <- %(rows)d
+    function(i) {
+        assign(".Random.seed", seeds[[i]], envir = globalenv())
+        rows <- ((i - 1) * rows_per_chunk + 1):min(n, i * rows_per_chunk)
+        # 自分自身（G* の include.self）は固定し、それ以外の近傍数を数える
+        card <- vapply(rows, function(r) sum(neighbours[[r]] > 0 & neighbours[[r]] != r), integer(1))
+        kmax <- max(card, 0L)
+        out <- matrix(NA_real_, length(rows), 2)
+        if (kmax == 0) return(out)
+        rids <- matrix(unlist(lapply(seq_len(nsim), function(s) sample.int(n - 1, kmax))),
+                       nrow = nsim, byrow = TRUE)
+        for (j in seq_along(rows)) {
+            k <- card[j]
+            if (k == 0) next
+            r <- rows[j]
+            nb_r <- neighbours[[r]]
+            w_r <- weights[[r]]
+            self <- nb_r == r
+            fixed <- sum(w_r[self]) * v[r]
+            w_other <- w_r[!self]
+            observed <- scale[r] * (fixed + sum(w_other * v[nb_r[!self]]))
+            # 自分を除いた番号に対応させる
+            idx <- rids[, seq_len(k), drop = FALSE]
+            idx <- idx + (idx >= r)
+            sims <- scale[r] * (fixed + drop(matrix(v[idx], nsim, k) %%*%% w_other))
+            larger <- sum(sims >= observed)
+            larger <- min(larger, nsim - larger)
+            # 並べ替えた統計量が一定（近傍の値がすべて同じなど）なら Z 値は求めない（localmoran_perm と同じ）
+            sd_sims <- sd(sims)
+            z <- if (is.na(sd_sims) || sd_sims == 0) NA_real_ else (observed - mean(sims)) / sd_sims
+            out[j, ] <- c((larger + 1) / (nsim + 1), z)
+        }
+        out
+    }
+}
+environment(rss_local_chunk_fun) <- globalenv()
+
+rss_local_permutation <- function(x, listw, statistic_type, nsim, seed, workers) {
+    n_chunks <- ceiling(length(x) / %(rows)d)
+    chunk_fun <- rss_local_chunk_fun(x, listw, statistic_type, nsim, rss_chunk_seeds(seed, n_chunks))
+    perm <- do.call(rbind, rss_parallel_chunks(n_chunks, chunk_fun, workers, c(60, 90), "条件付き並べ替え"))
+    colnames(perm) <- c("Pr_sim", "Z_sim")
+    perm
+}
+""" % {"rows": ROWS_PER_CHUNK}
+
+
+def r_local_permutation_functions(n_simulations):
+    """LISA の条件付き並べ替えの関数定義（n_simulations が 0 の場合は空）"""
+    if n_simulations <= 0:
+        return ""
+    return R_PARALLEL_CODE + R_LOCAL_PERMUTATION_CODE
+
+
+def r_local_permutation_code(n_simulations, seed):
+    """
+    LISA の条件付き並べ替えを行い、疑似 p 値（折り返し）と Z 値を results に追加する R コード。
+    r_local_permutation_functions の定義と
+    polygons・id_field・listw・statistic_type・results が定義されていること。
+    n_simulations が 0 の場合は何もしない。
+    """
+    if n_simulations <= 0:
+        return ""
+    return f"""
+            perm <- rss_local_permutation(polygons[[id_field]], listw, statistic_type,
+                                          {int(n_simulations)}, {int(seed)}, {r_workers_code()})
+            results$Pr_sim <- perm[, "Pr_sim"]
+            results$Z_sim <- perm[, "Z_sim"]
+"""
@@ -0,0 +1,160 @@
+"""
+アルゴリズムの処理段階ごとの経過時間・メモリを記録する。
+Python 側は mark(名前) を呼ぶたびに、前回の mark からの区間を1段階として記録する。
+R 側は rss_progress / rss_stage の呼び出しごとに、経過時間と R のメモリ使用量の最大値
+（gc の max used）を "##STAGE##" マーカーで返し、r_session 経由で add_r_stage に渡される。
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from qgis.core import (QgsSettings,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFileDestination)
+
+# プロファイル出力のパラメータ名（全アルゴリズム共通）
+OUTPUT_PROFILE = 'OUTPUT_PROFILE'
+
+
+def add_profile_parameter(algorithm):
+    """段階ごとのプロファイル（JSON）の出力パラメータを詳細設定に追加する"""
+    param = QgsProcessingParameterFileDestination(
+        name=OUTPUT_PROFILE,
+        description='Stage profile (JSON)',
+        fileFilter='JSON (*.json)',
+        optional=True,
+        createByDefault=False
+    )
+    param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+    algorithm.addParameter(param)
+
+
+def stage_profiler(algorithm, parameters, context, feedback):
+    """
+    アルゴリズム用のプロファイラを返す。
+    プロファイルの出力先を指定した場合か、設定 RRunner/ProfileStages が true の場合のみ記録する。
+    """
+    path = algorithm.parameterAsFile(parameters, OUTPUT_PROFILE, context)
+    enabled = bool(path) or QgsSettings().value("RRunner/ProfileStages", False, type=bool)
+    return StageProfiler(algorithm.name(), feedback, enabled, path)
+
+
+def memory_mb():
+    """
+    QGIS プロセスの (現在の使用量, 最大使用量) を MB で返す。取得できない値は None。
+    """
+    if sys.platform.startswith("linux"):
+        values = {}
+        try:
+            with open("/proc/self/status", encoding="ascii") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in ("VmRSS", "VmHWM"):
+                        values[key] = int(value.split()[0]) / 1024
+        except OSError:
+            pass
+        return values.get("VmRSS"), values.get("VmHWM")
+    if os.name == "nt":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / 2 ** 20, counters.PeakWorkingSetSize / 2 ** 20
+        return None, None
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # macOS の ru_maxrss はバイト単位
+    return None, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+
+
+class StageProfiler:
+    """処理段階ごとの経過時間とメモリの記録"""
+
+    def __init__(self, algorithm_name, feedback=None, enabled=True, output_path=""):
+        self.algorithm_name = algorithm_name
+        self.feedback = feedback
+        self.enabled = enabled
+        self.output_path = output_path
+        self.stages = []
+        self._started = datetime.now()
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, name):
+        """前回の mark（または開始）からここまでを1段階として記録する"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        rss, peak = memory_mb()
+        self.stages.append({
+            "name": name,
+            "source": "qgis",
+            "seconds": now - self._last,
+            "rss_mb": rss,
+            "peak_rss_mb": peak,
+        })
+        self._last = now
+
+    def add_r_stage(self, name, seconds, peak_mb):
+        """R スクリプト内のマーカーで区切られた段階を記録する（mark の区間とは重複する）"""
+        if self.enabled:
+            self.stages.append({
+                "name": name,
+                "source": "R",
+                "seconds": seconds,
+                "r_peak_mb": peak_mb,
+            })
+
+    def report(self):
+        """段階ごとの内訳をログに出す"""
+        if self.feedback is None:
+            return
+        self.feedback.pushInfo("=== Stage profile ===")
+        for stage in self.stages:
+            if stage["source"] == "R":
+                memory = f"R max {stage['r_peak_mb']:.1f} MB"
+                label = f"  R: {stage['name']}"
+            else:
+                memory = "" if stage["peak_rss_mb"] is None else f"peak {stage['peak_rss_mb']:.1f} MB"
+                label = stage["name"]
+            self.feedback.pushInfo(f"{label:<32} {stage['seconds']:9.3f} s  {memory}")
+        self.feedback.pushInfo(f"{'合計':<32} {time.perf_counter() - self._start:9.3f} s")
+        self.feedback.pushInfo("=============================")
+
+    def finish(self, result_dict):
+        """
+        内訳をログに出し、出力先が指定されていれば JSON に書き出す。
+        結果の辞書（OUTPUT_PROFILE を追加したもの）を返す。
+        """
+        if not self.enabled:
+            return result_dict
+        self.report()
+        if self.output_path:
+            profile = {
+                "algorithm": self.algorithm_name,
+                "started": self._started.isoformat(timespec="seconds"),
+                "total_seconds": time.perf_counter() - self._start,
+                "stages": self.stages,
+            }
+            with open(self.output_path, "w", encoding="utf-8") as f:
+                json.dump(profile, f, ensure_ascii=False, indent=2)
+            result_dict[OUTPUT_PROFILE] = self.output_path
+        return result_dict
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import subprocess
+
+from qgis.core import QgsSettings, QgsProcessingException
+
+from .scratch import scratch_path
+
+# 生成するRスクリプトで使用するパッケージ
+REQUIRED_PACKAGES = ["sf", "spdep", "dplyr", "classInt"]
+
+# 確認済みのキー（QGIS起動中のキャッシュ）
+_verified_keys = set()
+
+# ユーザーライブラリを .libPaths に追加する共通コード
+R_USER_LIB_CODE = """
+user_lib <- Sys.getenv("R_LIBS_USER")
+if (user_lib != "" && dir.exists(user_lib)) {
+    .libPaths(user_lib)
+}
+"""
+
+
+def _r_vector(packages):
+    return "c(" + ", ".join(f'"{pkg}"' for pkg in packages) + ")"
+
+
+def r_library_code(packages=REQUIRED_PACKAGES):
+    """
+    生成スクリプトの先頭に埋め込むパッケージ読み込みコードを返す。
+    インストール確認は行わず、見つからなければ即座にエラーにする。
+    """
+    return R_USER_LIB_CODE + f"""
+for (pkg in {_r_vector(packages)}) {{
+    loaded <- suppressPackageStartupMessages(
+        tryCatch({{ library(pkg, character.only = TRUE); TRUE }}, error = function(e) FALSE)
+    )
+    if (!loaded) {{
+        stop(sprintf("Rパッケージ '%s' が読み込めません。設定ダイアログからパッケージを確認・インストールしてください。", pkg))
+    }}
+}}
+rss_stage("パッケージ読み込み")
+"""
+
+
+def _normalize(rscript_path):
+    return os.path.normcase(os.path.abspath(rscript_path))
+
+
+def query_library_paths(rscript_path):
+    """Rを起動して .libPaths()（生成スクリプトと同じくユーザーライブラリを加えたもの）を返す"""
+    r_code = R_USER_LIB_CODE + """
+cat(.libPaths(), sep = "\\n")
+"""
+    result = _run_r_code(rscript_path, r_code)
+    if result.returncode != 0:
+        raise QgsProcessingException(f"Rのライブラリパスの取得中にエラー:\n{result.stderr}")
+    return "\n".join(line.strip() for line in result.stdout.splitlines() if line.strip())
+
+
+def save_library_paths(rscript_path, library_paths=None):
+    """
+    Rscriptのパスを保存するときに呼び、.libPaths() の結果を設定に保存する。
+    library_paths を省略するとRを起動して取得する。
+    """
+    if library_paths is None:
+        library_paths = query_library_paths(rscript_path)
+    settings = QgsSettings()
+    settings.setValue("RRunner/LibPaths", library_paths)
+    settings.setValue("RRunner/LibPathsRscript", _normalize(rscript_path))
+
+
+def package_cache_key(rscript_path):
+    """
+    Rscriptのパスと、その .libPaths() からキャッシュキーを作る。
+    .libPaths() は設定に保存したものを使う。保存されていなければ（Rscriptのパスを
+    設定ダイアログ以外で変更した場合など）1回だけRを起動して取得する。
+    """
+    settings = QgsSettings()
+    if settings.value("RRunner/LibPathsRscript", "") != _normalize(rscript_path):
+        save_library_paths(rscript_path)
+    source = "|".join([
+        _normalize(rscript_path),
+        settings.value("RRunner/LibPaths", "")
+    ])
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+
+
+def _run_r_code(rscript_path, r_code):
+    r_script_file = scratch_path("packages_", ".R")
+    with open(r_script_file, "w", encoding="utf-8") as f:
+        f.write(r_code)
+    try:
+        return subprocess.run([rscript_path, r_script_file], capture_output=True, text=True)
+    finally:
+        os.remove(r_script_file)
+
+
+def _stream_r_code(rscript_path, r_code, feedback):
+    """
+    Rスクリプトを実行し、出力を1行ずつ feedback に送る。戻り値は終了コード。
+    キャンセルされた場合はRを終了する。
+    """
+    r_script_file = scratch_path("packages_", ".R")
+    with open(r_script_file, "w", encoding="utf-8") as f:
+        f.write(r_code)
+    try:
+        process = subprocess.Popen(
+            [rscript_path, r_script_file],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+        )
+        for line in process.stdout:
+            feedback.pushConsoleInfo(line.rstrip())
+            if feedback.isCanceled():
+                process.terminate()
+                break
+        return process.wait()
+    finally:
+        os.remove(r_script_file)
+
+
+def find_missing_packages(rscript_path, packages=REQUIRED_PACKAGES):
+    """Rを起動して未インストールのパッケージ名のリストを返す"""
+    r_code = R_USER_LIB_CODE + f"""
+pkgs <- {_r_vector(packages)}
+ok <- vapply(pkgs, requireNamespace, logical(1), quietly = TRUE)
+cat(pkgs[!ok], sep = "\\n")
+"""
+    result = _run_r_code(rscript_path, r_code)
+    if result.returncode != 0:
+        raise QgsProcessingException(f"Rパッケージの確認中にエラー:\n{result.stderr}")
+    return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+
+def install_packages(rscript_path, packages, feedback=None):
+    """
+    ユーザーライブラリにパッケージをインストールする。
+    feedback を渡すと、パッケージごとに進捗を更新し、Rの出力を1行ずつ送る。
+    戻り値はRの終了コード（0 以外があればその値）。
+    """
+    returncode = 0
+    for i, pkg in enumerate(packages):
+        r_code = f"""
+user_lib <- Sys.getenv("R_LIBS_USER")
+if (!dir.exists(user_lib)) {{
+    dir.create(user_lib, recursive = TRUE)
+}}
+.libPaths(user_lib)
+install.packages({_r_vector([pkg])}, repos = "https://cloud.r-project.org", lib = user_lib)
+"""
+        if feedback is None:
+            result = _run_r_code(rscript_path, r_code)
+            returncode = returncode or result.returncode
+            continue
+        if feedback.isCanceled():
+            break
+        feedback.pushInfo(f"Rパッケージ '{pkg}' をインストールしています（{i + 1}/{len(packages)}）")
+        returncode = returncode or _stream_r_code(rscript_path, r_code, feedback)
+        feedback.setProgress(100 * (i + 1) / len(packages))
+    return returncode
+
+
+def mark_verified(rscript_path):
+    key = package_cache_key(rscript_path)
+    _verified_keys.add(key)
+    QgsSettings().setValue(f"RRunner/PackagesVerified/{key}", True)
+
+
+def clear_verified():
+    _verified_keys.clear()
+    QgsSettings().remove("RRunner/PackagesVerified")
+
+
+def is_verified(rscript_path):
+    key = package_cache_key(rscript_path)
+    if key in _verified_keys:
+        return True
+    if QgsSettings().value(f"RRunner/PackagesVerified/{key}", False, type=bool):
+        _verified_keys.add(key)
+        return True
+    return False
+
+
+def ensure_r_packages(rscript_path):
+    """
+    必要なRパッケージが揃っているかを確認する。
+    結果はRscriptのパスと .libPaths() ごとにキャッシュされ、2回目以降はRを起動しない。
+    """
+    if is_verified(rscript_path):
+        return
+    missing = find_missing_packages(rscript_path)
+    if missing:
+        raise QgsProcessingException(
+            "必要なRパッケージがインストールされていません: " + ", ".join(missing) +
+            "\n[R Spatial Statistics] → [Setting] からインストールしてください。"
+        )
+    mark_verified(rscript_path)
@@ -0,0 +1,74 @@
+from qgis.core import QgsSettings
+
+from .r_session import max_r_processes
+
+# 並列計算の共通関数（R の parallel パッケージ）。
+# 仕事を固定サイズのチャンクに分け、チャンクごとに L'Ecuyer-CMRG の乱数ストリームを割り当てる。
+# チャンクの分け方はワーカー数に依存しないため、同じシードなら何コアで実行しても同じ結果になる。
+R_PARALLEL_CODE = r"""
+rss_workers <- function(requested = 0, max_processes = 1) {
+    if (requested > 0) return(as.integer(requested))
+    # 自動: 同時に動く R プロセス（RRunner/MaxRProcesses）で論理コアを分け合う
+    cores <- parallel::detectCores()
+    if (is.na(cores)) cores <- 1L
+    max(1L, as.integer(cores) %/% as.integer(max_processes))
+}
+
+rss_chunk_seeds <- function(seed, n_chunks) {
+    old_kind <- RNGkind("L'Ecuyer-CMRG")
+    on.exit(RNGkind(old_kind[1], old_kind[2], old_kind[3]))
+    set.seed(seed)
+    seeds <- vector("list", n_chunks)
+    s <- .Random.seed
+    for (i in seq_len(n_chunks)) {
+        seeds[[i]] <- s
+        s <- parallel::nextRNGStream(s)
+    }
+    seeds
+}
+
+rss_parallel_chunks <- function(n_chunks, chunk_fun, workers, progress = c(50, 90), label = "") {
+    old_kind <- RNGkind()
+    on.exit(RNGkind(old_kind[1], old_kind[2], old_kind[3]), add = TRUE)
+    cl <- NULL
+    if (workers > 1 && .Platform$OS.type == "windows") {
+        # Windows はフォークできないため PSOCK クラスタを使う
+        cl <- parallel::makeCluster(workers)
+        on.exit(parallel::stopCluster(cl), add = TRUE)
+        parallel::clusterEvalQ(cl, suppressPackageStartupMessages(library(spdep)))
+    }
+    results <- vector("list", n_chunks)
+    batch <- max(1L, workers) * 2L
+    for (start in seq(1L, n_chunks, by = batch)) {
+        ids <- start:min(n_chunks, start + batch - 1L)
+        if (!is.null(cl)) {
+            part <- parallel::parLapply(cl, ids, chunk_fun)
+        } else if (workers > 1) {
+            part <- parallel::mclapply(ids, chunk_fun, mc.cores = workers)
+        } else {
+            part <- lapply(ids, chunk_fun)
+        }
+        failed <- vapply(part, inherits, logical(1), what = "try-error")
+        if (any(failed)) stop(as.character(part[[which(failed)[1]]]))
+        results[ids] <- part
+        rss_progress(round(progress[1] + (progress[2] - progress[1]) * max(ids) / n_chunks), label)
+    }
+    results
+}
+"""
+
+
+def parallel_workers():
+    """
+    並列計算に使うワーカー数（設定 RRunner/ParallelWorkers、0 は自動）。
+    指定した値は R プロセスごとの数なので、全体では最大 RRunner/MaxRProcesses 倍になる。
+    """
+    return max(QgsSettings().value("RRunner/ParallelWorkers", 0, type=int), 0)
+
+
+def r_workers_code():
+    """
+    R 側でワーカー数を決める式。自動（0）の場合は論理コア数を同時に動く R プロセスの上限
+    （max_r_processes）で割った数にし、並行して実行してもコア数を超えないようにする。
+    """
+    return f"rss_workers({parallel_workers()}, {max_r_processes()})"
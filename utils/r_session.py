@@ -0,0 +1,406 @@
+import os
+import queue
+import signal
+import subprocess
+import threading
+import uuid
+from contextlib import contextmanager
+
+from qgis.core import QgsProcessingException, QgsSettings
+
+from .r_packages import REQUIRED_PACKAGES, R_USER_LIB_CODE
+from .scratch import scratch_path, scratch_root
+
+# Rスクリプトから進捗を通知するマーカー（"##PROGRESS## <0-100> <メッセージ>"）
+PROGRESS_MARKER = "##PROGRESS##"
+# 段階ごとの計測を通知するマーカー（"##STAGE## <秒> <Rの最大メモリMB> <段階名>"）
+STAGE_MARKER = "##STAGE##"
+
+# 常駐Rワーカー本体。標準入力から "<token>\t<script>" を1行ずつ受け取り、
+# スクリプトを独立した環境で source() した後、終了マーカーを返す。
+WORKER_R_CODE = r"""
+options(warn = 1)
+{user_lib_code}
+for (pkg in c({packages})) {{
+    suppressPackageStartupMessages(try(library(pkg, character.only = TRUE), silent = TRUE))
+}}
+# 段階の計測（rss_profile_start() を呼んだスクリプトの実行中のみ）
+rss_profile <- new.env()
+rss_profile$enabled <- FALSE
+rss_profile_start <- function() {{
+    invisible(gc(reset = TRUE))
+    rss_profile$enabled <- TRUE
+    rss_profile$last <- proc.time()[["elapsed"]]
+}}
+rss_stage <- function(name) {{
+    if (!rss_profile$enabled) return(invisible(NULL))
+    elapsed <- proc.time()[["elapsed"]] - rss_profile$last
+    g <- gc(reset = TRUE)
+    peak <- sum(g[, which(colnames(g) == "max used") + 1])
+    cat("{stage_marker} ", sprintf("%.3f %.1f ", elapsed, peak), name, "\n", sep = "")
+    flush(stdout())
+    # gc の時間は次の段階に含めない
+    rss_profile$last <- proc.time()[["elapsed"]]
+}}
+rss_progress <- function(percent, msg = "") {{
+    rss_stage(msg)
+    cat("{marker} ", percent, " ", msg, "\n", sep = "")
+    flush(stdout())
+}}
+con <- file("stdin", open = "r")
+repeat {{
+    line <- readLines(con, n = 1, warn = FALSE)
+    if (length(line) == 0 || line == "__QUIT__") break
+    parts <- strsplit(line, "\t", fixed = TRUE)[[1]]
+    token <- parts[1]
+    status <- tryCatch({{
+        source(parts[2], local = new.env(parent = globalenv()), encoding = "UTF-8")
+        0L
+    }}, error = function(e) {{
+        message("Error: ", conditionMessage(e))
+        1L
+    }})
+    rss_stage("最後のマーカー以降")
+    rss_profile$enabled <- FALSE
+    message(token)
+    flush(stdout())
+    cat(token, " ", status, "\n", sep = "")
+    flush(stdout())
+}}
+"""
+
+
+class RWorkerSession:
+    """
+    Rscriptを常駐させ、複数回のスクリプト実行で使い回すセッション。
+    R本体とパッケージ読み込みの起動コストを最初の1回だけにする。
+    ワーカーが落ちていた場合は次回実行時に自動で再起動する。
+    """
+
+    def __init__(self, rscript_path):
+        self.rscript_path = rscript_path
+        self._process = None
+        self._lines = None
+        self._worker_file = None
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """ワーカーを起動する（起動済みなら何もしない）"""
+        if self.is_alive():
+            return
+        self._cleanup()
+
+        packages = ", ".join(f'"{pkg}"' for pkg in REQUIRED_PACKAGES)
+        r_code = WORKER_R_CODE.format(
+            packages=packages, user_lib_code=R_USER_LIB_CODE, marker=PROGRESS_MARKER,
+            stage_marker=STAGE_MARKER
+        )
+        # ワーカーは実行をまたいで使うので、実行ごとの作業フォルダではなく置き場所の直下に置く
+        self._worker_file = os.path.join(scratch_root(), f"worker_{os.getpid()}_{uuid.uuid4().hex}.R")
+        with open(self._worker_file, "w", encoding="utf-8") as f:
+            f.write(r_code)
+
+        self._process = subprocess.Popen(
+            [self.rscript_path, self._worker_file],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace",
+            bufsize=1,
+            # プロセスツリーごと終了できるように別グループで起動
+            start_new_session=(os.name != "nt")
+        )
+        # stdout / stderr を1本のキューにまとめて読む
+        self._lines = queue.Queue()
+        for name, stream in (("stdout", self._process.stdout), ("stderr", self._process.stderr)):
+            threading.Thread(
+                target=self._pump, args=(name, stream, self._lines), daemon=True
+            ).start()
+
+    @staticmethod
+    def _pump(name, stream, lines):
+        for line in iter(stream.readline, ""):
+            lines.put((name, line))
+        lines.put((name, None))
+
+    def run(self, script_path, feedback=None, on_stage=None):
+        """
+        Rスクリプトをワーカーで実行する。
+        feedback を渡すと stdout / stderr を1行ずつ送り、進捗マーカーを反映し、
+        キャンセル時にはRのプロセスツリーを終了する。
+        on_stage を渡すと段階の計測マーカーごとに on_stage(段階名, 秒, Rの最大メモリMB) を呼ぶ。
+        戻り値は subprocess.run と同じ形の CompletedProcess
+        （キャンセル時は returncode が None）。
+        """
+        with self._lock:
+            self.start()
+            token = f"__RSS_DONE_{uuid.uuid4().hex}__"
+            try:
+                self._send(f"{token}\t{script_path}")
+            except (BrokenPipeError, OSError):
+                # 待機中にワーカーが落ちていた場合は1度だけ再起動する
+                self._cleanup()
+                self.start()
+                self._send(f"{token}\t{script_path}")
+            return self._collect(script_path, token, feedback, on_stage)
+
+    def _send(self, line):
+        self._process.stdin.write(line.replace("\\", "/") + "\n")
+        self._process.stdin.flush()
+
+    def _collect(self, script_path, token, feedback, on_stage=None):
+        stdout, stderr = [], []
+        returncode = None
+        stderr_done = False
+        while returncode is None or not stderr_done:
+            if feedback is not None and feedback.isCanceled():
+                self._kill_tree()
+                return subprocess.CompletedProcess(
+                    [self.rscript_path, script_path], None, "".join(stdout), "".join(stderr)
+                )
+            try:
+                name, line = self._lines.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if line is None:
+                # 実行中にワーカーが終了した（クラッシュ）
+                self._process.wait()
+                returncode = self._process.returncode or -1
+                self._cleanup()
+                break
+            text = line.rstrip("\r\n")
+            if token in text:
+                # 改行で終わらなかった最後の出力の後ろに終了の目印が続いた場合は、前の部分を出力として扱う
+                text, _, rest = text.partition(token)
+                if name == "stdout":
+                    returncode = int(rest.strip() or 1)
+                else:
+                    stderr_done = True
+                if not text:
+                    continue
+                line = text + "\n"
+            elif name == "stdout" and text.startswith(PROGRESS_MARKER):
+                self._report_progress(text[len(PROGRESS_MARKER):], feedback)
+                continue
+            elif name == "stdout" and text.startswith(STAGE_MARKER):
+                self._report_stage(text[len(STAGE_MARKER):], on_stage)
+                continue
+            if name == "stdout":
+                stdout.append(line)
+                if feedback is not None:
+                    feedback.pushInfo(text)
+            else:
+                stderr.append(line)
+                if feedback is not None:
+                    feedback.pushConsoleInfo(text)
+        return subprocess.CompletedProcess(
+            [self.rscript_path, script_path], returncode, "".join(stdout), "".join(stderr)
+        )
+
+    @staticmethod
+    def _report_progress(text, feedback):
+        if feedback is None:
+            return
+        percent, _, message = text.strip().partition(" ")
+        try:
+            feedback.setProgress(float(percent))
+        except ValueError:
+            return
+        if message:
+            feedback.setProgressText(message)
+
+    @staticmethod
+    def _report_stage(text, on_stage):
+        if on_stage is None:
+            return
+        parts = text.strip().split(" ", 2)
+        try:
+            seconds, peak = float(parts[0]), float(parts[1])
+        except (IndexError, ValueError):
+            return
+        on_stage(parts[2] if len(parts) > 2 else "", seconds, peak)
+
+    def _kill_tree(self):
+        """ワーカーと、そこから起動された子プロセスをまとめて終了する"""
+        if self.is_alive():
+            if os.name == "nt":
+                subprocess.run(
+                    ["taskkill", "/F", "/T", "/PID", str(self._process.pid)],
+                    capture_output=True
+                )
+            else:
+                try:
+                    os.killpg(self._process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self._cleanup()
+
+    def shutdown(self):
+        """ワーカーを終了する"""
+        with self._lock:
+            if self.is_alive():
+                try:
+                    self._process.stdin.write("__QUIT__\n")
+                    self._process.stdin.flush()
+                    self._process.wait(timeout=5)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._process.kill()
+            self._cleanup()
+
+    def _cleanup(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.kill()
+            for stream in (self._process.stdin, self._process.stdout, self._process.stderr):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self._process = None
+        if self._worker_file and os.path.exists(self._worker_file):
+            os.remove(self._worker_file)
+        self._worker_file = None
+
+
+class RSessionPool:
+    """
+    常駐Rセッションのプール。並行して実行されるアルゴリズムにはそれぞれ別のセッションを渡し、
+    終わったセッションは待機させて次の実行で使い回す。
+    待機させる数は同時実行の上限（max_r_processes）までで、それを超えた分は終了する。
+    """
+
+    def __init__(self, rscript_path):
+        self.rscript_path = rscript_path
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        """待機中のセッションを返す（なければ新しく作る。起動は実行時）"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return RWorkerSession(self.rscript_path)
+
+    def release(self, session):
+        """実行が終わったセッションを戻す"""
+        with self._lock:
+            if not self._closed and session.is_alive() and len(self._idle) < max_r_processes():
+                self._idle.append(session)
+                return
+        session.shutdown()
+
+    def shutdown(self):
+        """待機中のセッションを終了する（実行中のものは release 時に終了する）"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.shutdown()
+
+
+def max_r_processes():
+    """
+    同時に実行する R プロセスの上限（設定 RRunner/MaxRProcesses、0 は自動 = 論理コア数の半分）。
+    並べ替え検定の並列ワーカーの自動の数（RRunner/ParallelWorkers = 0）は、論理コア数をこの値で割って決める。
+    """
+    value = QgsSettings().value("RRunner/MaxRProcesses", 0, type=int)
+    if value > 0:
+        return value
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+# 実行中の R プロセスの数（全アルゴリズム・全スレッドで共通）
+_slots = threading.Condition()
+_running = 0
+
+
+@contextmanager
+def r_process_slot(feedback=None):
+    """
+    R プロセスの実行枠を1つ確保する。上限に達していれば空くまで待つ。
+    待っている間にキャンセルされた場合は QgsProcessingException。
+    """
+    global _running
+    with _slots:
+        waiting = False
+        while _running >= max_r_processes():
+            if feedback is not None:
+                if feedback.isCanceled():
+                    raise QgsProcessingException("処理がキャンセルされました")
+                if not waiting:
+                    feedback.pushInfo("他の R の処理が終わるのを待っています（RRunner/MaxRProcesses）")
+            waiting = True
+            _slots.wait(timeout=0.2)
+        _running += 1
+    try:
+        yield
+    finally:
+        with _slots:
+            _running -= 1
+            _slots.notify()
+
+
+def r_session_pool_for(algorithm, rscript_path):
+    """
+    アルゴリズムが属するプロバイダのセッションプールを返す。
+    プロバイダ外から実行された場合は None（単発のセッションを使う）。
+    """
+    provider = algorithm.provider()
+    if provider is not None and hasattr(provider, "r_session_pool"):
+        return provider.r_session_pool(rscript_path)
+    return None
+
+
+class _OneShotSession(RWorkerSession):
+    """1回実行したら終了するセッション"""
+
+    def run(self, script_path, feedback=None, on_stage=None):
+        try:
+            return super().run(script_path, feedback, on_stage)
+        finally:
+            self.shutdown()
+
+
+def run_r_script(algorithm, rscript_path, r_code, feedback, profiler=None):
+    """
+    Rコードを一時ファイルに保存し、常駐セッションで実行する。
+    同時に実行する R プロセスは max_r_processes() までで、超えた分は空くまで待つ。
+    出力は逐次 feedback に送られる。エラー・キャンセル時は QgsProcessingException。
+    profiler（profiling.StageProfiler）を渡すと、R の起動・スクリプト内の段階を記録する。
+    戻り値は R の標準出力。
+    """
+    profiling = profiler is not None and profiler.enabled
+    if profiling:
+        r_code = "rss_profile_start()\n" + r_code
+    r_script_file = scratch_path("script_", ".R")
+    with open(r_script_file, "w", encoding="utf-8") as f:
+        f.write(r_code)
+    pool = r_session_pool_for(algorithm, rscript_path)
+    try:
+        with r_process_slot(feedback):
+            session = pool.acquire() if pool is not None else _OneShotSession(rscript_path)
+            try:
+                if profiling:
+                    profiler.mark("R の実行待ち")
+                    # 起動済みの常駐セッションなら何もしない
+                    session.start()
+                    profiler.mark("R の起動")
+                result = session.run(r_script_file, feedback, profiler.add_r_stage if profiling else None)
+            finally:
+                if pool is not None:
+                    pool.release(session)
+    finally:
+        os.remove(r_script_file)
+    if profiling:
+        profiler.mark("R スクリプト")
+
+    if result.returncode is None:
+        raise QgsProcessingException("処理がキャンセルされました")
+    if result.returncode != 0:
+        raise QgsProcessingException(f"R実行中にエラー:\n{result.stderr}\n{result.stdout}")
+    return result.stdout
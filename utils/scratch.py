@@ -0,0 +1,250 @@
+"""
+一時ファイル（R スクリプト・R の出力 GPKG・受け渡し用ファイルなど）の置き場所を管理する。
+アルゴリズムの実行ごとに作業フォルダ（run_<pid>_<id>）を作り、実行が終わると成功・失敗に
+関係なくフォルダごと削除する。置き場所は設定 RRunner/ScratchDir で変更できる（/dev/shm など）。
+異常終了したプロセスが残したファイルは、プラグインの起動時に sweep_orphans で削除する。
+"""
+import functools
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from qgis.core import QgsProcessingException, QgsSettings
+
+# 置き場所の既定値（一時フォルダ内）
+DEFAULT_SCRATCH_DIR = os.path.join(tempfile.gettempdir(), "r_spatial_stat_scratch")
+# 以前のバージョンが一時フォルダに直接作っていたファイルの接頭辞（起動時の掃除の対象）
+_LEGACY_PREFIXES = ("output_neighbors_", "nb_polygons_", "input_polygons_", "lisa_results_",
+                    "gisa_table_", "nb_edges_", "rss_handoff_")
+# 作成したプロセスの pid を含む名前（"<接頭辞>_<pid>_<uuid>..."）
+_OWNER_PATTERN = re.compile(r"_(\d+)_[0-9a-f]{32}")
+
+# 実行中の作業フォルダ（スレッドごと。アルゴリズムは1つのスレッドで実行される）
+_local = threading.local()
+# このプロセスで実行中の作業フォルダの数（容量の上限を超えたときの待ち合わせ用）
+_active = threading.Condition()
+_active_count = 0
+
+
+def scratch_root():
+    """一時ファイルの置き場所を返す（無ければ作成する）"""
+    root = QgsSettings().value("RRunner/ScratchDir", "") or DEFAULT_SCRATCH_DIR
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+def _unique_name(prefix, suffix=""):
+    return f"{prefix}{os.getpid()}_{uuid.uuid4().hex}{suffix}"
+
+
+class ScratchScope:
+    """1回の実行で使う作業フォルダ"""
+
+    def __init__(self, root):
+        self.directory = os.path.join(root, _unique_name("run_"))
+        os.makedirs(self.directory)
+
+    def path(self, prefix, suffix=""):
+        """作業フォルダ内の新しいファイルのパス"""
+        return os.path.join(self.directory, _unique_name(prefix, suffix))
+
+    def mkdtemp(self, prefix):
+        """作業フォルダ内に新しいフォルダを作る"""
+        return tempfile.mkdtemp(prefix=prefix, dir=self.directory)
+
+    def cleanup(self):
+        """作業フォルダの中身を削除する（何度呼んでもよい）"""
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    # 開いたままのファイル（Windows）は起動時の掃除で削除する
+                    pass
+
+    def remove(self):
+        self.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _usage_bytes(root):
+    """作業フォルダの合計サイズ"""
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _wait_for_quota(root, feedback):
+    """
+    設定 RRunner/ScratchMaxMB（0 は無制限）を超えていれば、孤立したファイルを掃除し、
+    それでも超えていれば他の実行が終わるのを待つ。他に実行中のものが無ければ QgsProcessingException。
+    """
+    max_mb = QgsSettings().value("RRunner/ScratchMaxMB", 0, type=int)
+    if max_mb <= 0:
+        return
+    max_bytes = max_mb * 1024 * 1024
+    if _usage_bytes(root) < max_bytes:
+        return
+    sweep_orphans()
+    with _active:
+        waiting = False
+        while _usage_bytes(root) >= max_bytes:
+            if _active_count == 0:
+                raise QgsProcessingException(
+                    f"一時ファイルの置き場所（{root}）の使用量が上限（RRunner/ScratchMaxMB = {max_mb} MB）を超えています"
+                )
+            if feedback is not None:
+                if feedback.isCanceled():
+                    raise QgsProcessingException("処理がキャンセルされました")
+                if not waiting:
+                    feedback.pushInfo("一時ファイルの使用量が上限を超えています。他の処理が終わるのを待っています（RRunner/ScratchMaxMB）")
+            waiting = True
+            _active.wait(timeout=0.5)
+
+
+@contextmanager
+def scratch_scope(feedback=None):
+    """
+    作業フォルダを作り、その間 scratch_path / scratch_dir の置き場所にする。
+    抜けるときに（例外で抜けた場合も）作業フォルダを削除する。
+    """
+    global _active_count
+    root = scratch_root()
+    _wait_for_quota(root, feedback)
+    scope = ScratchScope(root)
+    previous = getattr(_local, "scope", None)
+    _local.scope = scope
+    with _active:
+        _active_count += 1
+    try:
+        yield scope
+    finally:
+        _local.scope = previous
+        scope.remove()
+        with _active:
+            _active_count -= 1
+            _active.notify_all()
+
+
+def scratch_scoped(process_algorithm):
+    """processAlgorithm を作業フォルダの中で実行するデコレータ"""
+    @functools.wraps(process_algorithm)
+    def wrapper(self, parameters, context, feedback):
+        with scratch_scope(feedback):
+            return process_algorithm(self, parameters, context, feedback)
+    return wrapper
+
+
+def scratch_path(prefix, suffix=""):
+    """
+    一時ファイルのパスを返す。実行中の作業フォルダがあればその中
+    （実行の終わりに削除される）、無ければ置き場所の直下（呼び出し側で削除する）。
+    """
+    scope = getattr(_local, "scope", None)
+    if scope is not None:
+        return scope.path(prefix, suffix)
+    return os.path.join(scratch_root(), _unique_name(prefix, suffix))
+
+
+def scratch_dir(prefix):
+    """一時フォルダを作って返す（置き場所は scratch_path と同じ）"""
+    scope = getattr(_local, "scope", None)
+    if scope is not None:
+        return scope.mkdtemp(prefix)
+    return tempfile.mkdtemp(prefix=_unique_name(prefix) + "_", dir=scratch_root())
+
+
+def cleanup_scratch():
+    """実行中の作業フォルダの中身を今すぐ削除する（フォルダ自体は実行の終わりに削除される）"""
+    scope = getattr(_local, "scope", None)
+    if scope is not None:
+        scope.cleanup()
+
+
+def _process_exists(pid):
+    """pid のプロセスが存在するか。判定できない場合は None"""
+    if os.name == "nt":
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            if not ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return None
+            return code.value == STILL_ACTIVE
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return None
+    return True
+
+
+def _remove_entry(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def sweep_orphans():
+    """
+    終了したプロセスが残した一時ファイルを削除する（プラグインの起動時に呼ぶ）。
+    名前の pid のプロセスが存在しないもの、pid が判定できず RRunner/ScratchOrphanHours
+    （既定 24 時間）より古いもの、以前のバージョンが一時フォルダに残した同じ時間より古いものが対象。
+    戻り値は削除したファイル・フォルダの数。
+    """
+    max_age = QgsSettings().value("RRunner/ScratchOrphanHours", 24, type=float) * 3600
+    now = time.time()
+    removed = 0
+    for entry in os.scandir(scratch_root()):
+        match = _OWNER_PATTERN.search(entry.name)
+        if match is None:
+            continue
+        pid = int(match.group(1))
+        if pid == os.getpid():
+            continue
+        exists = _process_exists(pid)
+        try:
+            expired = now - entry.stat(follow_symlinks=False).st_mtime > max_age
+        except OSError:
+            continue
+        if exists is False or (exists is None and expired):
+            removed += _remove_entry(entry.path)
+
+    for entry in os.scandir(tempfile.gettempdir()):
+        if not entry.name.startswith(_LEGACY_PREFIXES):
+            continue
+        try:
+            expired = now - entry.stat(follow_symlinks=False).st_mtime > max_age
+        except OSError:
+            continue
+        if expired:
+            removed += _remove_entry(entry.path)
+    return removed
@@ -0,0 +1,57 @@
+"""
+出力シンクへの地物の書き込みをまとめて行う。
+地物ごとに addFeature を呼ぶ代わりに SINK_BATCH_SIZE 件ずつ addFeatures で書き込み、
+バッチの間で進捗の更新とキャンセルの確認を行う。
+"""
+from qgis.core import QgsFeatureSink, QgsProcessingException
+
+# 1回の addFeatures で書き込む地物数
+SINK_BATCH_SIZE = 10000
+
+
+class BatchedSink:
+    """
+    add() で受け取った地物をバッチにまとめてシンクに書き込む。
+    total（地物数の見込み）を渡すと、progress=(開始, 終了) の範囲で進捗を更新する。
+    キャンセルされた後の add() は何もせず False を返す。
+    """
+
+    def __init__(self, sink, feedback, total=0, progress=(90, 100)):
+        self.sink = sink
+        self.feedback = feedback
+        self.total = max(total, 1)
+        self.progress = progress
+        self.count = 0
+        self._batch = []
+
+    def add(self, feature):
+        if self.feedback.isCanceled():
+            return False
+        self._batch.append(feature)
+        if len(self._batch) >= SINK_BATCH_SIZE:
+            self.flush()
+        return True
+
+    def flush(self):
+        """溜まっている地物を書き込む"""
+        if not self._batch:
+            return
+        if not self.sink.addFeatures(self._batch, QgsFeatureSink.FastInsert):
+            raise QgsProcessingException(f"出力の書き込みに失敗しました: {self.sink.lastError()}")
+        self.count += len(self._batch)
+        self._batch = []
+        start, end = self.progress
+        self.feedback.setProgress(start + (end - start) * min(self.count / self.total, 1))
+
+
+def copy_to_sink(layer, sink, feedback, progress=(90, 100)):
+    """
+    layer（R が書き出したレイヤなど。シンクと同じ列を持つこと）の地物を
+    バッチにまとめてシンクに書き込む。戻り値は書き込んだ地物数。
+    """
+    writer = BatchedSink(sink, feedback, layer.featureCount(), progress)
+    for feat in layer.getFeatures():
+        if not writer.add(feat):
+            break
+    writer.flush()
+    return writer.count
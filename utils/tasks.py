@@ -0,0 +1,41 @@
+"""
+アルゴリズムをタスクマネージャのバックグラウンドタスクとして実行する。
+Python コンソールやスクリプトから複数の解析を投入すると、それぞれが別スレッドで並行して動き、
+QGIS の画面は操作できるままになる（R プロセスの数は RRunner/MaxRProcesses で制限される）。
+"""
+from qgis.core import (QgsApplication,
+                       QgsProcessingAlgRunnerTask,
+                       QgsProcessingContext,
+                       QgsProcessingException,
+                       QgsProcessingFeedback,
+                       QgsProject)
+
+# 実行中のタスクの context / feedback（タスクが終わるまで参照を保持する）
+_running_tasks = {}
+
+
+def run_in_background(algorithm_id, parameters, on_finished=None, feedback=None):
+    """
+    algorithm_id（例: "rspatialstatistics:gisaknearneigh"）をバックグラウンドで実行し、すぐに戻る。
+    on_finished(successful, results) は完了時にメインスレッドで呼ばれる。
+    出力はファイルのパスで指定する（TEMPORARY_OUTPUT のメモリレイヤはプロジェクトに読み込まれない）。
+    戻り値はタスク（cancel() で中止できる）。
+    """
+    algorithm = QgsApplication.processingRegistry().createAlgorithmById(algorithm_id)
+    if algorithm is None:
+        raise QgsProcessingException(f"アルゴリズムが見つかりません: {algorithm_id}")
+    context = QgsProcessingContext()
+    context.setProject(QgsProject.instance())
+    feedback = feedback or QgsProcessingFeedback()
+    task = QgsProcessingAlgRunnerTask(algorithm, parameters, context, feedback)
+    key = id(task)
+    _running_tasks[key] = (context, feedback)
+
+    def finished(successful, results):
+        _running_tasks.pop(key, None)
+        if on_finished is not None:
+            on_finished(successful, results)
+
+    task.executed.connect(finished)
+    QgsApplication.taskManager().addTask(task)
+    return task
@@ -0,0 +1,74 @@
+"""
+近傍（spdep の nb）のディスクキャッシュ。
+同じレイヤ・同じ近傍の設定で GISA / LISA を繰り返し実行したときに、近傍の構築を省略する。
+nb は R の saveRDS 形式で保存し、キーはレイヤの内容と近傍のパラメータから作る。
+"""
+import hashlib
+import os
+
+from qgis.core import QgsSettings
+
+from .disk_cache import cache_dir, evict_lru, touch
+from .layer_tools import layer_fingerprint
+
+# 保存形式を変えたときに古いキャッシュを使わないための版番号
+_CACHE_VERSION = 2
+
+
+def weights_cache_enabled():
+    return QgsSettings().value("RRunner/WeightsCacheEnabled", True, type=bool)
+
+
+def weights_cache_path(layer, kind, **params):
+    """
+    レイヤと近傍の設定に対応するキャッシュファイルのパスを返す。
+    キャッシュが無効な場合は空文字列。
+    kind: "knn" / "dnear" / "contiguity" など近傍の種類
+    params: 近傍の構築に影響するパラメータ（k、距離帯、エンジンなど）
+    """
+    if not weights_cache_enabled():
+        return ""
+    source = "|".join(
+        [str(_CACHE_VERSION), layer_fingerprint(layer), kind] +
+        [f"{name}={params[name]!r}" for name in sorted(params)]
+    )
+    key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir("weights"), f"nb_{key}.rds")
+
+
+def is_cached(cache_path):
+    """キャッシュがあれば LRU の順番を更新して True を返す"""
+    return bool(cache_path) and os.path.exists(cache_path) and touch(cache_path)
+
+
+def r_cached_nb_code(cache_path, r_nb_code):
+    """
+    キャッシュがあれば nb を読み込み、無ければ r_nb_code で構築して保存する R コード。
+    キャッシュは R が読み込む前に他の実行で削除されることがあるので、
+    Python 側でキャッシュを確認済みでも r_nb_code には構築のコードを渡すこと。
+    """
+    if not r_nb_code.strip():
+        raise ValueError("r_nb_code（キャッシュが無い場合の近傍の構築コード）が空です")
+    if not cache_path:
+        return r_nb_code
+    path = cache_path.replace("\\", "/")
+    return f"""
+        nb_cache_path <- "{path}"
+        if (file.exists(nb_cache_path)) {{
+            nb <- readRDS(nb_cache_path)
+            if (length(nb) != nrow(polygons)) stop("キャッシュの近傍と地物数が一致しません")
+            message("キャッシュ済みの近傍を使用します")
+        }} else {{
+            {r_nb_code}
+            # 書き込み途中のファイルを読まないよう、一時ファイルに保存してから置き換える
+            nb_cache_tmp <- paste0(nb_cache_path, ".", Sys.getpid(), ".tmp")
+            saveRDS(nb, nb_cache_tmp)
+            file.rename(nb_cache_tmp, nb_cache_path)
+        }}
+"""
+
+
+def evict_weights_cache():
+    """設定した上限（MB）を超えた分を、使われていない順に削除する"""
+    max_mb = QgsSettings().value("RRunner/WeightsCacheMaxMB", 256, type=int)
+    return evict_lru(cache_dir("weights"), max_mb * 1024 * 1024)
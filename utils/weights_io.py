@@ -0,0 +1,160 @@
+"""
+空間重み行列の書き出し。
+密な n×n の CSV 以外は、辺の数に比例した大きさ・時間で書き出す。
+"""
+import csv
+
+from .neighbours import neighbour_counts
+
+# 書き出し形式（Processing の選択肢と同じ順番）
+WEIGHTS_FORMATS = [
+    'Dense matrix CSV',
+    'Sparse triplets CSV (from_id, to_id, weight)',
+    'GAL (GeoDa)',
+    'GWT (GeoDa)',
+    'Matrix Market (.mtx)'
+]
+DENSE_CSV, SPARSE_CSV, GAL, GWT, MATRIX_MARKET = range(len(WEIGHTS_FORMATS))
+
+WEIGHTS_FILE_FILTER = ('CSV files (*.csv);;GAL files (*.gal);;GWT files (*.gwt);;'
+                       'Matrix Market files (*.mtx)')
+
+
+def format_id(value):
+    """R の paste() と同じように ID 値を文字列化する"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _header_token(text):
+    """GAL/GWT のヘッダ行に書く名前（空白・引用符を含まない1語にする）"""
+    return "".join("_" if c.isspace() or c in "\"'\\" else c for c in str(text)) or "layer"
+
+
+def write_weights(path, weights_format, ids, from_idx, to_idx, weights,
+                  layer_name="layer", id_field="id"):
+    """from_idx の昇順に並んだ辺と重みを、指定した形式で書き出す"""
+    layer_name, id_field = _header_token(layer_name), _header_token(id_field)
+    if weights_format == DENSE_CSV:
+        write_dense_csv(path, ids, from_idx, to_idx, weights)
+    elif weights_format == SPARSE_CSV:
+        write_sparse_csv(path, ids, from_idx, to_idx, weights)
+    elif weights_format == GAL:
+        write_gal(path, ids, from_idx, to_idx, layer_name, id_field)
+    elif weights_format == GWT:
+        write_gwt(path, ids, from_idx, to_idx, weights, layer_name, id_field)
+    else:
+        write_matrix_market(path, len(ids), from_idx, to_idx, weights)
+
+
+def write_dense_csv(path, ids, from_idx, to_idx, weights):
+    """write.csv(weight_mat) と同じ形式の n×n 重み行列を1行ずつ書き出す"""
+    n = len(ids)
+    labels = [format_id(v) for v in ids]
+    counts = neighbour_counts(n, from_idx)
+    starts = counts.cumsum() - counts
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow([""] + labels)
+        row = [0.0] * n
+        for i in range(n):
+            cols = to_idx[starts[i]:starts[i] + counts[i]]
+            for j, w in zip(cols, weights[starts[i]:starts[i] + counts[i]]):
+                row[j] = float(w)
+            writer.writerow([labels[i]] + row)
+            for j in cols:
+                row[j] = 0.0
+
+
+def write_sparse_csv(path, ids, from_idx, to_idx, weights):
+    labels = [format_id(v) for v in ids]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["from_id", "to_id", "weight"])
+        writer.writerows(
+            (labels[i], labels[j], repr(float(w))) for i, j, w in zip(from_idx, to_idx, weights)
+        )
+
+
+def write_gal(path, ids, from_idx, to_idx, layer_name, id_field):
+    labels = [format_id(v) for v in ids]
+    n = len(ids)
+    counts = neighbour_counts(n, from_idx)
+    starts = counts.cumsum() - counts
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"0 {n} {layer_name} {id_field}\n")
+        for i in range(n):
+            neigh = to_idx[starts[i]:starts[i] + counts[i]]
+            f.write(f"{labels[i]} {counts[i]}\n")
+            f.write(" ".join(labels[j] for j in neigh) + "\n")
+
+
+def write_gwt(path, ids, from_idx, to_idx, weights, layer_name, id_field):
+    labels = [format_id(v) for v in ids]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"0 {len(ids)} {layer_name} {id_field}\n")
+        f.writelines(
+            f"{labels[i]} {labels[j]} {float(w)!r}\n" for i, j, w in zip(from_idx, to_idx, weights)
+        )
+
+
+def write_matrix_market(path, n, from_idx, to_idx, weights):
+    """行・列の順番は地物の順番（1始まり）"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("%%MatrixMarket matrix coordinate real general\n")
+        f.write(f"{n} {n} {len(from_idx)}\n")
+        f.writelines(
+            f"{i + 1} {j + 1} {float(w)!r}\n" for i, j, w in zip(from_idx, to_idx, weights)
+        )
+
+
+def r_weights_export_code(weights_format, path, layer_name="layer", id_field="id"):
+    """
+    R スクリプト内で listw（と nb, id_values）を指定形式で書き出すコード。
+    密な行列以外は listw2sn による辺の一覧から書き出す。
+    """
+    if not path:
+        return ""
+    path = path.replace("\\", "/")
+    layer_name, id_field = _header_token(layer_name), _header_token(id_field)
+    if weights_format == DENSE_CSV:
+        return f"""
+        # 書き出し（密な行列のCSV形式）
+        weight_mat <- matrix(0, nrow = length(id_values), ncol = length(id_values))
+        rownames(weight_mat) <- id_values
+        colnames(weight_mat) <- id_values
+        sn <- listw2sn(listw)
+        weight_mat[cbind(sn$from, sn$to)] <- sn$weights
+        write.csv(weight_mat, file = "{path}", row.names = TRUE)
+        """
+    if weights_format == SPARSE_CSV:
+        return f"""
+        # 書き出し（from_id, to_id, weight の疎形式）
+        sn <- listw2sn(listw)
+        write.csv(data.frame(from_id = id_values[sn$from], to_id = id_values[sn$to], weight = sn$weights),
+                  file = "{path}", row.names = FALSE)
+        """
+    if weights_format == GAL:
+        return f"""
+        # 書き出し（GAL形式）
+        nb_out <- nb
+        attr(nb_out, "region.id") <- as.character(id_values)
+        write.nb.gal(nb_out, "{path}", oldstyle = FALSE, shpfile = "{layer_name}", ind = "{id_field}")
+        """
+    if weights_format == GWT:
+        return f"""
+        # 書き出し（GWT形式）
+        sn <- listw2sn(listw)
+        attr(sn, "region.id") <- as.character(id_values)
+        write.sn2gwt(sn, "{path}", shpfile = "{layer_name}", ind = "{id_field}", useInd = TRUE)
+        """
+    return f"""
+        # 書き出し（Matrix Market形式）
+        sn <- listw2sn(listw)
+        con <- file("{path}", "w")
+        writeLines(c("%%MatrixMarket matrix coordinate real general",
+                     paste(length(id_values), length(id_values), nrow(sn))), con)
+        write.table(sn[, c("from", "to", "weights")], con, row.names = FALSE, col.names = FALSE)
+        close(con)
+        """